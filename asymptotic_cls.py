@@ -0,0 +1,329 @@
+import sys
+import time
+
+import numpy as np
+from scipy.optimize import brentq, minimize
+from scipy.stats import norm
+
+# Bump when the limit calculation changes (invalidates cached native limits)
+version = "3"
+
+# Quantiles of the expected limit bands, with the keys used by combine's output (and limits.expected_percent)
+expected_quantiles = { " 2.5": 0.025, "16.0": 0.16, "50.0": 0.5, "84.0": 0.84, "97.5": 0.975 }
+
+# Allowed range of the signal strength, as combine's default r range
+mu_max = 1.0e6
+
+# ------------------------------------------------------------------------------
+def parse_datacard(text):
+    """ Parse a counting-experiment datacard (observations, rates, lnN and gmN nuisances and rateParams)
+
+    Returns a dict with "bins", "observation", "columns" [(bin, process, process index, rate)],
+    "nuisances" [(name, type, [value or None per column])], "gmN_counts" {name: N} and
+    "rate_params" [(name, bin, process, value)].
+    Raises ValueError for anything else (shapes, ...), which this backend does not model.
+    """
+    bins, observation, columns, nuisances, rate_params = None, None, None, [], []
+    gmN_counts = {}
+    column_bins, column_processes, column_indices = None, None, None
+
+    for line in text.splitlines():
+        line = line.split("#")[0].strip()
+        if line == "" or line.startswith("---"): continue
+
+        words = line.split()
+        key   = words[0]
+
+        if key in ["imax", "jmax", "kmax"]:
+            continue
+        elif key == "bin" and observation is None:
+            bins = words[1:]
+        elif key == "observation":
+            observation = [float(val) for val in words[1:]]
+        elif key == "bin":
+            column_bins = words[1:]
+        elif key == "process" and column_processes is None:
+            column_processes = words[1:]
+        elif key == "process":
+            column_indices = [int(val) for val in words[1:]]
+        elif key == "rate":
+            columns = list( zip(column_bins, column_processes, column_indices, [float(val) for val in words[1:]]) )
+        elif len(words) >= 2 and words[1] == "lnN":
+            values = [ None if val == "-" else float(val) for val in words[2:] ]
+            nuisances.append( (key, "lnN", values) )
+        elif len(words) >= 3 and words[1] == "gmN":
+            values = [ None if val == "-" else float(val) for val in words[3:] ]
+            nuisances.append( (key, "gmN", values) )
+            gmN_counts[key] = int(words[2])
+        elif len(words) >= 5 and words[1] == "rateParam":
+            rate_params.append( (key, words[2], words[3], float(words[4])) )
+        else:
+            raise ValueError("unsupported datacard line: " + line)
+
+    if bins is None or observation is None or columns is None:
+        raise ValueError("datacard is missing the bin, observation or rate lines")
+
+    for name, _, values in nuisances:
+        if len(values) != len(columns):
+            raise ValueError("nuisance {0} has {1} entries for {2} columns".format(name, len(values), len(columns)))
+
+    return { "bins": bins, "observation": observation, "columns": columns, "nuisances": nuisances, "gmN_counts": gmN_counts, "rate_params": rate_params }
+
+# ------------------------------------------------------------------------------
+def apply_rate_params(card, parameters=None):
+    """ Card with the rateParams multiplied into the rates, at the values in parameters (default: their initial values)
+
+    rateParams are always fixed, as with combine's --freezeParameters; bin and process may be "*".
+    """
+    parameters = parameters or {}
+    columns = []
+    for column_bin, process, index, rate in card["columns"]:
+        for name, param_bin, param_process, value in card["rate_params"]:
+            if param_bin in ["*", column_bin] and param_process in ["*", process]:
+                rate *= parameters.get(name, value)
+        columns.append( (column_bin, process, index, rate) )
+
+    return dict(card, columns=columns, rate_params=[])
+
+# ------------------------------------------------------------------------------
+class CountingModel:
+    """ Poisson counting bins with multiplicative lnN and gmN nuisances and a signal strength mu
+
+    expected_b(mu, theta) = sum_{c in b} rate_c * (mu if c is signal) * prod_k kappa_kc^theta_k,
+    with a unit Gaussian constraint on every lnN theta_k around its global observable theta0_k.
+    A gmN nuisance with count N scales its columns by exp(theta_k) (kappa = e), constrained by the Poisson
+    term of the control count, -log Poisson(N e^theta0 | N e^theta) = N (e^theta - e^theta0 theta) + const.
+    gmN nuisances with N = 0 have no effect (their columns have zero rate).
+    """
+
+    def __init__(self, card):
+        self.bins = card["bins"]
+        self.observation = np.array(card["observation"], dtype=np.float64)
+
+        bin_index = { name: i for i, name in enumerate(self.bins) }
+        self.column_bin = np.array( [bin_index[column[0]] for column in card["columns"]] )
+        self.is_signal  = np.array( [column[2] <= 0 for column in card["columns"]] )
+        self.rates      = np.array( [column[3] for column in card["columns"]], dtype=np.float64 )
+
+        self.nuisance_names = [ nuisance[0] for nuisance in card["nuisances"] ]
+        self.log_kappa = np.zeros( (len(card["nuisances"]), len(self.rates)) )
+        for k, (name, kind, values) in enumerate(card["nuisances"]):
+            for c, val in enumerate(values):
+                if val is None: continue
+                if kind == "lnN": self.log_kappa[k, c] = np.log(val)
+                elif card["gmN_counts"][name] > 0: self.log_kappa[k, c] = 1.
+
+        # Control counts of the gmN nuisances (0 for lnN, which have Gaussian constraints)
+        self.gamma_counts = np.array( [ card["gmN_counts"][name] if kind == "gmN" else 0 for name, kind, _ in card["nuisances"] ], dtype=np.float64 )
+        self.is_gamma = self.gamma_counts > 0
+
+        # columns -> bins summation matrix
+        self.to_bins = np.zeros( (len(self.rates), len(self.bins)) )
+        self.to_bins[np.arange(len(self.rates)), self.column_bin] = 1.
+
+        self.n_nuisances = len(self.nuisance_names)
+
+    # --------------------------------------------------------------------------
+    def column_rates(self, mu, theta):
+        return self.rates * np.where(self.is_signal, mu, 1.) * np.exp(theta @ self.log_kappa)
+
+    def expected(self, mu, theta):
+        return self.column_rates(mu, theta) @ self.to_bins
+
+    # --------------------------------------------------------------------------
+    def constraint(self, theta, theta0):
+        return np.sum( np.where(self.is_gamma, self.gamma_counts * (np.exp(theta) - np.exp(theta0) * theta), 0.5 * (theta - theta0)**2) )
+
+    def constraint_gradient(self, theta, theta0):
+        return np.where(self.is_gamma, self.gamma_counts * (np.exp(theta) - np.exp(theta0)), theta - theta0)
+
+    def constraint_hessian(self, theta):
+        return np.diag( np.where(self.is_gamma, self.gamma_counts * np.exp(theta), 1.) )
+
+    # --------------------------------------------------------------------------
+    def nll(self, mu, theta, data, theta0):
+        lam = self.expected(mu, theta)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            log_term = np.where(data > 0, data * np.log(lam), 0.)
+        return np.sum(lam - log_term) + self.constraint(theta, theta0)
+
+    # --------------------------------------------------------------------------
+    def fit_theta(self, mu, data, theta0, theta_start=None, max_iterations=50, tolerance=1e-10):
+        """ Conditional fit of the nuisances at fixed mu (damped Newton with analytic derivatives)
+        """
+        theta = np.array(theta0 if theta_start is None else theta_start, dtype=np.float64)
+        if self.n_nuisances == 0: return theta, self.nll(mu, theta, data, theta0)
+
+        nll = self.nll(mu, theta, data, theta0)
+        for _ in range(max_iterations):
+            rates = self.column_rates(mu, theta)
+            lam   = rates @ self.to_bins
+            with np.errstate(divide="ignore", invalid="ignore"):
+                ratio = np.where(data > 0, data / lam, 0.)
+
+            # d lambda_b / d theta_k and d2 lambda_b / d theta_k d theta_l
+            dlam  = (self.log_kappa * rates) @ self.to_bins
+            d2lam = np.einsum("kc,lc,cb->klb", self.log_kappa, self.log_kappa * rates, self.to_bins)
+
+            gradient = dlam @ (1. - ratio) + self.constraint_gradient(theta, theta0)
+            hessian  = d2lam @ (1. - ratio) + (dlam * ratio / np.where(lam > 0, lam, 1.)) @ dlam.T + self.constraint_hessian(theta)
+
+            # Levenberg damping keeps the step a descent direction where the Hessian is not positive definite
+            damping = 0.
+            while True:
+                try:
+                    step = np.linalg.solve(hessian + damping * np.eye(self.n_nuisances), gradient)
+                except np.linalg.LinAlgError:
+                    step = gradient / (1. + damping)
+                theta_new = theta - step
+                nll_new   = self.nll(mu, theta_new, data, theta0)
+                if nll_new <= nll or damping > 1e8: break
+                damping = max(1e-3, 10. * damping)
+
+            if not nll_new <= nll: break # no further improvement
+
+            converged = nll - nll_new < tolerance
+            theta, nll = theta_new, nll_new
+            if converged: break
+
+        return theta, nll
+
+    # --------------------------------------------------------------------------
+    def fit_global(self, data, theta0):
+        """ Unconditional fit with mu in [0, mu_max]
+        """
+        n = self.n_nuisances
+
+        def objective(params):
+            mu, theta = params[0], params[1:]
+            rates = self.column_rates(mu, theta)
+            lam   = rates @ self.to_bins
+            with np.errstate(divide="ignore", invalid="ignore"):
+                ratio    = np.where(data > 0, data / lam, 0.)
+                log_term = np.where(data > 0, data * np.log(lam), 0.)
+            nll = np.sum(lam - log_term) + self.constraint(theta, theta0)
+
+            dlam_dmu = np.where(self.is_signal, self.rates * np.exp(theta @ self.log_kappa), 0.) @ self.to_bins
+            dlam     = (self.log_kappa * rates) @ self.to_bins
+            gradient = np.concatenate( [ [dlam_dmu @ (1. - ratio)], dlam @ (1. - ratio) + self.constraint_gradient(theta, theta0) ] )
+            return nll, gradient
+
+        # Start from the best mu of the nominal model
+        mu_grid = np.concatenate( [[0.], np.logspace(-4, np.log10(mu_max), 41)] )
+        mu_start = mu_grid[ np.argmin( [self.nll(mu, theta0, data, theta0) for mu in mu_grid] ) ]
+
+        result = minimize(objective, np.concatenate([[mu_start], theta0]), jac=True, method="L-BFGS-B",
+                          bounds=[(0., mu_max)] + [(None, None)] * n)
+
+        mu_hat = result.x[0]
+        theta_hat, nll_hat = self.fit_theta(mu_hat, data, theta0, result.x[1:])
+
+        return mu_hat, theta_hat, min(nll_hat, result.fun)
+
+# ------------------------------------------------------------------------------
+class AsymptoticCLs:
+    """ Asymptotic CLs upper limits (q~_mu test statistic, Asimov dataset for the expected bands)
+
+    As in combine's AsymptoticLimits, the background-only Asimov dataset uses the nuisances fitted to
+    the observed data at mu = 0 (also as global observables, i.e. gmN control counts N e^theta).
+    """
+
+    def __init__(self, model, cl=0.95):
+        self.model = model
+        self.alpha = 1. - cl
+
+        theta_nominal = np.zeros(model.n_nuisances)
+        self.data = model.observation
+
+        # Observed data
+        self.mu_hat, self.theta_hat, self.nll_hat = model.fit_global(self.data, theta_nominal)
+        self.theta_nominal = theta_nominal
+
+        # Background-only Asimov dataset with post-fit nuisances
+        theta_bonly, _ = model.fit_theta(0., self.data, theta_nominal)
+        self.asimov        = model.expected(0., theta_bonly)
+        self.theta0_asimov = theta_bonly
+        self.nll_asimov    = model.nll(0., theta_bonly, self.asimov, theta_bonly)
+
+    # --------------------------------------------------------------------------
+    def q_obs(self, mu):
+        if mu <= self.mu_hat: return 0.
+        _, nll = self.model.fit_theta(mu, self.data, self.theta_nominal, self.theta_hat)
+        return max( 2. * (nll - self.nll_hat), 0. )
+
+    def q_asimov(self, mu):
+        _, nll = self.model.fit_theta(mu, self.asimov, self.theta0_asimov, self.theta0_asimov)
+        return max( 2. * (nll - self.nll_asimov), 0. )
+
+    # --------------------------------------------------------------------------
+    def cls_obs(self, mu):
+        """ Asymptotic CLs for the q~_mu test statistic (Cowan, Cranmer, Gross, Vitells)
+        """
+        q, q_a = self.q_obs(mu), self.q_asimov(mu)
+        if q_a <= 0.: return 1.
+        if q <= q_a:
+            p_mu, one_minus_p_b = norm.sf(np.sqrt(q)), norm.cdf(np.sqrt(q_a) - np.sqrt(q))
+        else:
+            p_mu, one_minus_p_b = norm.sf( (q + q_a) / (2. * np.sqrt(q_a)) ), norm.sf( (q - q_a) / (2. * np.sqrt(q_a)) )
+        if one_minus_p_b <= 0.: return 0.
+        return p_mu / one_minus_p_b
+
+    # --------------------------------------------------------------------------
+    def solve(self, function, target):
+        """ mu where the increasing function crosses target, by root finding in log(mu)
+        """
+        low, high = 1e-6, 1.
+        while function(high) < target:
+            low, high = high, 10. * high
+            if high > mu_max: return None
+        while low > 1e-12 and function(low) > target:
+            low /= 10.
+        return float( np.exp( brentq(lambda log_mu: function(np.exp(log_mu)) - target, np.log(low), np.log(high), xtol=1e-6, rtol=1e-6) ) )
+
+    # --------------------------------------------------------------------------
+    def limit_obs(self):
+        return self.solve(lambda mu: -self.cls_obs(mu), -self.alpha)
+
+    def limit_exp(self, quantile):
+        n_sigma = norm.ppf(quantile)
+        target  = norm.isf(self.alpha * norm.cdf(n_sigma)) + n_sigma
+        return self.solve(lambda mu: np.sqrt(self.q_asimov(mu)), target)
+
+# ------------------------------------------------------------------------------
+def asymptotic_limits(datacard_text, cl=0.95, parameters=None):
+    """ Observed and expected limits on r for a counting datacard, in the format of limits.parse_combine_output
+
+    parameters: {rateParam: value}, as combine's --setParameters with those parameters frozen
+    """
+    model = CountingModel( apply_rate_params(parse_datacard(datacard_text), parameters) )
+
+    if not np.any(model.rates[model.is_signal] > 0):
+        return None, { val: None for val in expected_quantiles }
+
+    calculator = AsymptoticCLs(model, cl)
+
+    limit_obs  = calculator.limit_obs()
+    limits_exp = { val: calculator.limit_exp(quantile) for val, quantile in expected_quantiles.items() }
+
+    return limit_obs, limits_exp
+
+# ------------------------------------------------------------------------------
+def main():
+
+    # Usage: python3 asymptotic_cls.py <datacard> [<datacard> ...]
+
+    for datacard in sys.argv[1:]:
+        with open(datacard) as f:
+            text = f.read()
+
+        start = time.time()
+        limit_obs, limits_exp = asymptotic_limits(text)
+
+        print( "--------------------------------------" )
+        print( datacard, "({0:.1f} ms)".format( 1e3 * (time.time() - start) ) )
+        print( "Observed Limit: r <", limit_obs )
+        for val in expected_quantiles:
+            print( "Expected {0}%: r <".format(val), limits_exp[val] )
+
+if __name__ == '__main__':
+    main()
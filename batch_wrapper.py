@@ -0,0 +1,111 @@
+import argparse
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from data_eras import add_data_era_args
+from limits import limit_backends
+from lifetime_sampling import add_lifetime_sampling_args, lifetime_sampler_from_args
+from limit_cache import add_limit_cache_args, limit_cache_from_args
+from skim_cache import add_skim_cache_args
+from column_store import add_column_store_args, column_reader
+from profiling import add_profile_args, profile_path, profiler
+from results_store import add_results_store_args, results_db_from_args
+from combine_wrapper import default_template_datacard, predict_background_from_args, process_signal
+from signal_samples import read_manifest, samples_from_glob, lifetime_list
+
+# ------------------------------------------------------------------------------
+def parseArgs():
+    """ Parse command-line arguments
+    """
+    parser = argparse.ArgumentParser(
+        add_help=True,
+        description='Run the combine wrapper over many signal samples, with the background prediction computed once'
+    )
+
+    parser.add_argument("-d", "--debug",      action="store_true", default=False, help="Debug mode")
+    parser.add_argument("-m", "--manifest",   action="store", default=None, help="Manifest of signal samples (json list of {input, filetag, ctau[, sig_table, lifetimes]}, or text lines '<input> <filetag> <ctau>')")
+    parser.add_argument("-g", "--glob",       action="store", default=None, help="Glob of signal minituples named minituple_<name>_CTau<ctau>_*.root")
+    parser.add_argument("-t", "--template",   action="store", default=default_template_datacard, help="Input template datacard")
+    parser.add_argument("-o", "--output-dir", action="store", default="output", help="Output directory")
+    parser.add_argument("--incl-score",       action="store", default=0.9, help="Signal region inclusive score cut")
+    parser.add_argument("--depth-score",      action="store", default=0.8, help="Signal region depth score cut")
+    parser.add_argument("-l", "--lifetimes",  action="store", default=None, help="Comma separated target lifetimes in mm (default: hardcoded list, a manifest entry's \"lifetimes\" overrides it)")
+    parser.add_argument("--chunk-size",       action="store", type=int, default=None, help="Stream the trees in chunks of this many entries (bounded memory, bypasses the skim cache)")
+    parser.add_argument("-b", "--backend",    action="store", default="combine", choices=limit_backends, help="Limit backend: combine subprocess, native asymptotic CLs, or validate (both, compared)")
+    parser.add_argument("--sample-jobs",      action="store", type=int, default=1, help="Number of signal samples to process in parallel")
+    parser.add_argument("-j", "--jobs",       action="store", type=int, default=1, help="Number of combine jobs (lifetime points) to run in parallel per sample")
+    parser.add_argument("--combine-timeout",  action="store", type=float, default=None, help="Timeout per combine job in seconds")
+    parser.add_argument("-w", "--workspace",  action="store_true", default=False, help="Build one workspace per sample, lifetime points only set the signal rateParams")
+    add_data_era_args(parser)
+    add_skim_cache_args(parser)
+    add_column_store_args(parser)
+    add_limit_cache_args(parser)
+    add_results_store_args(parser)
+    add_lifetime_sampling_args(parser)
+    add_profile_args(parser)
+
+    args = parser.parse_args()
+
+    if (args.manifest is None) == (args.glob is None):
+        parser.error("exactly one of --manifest or --glob is required")
+
+    return args
+
+# ------------------------------------------------------------------------------
+def main():
+
+    # ----- Process Inputs ----- #
+
+    args = parseArgs()
+
+    samples = read_manifest(args.manifest) if args.manifest else samples_from_glob(args.glob)
+    print( "Signal samples:", len(samples) )
+
+    filetags = [ sample["filetag"] for sample in samples ]
+    duplicates = sorted( set( filetag for filetag in filetags if filetags.count(filetag) > 1 ) )
+    if duplicates:
+        raise ValueError("duplicate filetags in the signal samples (outputs would overwrite each other): " + ", ".join(duplicates))
+
+    # One profile for the batch; with --sample-jobs > 1 the per-sample stages run in the workers and are not included
+    if args.profile:
+        profiler.enable(args.profile_hook, os.path.join(args.output_dir, "profile"))
+
+    read_columns = column_reader(args)
+    limit_cache  = limit_cache_from_args(args)
+
+    # ----- Background Prediction (once) ----- #
+
+    with profiler.stage("bkg_prediction"):
+        bkg_predictions = predict_background_from_args(args, read_columns)
+
+    # ----- Signal Samples ----- #
+
+    ctau_targets = lifetime_list(args.lifetimes)
+
+    def sample_args(sample):
+        return ( sample["input"], sample["filetag"], sample["ctau"], bkg_predictions, args.template, args.incl_score, args.depth_score, args.output_dir,
+                 read_columns, args.backend, args.jobs, args.combine_timeout, limit_cache, args.debug, sample.get("lifetimes") or ctau_targets,
+                 lifetime_sampler_from_args(args), args.workspace, args.chunk_size, results_db_from_args(args), sample.get("sig_table") )
+
+    outfiles = []
+    if args.sample_jobs <= 1:
+        for sample in samples:
+            outfiles.append( process_signal(*sample_args(sample)) )
+    else:
+        # Only the background counts are shipped to the workers, every worker reads its own signal sample
+        with ProcessPoolExecutor(max_workers=args.sample_jobs, mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = [ pool.submit(process_signal, *sample_args(sample)) for sample in samples ]
+            outfiles = [ future.result() for future in futures ]
+
+    print( "======================================" )
+    for sample, outfile in zip(samples, outfiles):
+        print( sample["filetag"], "(ctau {0})".format(sample["ctau"]), "-->", outfile )
+
+    if args.profile:
+        os.makedirs(args.output_dir, exist_ok=True)
+        profiler.print_report()
+        profiler.write( profile_path(args.output_dir) )
+
+if __name__ == '__main__':
+    main()
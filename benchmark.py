@@ -0,0 +1,218 @@
+import argparse
+import os
+import sys
+import json
+import time
+import socket
+import platform
+import subprocess
+
+import numpy as np
+
+from datacards import datacard_replacements, render_datacard
+from lifetime_sampling import log_grid
+from limits import run_limit_jobs
+from profiling import peak_rss_mb
+from regions import btag_categories, signal_branches, load_columns, load_column_chunks, tree_entries, count_data_file, calculate_bkg_prediction, signal_region_events, concatenate_columns, calculate_sig_yields
+from synthetic_minituples import write_minituple
+
+benchmark_dir = os.path.join( os.path.dirname(os.path.abspath(__file__)), "benchmarks" )
+
+# Stand-ins for combine and text2workspace.py, put first on the PATH of the limit stages
+stub_dir = os.path.join(benchmark_dir, "stubs")
+
+default_history  = os.path.join(benchmark_dir, "history.jsonl")
+default_work_dir = os.path.join(benchmark_dir, "data")
+default_template = os.path.join( os.path.dirname(os.path.abspath(__file__)), "templates/v1/datacard_TEMPLATE.txt" )
+
+# ------------------------------------------------------------------------------
+def parseArgs():
+    """ Parse command-line arguments
+    """
+    parser = argparse.ArgumentParser(
+        add_help=True,
+        description='Time the stages of the statistics pipeline on synthetic (or given) minituples and record the results over time'
+    )
+
+    parser.add_argument("--sizes",           action="store", default="1e5,1e6,1e7", help="Comma separated numbers of events of the synthetic data and signal trees")
+    parser.add_argument("--data",            action="store", default=None, help="Use this data minituple instead of synthetic data (one size)")
+    parser.add_argument("--signal",          action="store", default=None, help="Use this signal minituple instead of synthetic signal (with --data)")
+    parser.add_argument("--signal-ctau",     action="store", type=float, default=1000., help="Lifetime of the signal sample in mm")
+    parser.add_argument("--work-dir",        action="store", default=default_work_dir, help="Directory of the synthetic minituples (reused between runs)")
+    parser.add_argument("--chunk-size",      action="store", type=int, default=10**6, help="Entries per chunk when reading the trees")
+    parser.add_argument("--lifetimes",       action="store", type=int, default=50, help="Number of target lifetimes of the reweighting")
+    parser.add_argument("--cards",           action="store", type=int, default=20, help="Number of datacards rendered and fitted in the datacard and limit stages")
+    parser.add_argument("-j", "--jobs",      action="store", type=int, default=1, help="Number of stub combine jobs in parallel")
+    parser.add_argument("--combine-latency", action="store", type=float, default=0., help="Seconds the stub combine sleeps per call")
+    parser.add_argument("--incl-score",      action="store", default=0.9, help="Signal region inclusive score cut")
+    parser.add_argument("--depth-score",     action="store", default=0.8, help="Signal region depth score cut")
+    parser.add_argument("--seed",            action="store", type=int, default=1, help="Random seed of the synthetic minituples")
+    parser.add_argument("--history",         action="store", default=default_history, help="History file the results are appended to (json lines)")
+    parser.add_argument("--no-history",      action="store_true", default=False, help="Do not record this run")
+    parser.add_argument("--regression-threshold", action="store", type=float, default=1.25, help="Flag stages slower than this factor times the best previous run")
+    parser.add_argument("--fail-on-regression",   action="store_true", default=False, help="Exit with status 1 when a regression is flagged")
+
+    args = parser.parse_args()
+
+    if (args.data is None) != (args.signal is None):
+        parser.error("--data and --signal go together")
+
+    return args
+
+# ------------------------------------------------------------------------------
+def synthetic_inputs(work_dir, n_events, ctau, seed):
+    """ Paths of the synthetic data and signal minituples with n_events, written on first use
+    """
+    data_file   = os.path.join(work_dir, "data_{0:.0e}_seed{1}.root".format(n_events, seed))
+    signal_file = os.path.join(work_dir, "signal_{0:.0e}_CTau{1:g}_seed{2}.root".format(n_events, ctau, seed))
+
+    if not os.path.exists(data_file):
+        print( "Writing synthetic data:", data_file )
+        write_minituple(data_file, n_events, "data", seed=seed)
+    if not os.path.exists(signal_file):
+        print( "Writing synthetic signal:", signal_file )
+        write_minituple(signal_file, n_events, "signal", ctau, seed=seed)
+
+    return data_file, signal_file
+
+# ------------------------------------------------------------------------------
+def timed(results, stage, n_events, function, *args, **kwargs):
+    """ Call function, append its timing to results and return its value
+    """
+    start = time.perf_counter()
+    value = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+
+    results.append( { "stage": stage, "events": int(n_events), "seconds": seconds,
+                      "events_per_s": n_events / seconds if n_events and seconds > 0 else None, "peak_rss_mb": peak_rss_mb() } )
+    print( "  {0:16s} {1:>10d} {2:10.3f} s".format(stage, int(n_events), seconds) )
+
+    return value
+
+# ------------------------------------------------------------------------------
+def benchmark_events(data_file, signal_file, ctau_sample, args):
+    """ Event-size dependent stages: background counting, signal reading and lifetime reweighting
+    """
+    results = []
+    n_data, n_signal = tree_entries(data_file), tree_entries(signal_file)
+
+    counts = timed(results, "bkg_count", n_data, count_data_file, data_file, args.incl_score, args.depth_score, load_columns, args.chunk_size)
+
+    read_signal = lambda: concatenate_columns([ signal_region_events(columns_chunk, args.incl_score, args.depth_score)
+                                                for columns_chunk in load_column_chunks(signal_file, signal_branches, args.chunk_size) ])
+    columns_sig = timed(results, "signal_read", n_signal, read_signal)
+
+    # Counted as (signal region events x lifetimes) reweighted
+    ctau_targets = log_grid(10., 10000., args.lifetimes)
+    n_reweighted = len(columns_sig[signal_branches[0]]) * len(ctau_targets)
+    yields_sig = timed(results, "signal_yields", n_reweighted, calculate_sig_yields, columns_sig, ctau_sample, ctau_targets, args.incl_score, args.depth_score)
+
+    bkg_predictions = { category: calculate_bkg_prediction(counts[category], 1., verbose=False) for category in btag_categories }
+
+    return results, bkg_predictions, yields_sig
+
+# ------------------------------------------------------------------------------
+def benchmark_limits(bkg_predictions, yields_sig, args):
+    """ Event-size independent stages: datacard rendering and limit extraction (native and stub combine) for args.cards cards
+    """
+    results = []
+    cards_dir = os.path.join(args.work_dir, "cards")
+    os.makedirs(cards_dir, exist_ok=True)
+
+    def render_cards():
+        jobs = []
+        for i_card in range(args.cards):
+            i_ctau = i_card * len(yields_sig["ljdc"]) // args.cards
+            replacements = datacard_replacements(yields_sig["ljdc"][i_ctau] * 100., yields_sig["sjdc"][i_ctau] * 100., bkg_predictions)
+            name = "bench{0}".format(i_card)
+            jobs.append( (render_datacard(default_template, os.path.join(cards_dir, "datacard_" + name + ".txt"), replacements), name) )
+        return jobs
+
+    jobs = timed(results, "datacards", 0, render_cards)
+
+    timed(results, "limits_native", 0, run_limit_jobs, jobs, os.path.join(cards_dir, "work"), backend="native")
+
+    os.environ["PATH"] = stub_dir + os.pathsep + os.environ["PATH"]
+    os.environ["BENCHMARK_COMBINE_LATENCY"] = str(args.combine_latency)
+    timed(results, "limits_combine", 0, run_limit_jobs, jobs, os.path.join(cards_dir, "work"), backend="combine", n_jobs=args.jobs)
+
+    return results
+
+# ------------------------------------------------------------------------------
+def run_description(args):
+    """ What identifies comparable runs in the history: host and benchmark configuration
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(benchmark_dir), capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    config = { "chunk_size": args.chunk_size, "lifetimes": args.lifetimes, "cards": args.cards, "jobs": args.jobs,
+               "combine_latency": args.combine_latency, "incl_score": float(args.incl_score), "depth_score": float(args.depth_score),
+               "inputs": "synthetic" if args.data is None else [os.path.abspath(args.data), os.path.abspath(args.signal)] }
+
+    return { "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": commit, "host": socket.gethostname(),
+             "python": platform.python_version(), "numpy": np.__version__, "config": config }
+
+# ------------------------------------------------------------------------------
+def read_history(path):
+    if not os.path.exists(path): return []
+    with open(path) as f:
+        return [ json.loads(line) for line in f if line.strip() ]
+
+def find_regressions(run, history, threshold, min_seconds=0.05):
+    """ Stages of run slower than threshold times the best previous time of the same stage and size, on the same host and configuration
+    """
+    best = {}
+    for previous in history:
+        if previous["host"] != run["host"] or previous["config"] != run["config"]: continue
+        for result in previous["results"]:
+            key = (result["stage"], result["events"])
+            best[key] = min( best.get(key, np.inf), result["seconds"] )
+
+    regressions = []
+    for result in run["results"]:
+        reference = best.get( (result["stage"], result["events"]) )
+        if reference is None or result["seconds"] < min_seconds: continue
+        if result["seconds"] > threshold * reference:
+            regressions.append( dict(result, best_seconds=reference, slowdown=result["seconds"] / reference) )
+    return regressions
+
+# ------------------------------------------------------------------------------
+def main():
+
+    args = parseArgs()
+
+    run = run_description(args)
+    run["results"] = []
+
+    if args.data is not None:
+        inputs = [ (args.data, args.signal) ]
+    else:
+        inputs = [ synthetic_inputs(args.work_dir, float(size), args.signal_ctau, args.seed) for size in args.sizes.split(",") ]
+
+    print( "{0:18s} {1:>10s} {2:>12s}".format("Stage", "Events", "Time") )
+    for data_file, signal_file in inputs:
+        results, bkg_predictions, yields_sig = benchmark_events(data_file, signal_file, args.signal_ctau, args)
+        run["results"] += results
+
+    # Datacards and limits do not depend on the number of events, run them once on the largest inputs
+    run["results"] += benchmark_limits(bkg_predictions, yields_sig, args)
+
+    history = read_history(args.history)
+    regressions = find_regressions(run, history, args.regression_threshold)
+    for regression in regressions:
+        print( "REGRESSION: {0} ({1} events) {2:.3f} s, best {3:.3f} s ({4:.2f}x)".format(
+               regression["stage"], regression["events"], regression["seconds"], regression["best_seconds"], regression["slowdown"]) )
+
+    if not args.no_history:
+        if os.path.dirname(args.history): os.makedirs(os.path.dirname(args.history), exist_ok=True)
+        with open(args.history, "a") as f:
+            f.write( json.dumps(run) + "\n" )
+        print( "Benchmark recorded in:", args.history )
+
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,7 @@
+#!/usr/bin/env python3
+""" Stand-in for text2workspace.py in the benchmarks: creates the empty output workspace file
+"""
+import sys
+
+args = sys.argv[1:]
+open(args[args.index("-o") + 1], "w").close()
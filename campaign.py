@@ -0,0 +1,345 @@
+import argparse
+import os
+import sys
+import json
+import time
+import fcntl
+import shutil
+import socket
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from signal_samples import read_manifest, samples_from_glob, lifetime_list
+from results_store import ResultsStore, default_db_name, template_version
+
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+wrapper  = os.path.join(repo_dir, "combine_wrapper.py")
+
+job_states = ["pending", "running", "done", "failed"]
+
+# A running job refreshes its status this often; on other hosts it counts as lost once the heartbeat is this old (s)
+heartbeat_interval = 60.
+heartbeat_stale    = 600.
+
+# ------------------------------------------------------------------------------
+def parseArgs():
+    """ Parse command-line arguments
+    """
+    parser = argparse.ArgumentParser(
+        add_help=True,
+        description='Expand a campaign config (samples x cut pairs x templates) into combine wrapper jobs, run them resumably and merge the outputs'
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    for command, help_text in [ ("expand", "Write the job manifest"), ("run", "Run the unfinished jobs with a local process pool"),
+                                ("status", "Count the jobs per state"), ("shards", "Write shard scripts (and an HTCondor submit file) for batch submission"),
+                                ("merge", "Merge the outputs of the finished jobs") ]:
+        subparser = subparsers.add_parser(command, help=help_text)
+        subparser.add_argument("config", action="store", help="Campaign config (json)")
+
+        if command == "run":
+            subparser.add_argument("-n", "--workers", action="store", type=int, default=None, help="Jobs to run at a time (default: cores / wrapper -j)")
+            subparser.add_argument("--shard",         action="store", default=None, help="Only run shard 'i/N' of the jobs (0-based)")
+            subparser.add_argument("--retry-failed",  action="store_true", default=False, help="Also rerun jobs that failed before")
+        if command == "shards":
+            subparser.add_argument("--shards",        action="store", type=int, required=True, help="Number of shards")
+            subparser.add_argument("-n", "--workers", action="store", type=int, default=1, help="Jobs to run at a time within a shard")
+
+    args = parser.parse_args()
+
+    return args
+
+# ------------------------------------------------------------------------------
+def read_config(path):
+    """ Campaign config with defaults filled in
+
+    {
+      "name": "...", "output_dir": "campaigns/<name>",
+      "samples": "<manifest>" | [{"input", "filetag", "ctau"[, "sig_table", "lifetimes"]}], "glob": "<signal minituple glob>" (instead of samples),
+      "incl_scores": [0.9, ...], "depth_scores": [0.8, ...]  (all pairs) | "cut_pairs": [[0.9, 0.8], ...],
+      "lifetimes": [10, 100, ...] (default: the wrapper's), "templates": ["templates/v1/datacard_TEMPLATE.txt", ...],
+      "options": ["-b", "native", "-j", "4", ...] (passed to every combine_wrapper.py job)
+    }
+    """
+    with open(path) as f:
+        config = json.load(f)
+
+    config.setdefault("name", os.path.splitext(os.path.basename(path))[0])
+    config["output_dir"] = os.path.abspath( config.get("output_dir", os.path.join("campaigns", config["name"])) )
+    config.setdefault("templates", [os.path.join(repo_dir, "templates/v1/datacard_TEMPLATE.txt")])
+    config.setdefault("options", [])
+
+    if "cut_pairs" not in config:
+        config["cut_pairs"] = [ [incl, depth] for incl in config.get("incl_scores", [0.9]) for depth in config.get("depth_scores", [0.8]) ]
+
+    return config
+
+def config_samples(config):
+    if "glob" in config: return samples_from_glob(config["glob"])
+    if isinstance(config["samples"], str): return read_manifest(config["samples"])
+    return [ { "input": sample["input"], "filetag": sample["filetag"], "ctau": str(sample["ctau"]), "sig_table": sample.get("sig_table"),
+               "lifetimes": lifetime_list(sample.get("lifetimes")) } for sample in config["samples"] ]
+
+# ------------------------------------------------------------------------------
+def input_path(path):
+    """ Absolute path of a local input, remote inputs (root://, ...) as given
+    """
+    if "://" in path: return path
+    return os.path.abspath(path)
+
+# ------------------------------------------------------------------------------
+def expand_jobs(config):
+    """ One combine wrapper job per (signal sample, cut pair, template), each in its own output directory
+
+    The lifetimes of a job share one signal read and background prediction and run in parallel within the
+    job (wrapper -j), so they are not split into separate jobs.
+    """
+    jobs = []
+    for sample in config_samples(config):
+        for incl_score, depth_score in config["cut_pairs"]:
+            for template in config["templates"]:
+                job_id  = "{0}__inc{1}_depth{2}__{3}".format(sample["filetag"], incl_score, depth_score, template_version(template))
+                job_dir = os.path.join(config["output_dir"], "jobs", job_id)
+
+                command = [ wrapper, "-i", input_path(sample["input"]), "-f", sample["filetag"], "-c", sample["ctau"], "-t", os.path.abspath(template),
+                            "--incl-score", str(incl_score), "--depth-score", str(depth_score), "-o", job_dir,
+                            "--results-db", os.path.join(job_dir, default_db_name) ]
+                if sample.get("sig_table"):
+                    command += [ "--sig-table", os.path.abspath(sample["sig_table"]) ]
+                lifetimes = sample.get("lifetimes") or lifetime_list(config.get("lifetimes"))
+                if lifetimes:
+                    command += [ "-l", ",".join(lifetimes) ]
+                command += [ str(option) for option in config["options"] ]
+
+                jobs.append( { "id": job_id, "sample": sample["filetag"], "incl_score": incl_score, "depth_score": depth_score,
+                               "template": template_version(template), "output_dir": job_dir, "command": command,
+                               "results_json": os.path.join(job_dir, "{0}_inc{1}_depth{2}.json".format(sample["filetag"], incl_score, depth_score)) } )
+
+    job_ids = [ job["id"] for job in jobs ]
+    duplicates = sorted( set( job_id for job_id in job_ids if job_ids.count(job_id) > 1 ) )
+    if duplicates:
+        raise ValueError("duplicate campaign jobs (same filetag, cuts and template version): " + ", ".join(duplicates))
+
+    return jobs
+
+def write_manifest(config, jobs):
+    path = os.path.join(config["output_dir"], "manifest.json")
+    os.makedirs(config["output_dir"], exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({ "name": config["name"], "jobs": jobs }, f, indent=2)
+    return path
+
+# ------------------------------------------------------------------------------
+def status_path(config, job):
+    return os.path.join(config["output_dir"], "status", job["id"] + ".json")
+
+def read_status(config, job):
+    """ Job status {"state", ...}; a job counts as done only if its results json exists
+    """
+    path = status_path(config, job)
+    if not os.path.exists(path): return { "state": "pending" }
+
+    with open(path) as f:
+        status = json.load(f)
+    if status["state"] == "done" and not os.path.exists(job["results_json"]):
+        return { "state": "pending" }
+    return status
+
+def write_status(config, job, status):
+    path = status_path(config, job)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    path_temp = path + ".tmp{0}".format(os.getpid())
+    with open(path_temp, "w") as f:
+        json.dump(status, f, indent=2)
+    os.replace(path_temp, path)
+
+def is_alive(status):
+    """ Whether the process of a "running" job still exists: by pid on the same host, by heartbeat age on other hosts
+    """
+    if status.get("host") == socket.gethostname() and status.get("pid"):
+        try:
+            os.kill(status["pid"], 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    return time.time() - status.get("heartbeat", status.get("start", 0.)) < heartbeat_stale
+
+def is_runnable(status, retry_failed=False):
+    """ Pending jobs, jobs whose running process is gone (crash, preempted node) and, with retry_failed, failed jobs
+    """
+    if status["state"] == "running": return not is_alive(status)
+    return status["state"] == "pending" or (retry_failed and status["state"] == "failed")
+
+# ------------------------------------------------------------------------------
+def run_job(config, job, retry_failed=False):
+    """ Run one job, its output in job/log.txt, and record its status (with a heartbeat while it runs)
+
+    The job is claimed under a lock on its status file, so a job started meanwhile by another run or shard is skipped.
+    """
+    os.makedirs(job["output_dir"], exist_ok=True)
+    log_path = os.path.join(job["output_dir"], "log.txt")
+
+    lock_path = status_path(config, job)[:-len(".json")] + ".lock"
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    with open(lock_path, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not is_runnable(read_status(config, job), retry_failed):
+            print( "{0:8s} {1} (claimed by another run)".format("skipped", job["id"]) )
+            return "skipped"
+
+        status = { "state": "running", "host": socket.gethostname(), "runner_pid": os.getpid(), "start": time.time(), "log": log_path }
+        log = open(log_path, "w")
+        process = subprocess.Popen([sys.executable] + job["command"], stdout=log, stderr=subprocess.STDOUT)
+        status["pid"] = process.pid
+        status["heartbeat"] = time.time()
+        write_status(config, job, status)
+
+    with log:
+        while True:
+            try:
+                returncode = process.wait(timeout=heartbeat_interval)
+                break
+            except subprocess.TimeoutExpired:
+                status["heartbeat"] = time.time()
+                write_status(config, job, status)
+
+    status["end"] = time.time()
+    status["elapsed"] = status["end"] - status["start"]
+    status["returncode"] = returncode
+    status["state"] = "done" if returncode == 0 and os.path.exists(job["results_json"]) else "failed"
+    write_status(config, job, status)
+
+    print( "{0:8s} {1} ({2:.0f} s)".format(status["state"], job["id"], status["elapsed"]) )
+    return status["state"]
+
+# ------------------------------------------------------------------------------
+def jobs_of_shard(jobs, shard):
+    if shard is None: return jobs
+
+    i_shard, n_shards = [ int(val) for val in shard.split("/") ]
+    return jobs[i_shard::n_shards]
+
+def default_workers(config):
+    """ Cores divided by the combine jobs each wrapper runs in parallel (-j)
+    """
+    options = [ str(option) for option in config["options"] ]
+    for flag in ["-j", "--jobs"]:
+        if flag in options:
+            return max( 1, (os.cpu_count() or 1) // int(options[options.index(flag) + 1]) )
+    return os.cpu_count() or 1
+
+def run_campaign(config, jobs, n_workers, retry_failed=False):
+    """ Run the unfinished jobs, n_workers at a time; jobs already done (and, unless retry_failed, failed) are skipped
+
+    A job left "running" is started again only if its process is gone (see is_alive), so a second run or an
+    overlapping shard does not duplicate live jobs.
+    """
+    to_run = [ job for job in jobs if is_runnable(read_status(config, job), retry_failed) ]
+
+    print( "Campaign {0}: {1} jobs, {2} to run, {3} workers".format(config["name"], len(jobs), len(to_run), n_workers) )
+
+    # Every job is its own process; the pool only keeps n_workers of them busy
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        results = list( pool.map(lambda job: run_job(config, job, retry_failed), to_run) )
+
+    return results.count("failed")
+
+# ------------------------------------------------------------------------------
+def print_status(config, jobs):
+
+    counts = { state: 0 for state in job_states }
+    for job in jobs:
+        status = read_status(config, job)
+        counts[status["state"]] += 1
+        if status["state"] == "failed":
+            print( "failed:", job["id"], "log:", status.get("log") )
+        elif status["state"] == "running" and not is_alive(status):
+            print( "lost:  ", job["id"], "(process gone, rerun by the next 'run')" )
+
+    print( "Campaign {0}: {1} jobs --".format(config["name"], len(jobs)), ", ".join( "{0} {1}".format(counts[state], state) for state in job_states ) )
+    return counts
+
+# ------------------------------------------------------------------------------
+def write_shards(config_path, config, n_shards, n_workers):
+    """ One shell script per shard running 'campaign.py run --shard i/N', and an HTCondor submit file for all of them
+
+    Shards share the status files, so a resubmitted shard only runs its unfinished jobs.
+    """
+    shard_dir = os.path.join(config["output_dir"], "shards")
+    os.makedirs(os.path.join(shard_dir, "logs"), exist_ok=True)
+
+    scripts = []
+    for i_shard in range(n_shards):
+        script = os.path.join(shard_dir, "shard_{0}.sh".format(i_shard))
+        with open(script, "w") as f:
+            f.write("#!/bin/bash\n")
+            f.write("cd {0}\n".format(os.getcwd()))
+            f.write("python3 {0} run {1} --shard {2}/{3} --workers {4}\n".format(os.path.join(repo_dir, "campaign.py"), os.path.abspath(config_path), i_shard, n_shards, n_workers))
+        os.chmod(script, 0o755)
+        scripts.append(script)
+
+    with open(os.path.join(shard_dir, "condor.sub"), "w") as f:
+        f.write("executable     = {0}/shard_$(Process).sh\n".format(os.path.abspath(shard_dir)))
+        f.write("output         = {0}/logs/shard_$(Process).out\n".format(os.path.abspath(shard_dir)))
+        f.write("error          = {0}/logs/shard_$(Process).err\n".format(os.path.abspath(shard_dir)))
+        f.write("log            = {0}/logs/condor.log\n".format(os.path.abspath(shard_dir)))
+        f.write("request_cpus   = {0}\n".format(n_workers))
+        f.write("getenv         = True\n")
+        f.write("queue {0}\n".format(n_shards))
+
+    return scripts
+
+# ------------------------------------------------------------------------------
+def merge_campaign(config, jobs):
+    """ Merge the results stores of the finished jobs into <output_dir>/results.sqlite, and collect their
+    results jsons in <output_dir>/results (named <filetag>_inc<x>_depth<y>_<template>.json)
+    """
+    store = ResultsStore( os.path.join(config["output_dir"], default_db_name) )
+    results_dir = os.path.join(config["output_dir"], "results")
+    os.makedirs(results_dir, exist_ok=True)
+
+    merged = []
+    for job in jobs:
+        if read_status(config, job)["state"] != "done": continue
+        store.merge( os.path.join(job["output_dir"], default_db_name) )
+        shutil.copy2( job["results_json"], os.path.join(results_dir, os.path.basename(job["results_json"]).replace(".json", "_" + job["template"] + ".json")) )
+        merged.append(job["id"])
+    store.close()
+
+    print( "Merged {0}/{1} jobs into {2} and {3}".format(len(merged), len(jobs), store.path, results_dir) )
+    return merged
+
+# ------------------------------------------------------------------------------
+def main():
+
+    args = parseArgs()
+
+    config = read_config(args.config)
+    jobs = expand_jobs(config)
+
+    if args.command == "expand":
+        print( "Job manifest ({0} jobs) written to: {1}".format(len(jobs), write_manifest(config, jobs)) )
+
+    elif args.command == "run":
+        write_manifest(config, jobs)
+        n_failed = run_campaign(config, jobs_of_shard(jobs, args.shard), args.workers or default_workers(config), args.retry_failed)
+        print_status(config, jobs)
+        if n_failed: sys.exit(1)
+
+    elif args.command == "status":
+        print_status(config, jobs)
+
+    elif args.command == "shards":
+        write_manifest(config, jobs)
+        scripts = write_shards(args.config, config, args.shards, args.workers)
+        print( "Shard scripts written to:", os.path.dirname(scripts[0]), "(submit with: condor_submit {0})".format(os.path.join(os.path.dirname(scripts[0]), "condor.sub")) )
+
+    elif args.command == "merge":
+        merge_campaign(config, jobs)
+
+if __name__ == '__main__':
+    main()
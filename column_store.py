@@ -0,0 +1,180 @@
+import os
+import sys
+import json
+import time
+import fcntl
+import tempfile
+from collections.abc import Mapping
+
+import numpy as np
+
+from regions import load_columns, default_preselection
+from skim_cache import skim_cache_reader
+from entry_store import EntryStore
+
+# RAM-backed by default, so attaching costs no disk I/O
+default_store_dir = os.environ.get("HCAL_LLP_COLUMN_STORE",
+                                   "/dev/shm/hcal_llp_columns" if os.path.isdir("/dev/shm") else os.path.join(tempfile.gettempdir(), "hcal_llp_columns"))
+
+# The store lives in RAM: least recently used entries are evicted above this size
+default_max_size_gb = 8.
+
+# Bump when the compact layout changes, so old entries are never attached
+store_format_version = 2
+
+# ------------------------------------------------------------------------------
+def is_flag(name):
+    """ 0/1 branches stored as one-byte booleans: tag candidates and Pass_* selections
+    """
+    return name.endswith("TagCand") or name.startswith("Pass_")
+
+def compact(name, values):
+    """ (stored array, kind) of one column: flags -> bool, floating point -> float32, anything else as is
+
+    Flags are not bit-packed: unpacking would give every process a private copy, a bool file is mapped as is.
+    """
+    values = np.asarray(values)
+    if is_flag(name):
+        return values != 0, "bool"
+    if np.issubdtype(values.dtype, np.floating):
+        return values.astype(np.float32), "float32"
+    return values, "raw"
+
+# ------------------------------------------------------------------------------
+class CompactColumns(Mapping):
+    """ Read-only columns of one store entry
+
+    Every column is a read-only memory map of the shared files, so all processes attached to an entry use
+    the same physical pages. Pickling (e.g. to spawn workers) only sends the entry path; the receiving process
+    attaches the same files.
+    """
+
+    def __init__(self, entry):
+        self.entry = entry
+        with open(os.path.join(entry, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.n_events = self.meta["n_events"]
+        self.arrays = { name: np.load(os.path.join(entry, name+".npy"), mmap_mode="r") for name in self.meta["columns"] }
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def __iter__(self):
+        return iter(self.meta["columns"])
+
+    def __len__(self):
+        return len(self.meta["columns"])
+
+    def __reduce__(self):
+        return (CompactColumns, (self.entry,))
+
+# ------------------------------------------------------------------------------
+class ColumnStore(EntryStore):
+    """ Compact preselected columns published once into memory-mapped files, attached zero-copy by every process
+
+    Entries are keyed like the skim cache (input identity, branch list, preselection, tree name). The first
+    process to need an entry reads it with read_columns and publishes it, under a file lock so that concurrent
+    workers wait for it instead of reading the same file; all others attach. Scores, weights and decay lengths
+    are stored as float32 and flags as bool. Least-recently-attached entries are evicted once the store exceeds
+    max_size_gb (processes still attached to an evicted entry keep their mapping, its memory is freed when they exit).
+    """
+
+    label = "Column store"
+    format_version = store_format_version
+
+    def __init__(self, store_dir=default_store_dir, read_columns=load_columns, max_size_gb=default_max_size_gb):
+        super().__init__(store_dir, max_size_gb)
+        self.read_columns = read_columns
+
+    # --------------------------------------------------------------------------
+    def load_columns(self, infilepath, branches, preselection=default_preselection, treename="NoSel"):
+        """ Same as regions.load_columns, attached from the store (published first if needed)
+        """
+        key = self.key(infilepath, branches, preselection, treename)
+        if key is None:
+            print("Column store: cannot identify", infilepath, "-- not stored")
+            return self.read_columns(infilepath, branches, preselection, treename)
+
+        columns = self.attach(key)
+        if columns is not None:
+            print("Column store: attached", infilepath)
+            return columns
+
+        with open(os.path.join(self.directory, key + ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            # Published by another process while this one waited for the lock
+            columns = self.attach(key)
+            if columns is not None:
+                print("Column store: attached", infilepath)
+                return columns
+
+            print("Column store: publishing", infilepath)
+            self.publish(key, self.read_columns(infilepath, branches, preselection, treename),
+                         { "input": os.path.abspath(infilepath), "preselection": preselection, "treename": treename })
+
+        return self.attach(key)
+
+    # --------------------------------------------------------------------------
+    def attach(self, key):
+
+        entry = self.entry(key)
+        if entry is None: return None
+
+        return CompactColumns(entry)
+
+    # --------------------------------------------------------------------------
+    def write_columns(self, entry, columns, meta):
+
+        meta["columns"]  = {}
+        meta["n_events"] = 0
+        meta["nbytes_original"] = 0
+        for name, values in columns.items():
+            stored, kind = compact(name, values)
+            np.save(os.path.join(entry, name+".npy"), np.ascontiguousarray(stored))
+            meta["columns"][name]    = kind
+            meta["n_events"]         = len(values)
+            meta["nbytes_original"] += int(np.asarray(values).nbytes)
+
+# ------------------------------------------------------------------------------
+def add_column_store_args(parser):
+    """ Command-line options of the shared column store, shared by the scripts reading minituples
+    """
+    parser.add_argument("--column-store",     action="store_true", default=False, help="Publish the preselected columns once to the shared column store and attach them zero-copy")
+    parser.add_argument("--column-store-dir", action="store", default=default_store_dir, help="Directory of the column store (RAM-backed /dev/shm by default)")
+    parser.add_argument("--column-store-max-gb", action="store", type=float, default=default_max_size_gb, help="Column store size limit (least recently used entries are evicted)")
+
+# ------------------------------------------------------------------------------
+def column_reader(args):
+    """ Column reader matching the column store and skim cache options
+
+    With --column-store, entries missing from the store are read through the skim cache reader and published.
+    """
+    read_columns = skim_cache_reader(args)
+    if not args.column_store: return read_columns
+
+    return ColumnStore(args.column_store_dir, read_columns, args.column_store_max_gb).load_columns
+
+# ------------------------------------------------------------------------------
+def main():
+
+    # Usage: python3 column_store.py [--purge] [<store dir>]
+
+    purge = "--purge" in sys.argv[1:]
+    paths = [ arg for arg in sys.argv[1:] if arg != "--purge" ]
+
+    column_store = ColumnStore(paths[0] if paths else default_store_dir)
+    if purge: column_store.purge()
+
+    entries = sorted( column_store.entries() )
+    print( "Column store:", column_store.directory )
+    for last_used, size, entry in entries:
+        with open(os.path.join(entry, "meta.json")) as f:
+            meta = json.load(f)
+        print( "  {0:8.1f} MB ({1:8.1f} MB as read)  last used {2}  {3}".format(size / 1024.**2, meta["nbytes_original"] / 1024.**2,
+               time.strftime("%Y-%m-%d %H:%M", time.localtime(last_used)), meta["input"]) )
+    print( "Entries:     ", len(entries) )
+    print( "Size:         {0:.1f} MB".format( sum( size for _, size, _ in entries ) / 1024.**2 ) )
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,20 @@
-import ROOT
-import sys
-import re
-import subprocess
 import argparse
 import os 
 import json 
 
-ROOT.gROOT.SetBatch(True)
+import numpy as np
+
+from data_eras import add_data_era_args, count_eras, predict_background_partials, read_era_manifest, read_partials
+from datacards import SF_temp, background_stat_lines, datacard_replacements, render_datacard, render_workspace_datacard, signal_scale_values
+from limits import expected_percent, limit_backends, run_limit_jobs
+from limit_cache import add_limit_cache_args, limit_cache_from_args
+from skim_cache import add_skim_cache_args
+from column_store import add_column_store_args, column_reader
+from profiling import add_profile_args, profile_path, profiler
+from results_store import ResultsStore, add_results_store_args, results_db_from_args
+from signal_efficiency_table import SignalEfficiencyTable
+from lifetime_sampling import add_lifetime_sampling_args, ctau_label, interpolate_limits, lifetime_sampler_from_args
+from regions import default_data_file, default_lumi_sf, btag_categories, signal_branches, load_column_chunks, count_data_file, calculate_bkg_prediction, bootstrap_summary, signal_region_events, concatenate_columns, calculate_sig_yields
 
 cwd = os.getcwd()
 default_template_datacard = os.path.join( cwd, "templates/v1/datacard_TEMPLATE.txt" )
@@ -14,12 +22,6 @@ default_template_datacard = os.path.join( cwd, "templates/v1/datacard_TEMPLATE.t
 # Lifetimes (ctau) in in mm -- points to dynamically reweight to
 lifetimes    = ["1000"] #["10", "30", "50", "100", "200", "300", "500", "800", "1000", "2000", "3000", "5000", "10000"]
 
-# Temporary scale factor, otherwise get weird results
-SF_temp = 0.01
-
-# Use this for text scraping (expert only)
-expected_percent = [" 2.5", "16.0", "50.0", "84.0", "97.5"] 
-
 # ------------------------------------------------------------------------------
 def parseArgs():
     """ Parse command-line arguments
@@ -31,197 +33,259 @@ def parseArgs():
 
     # General
     parser.add_argument("-d", "--debug",      action="store_true", default=False, help="Debug mode")
-    parser.add_argument("-i", "--input",      action="store", help="Input signal file (ROOT Minituple)", required=True)
+    parser.add_argument("-i", "--input",      action="store", help="Input signal file (ROOT Minituple)")
     parser.add_argument("-t", "--template",   action="store", default=default_template_datacard, help="Input template datacard")
     parser.add_argument("-f", "--filetag",    action="store", help="Input file tag", required=True)
     parser.add_argument("-c", "--ctau",       action="store", help="Input file lifetime", required=True)
     parser.add_argument("-o", "--output-dir", action="store", default="output", help="Output directory")
     parser.add_argument("--incl-score",       action="store", default=0.9, help="Signal region inclusive score cut")
     parser.add_argument("--depth-score",      action="store", default=0.8, help="Signal region depth score cut")
+    parser.add_argument("--chunk-size",       action="store", type=int, default=None, help="Stream the trees in chunks of this many entries (bounded memory, bypasses the skim cache)")
+    parser.add_argument("-l", "--lifetimes",  action="store", default=None, help="Comma separated target lifetimes in mm (default: hardcoded list)")
+    parser.add_argument("--sig-table",        action="store", default=None, help="Signal yields from this signal_efficiency_table.py table instead of the signal tree")
 
-    args = parser.parse_args()
-
-    return args
+    # Limit calculation
+    parser.add_argument("-b", "--backend",    action="store", default="combine", choices=limit_backends, help="Limit backend: combine subprocess, native asymptotic CLs, or validate (both, compared)")
+    parser.add_argument("-j", "--jobs",       action="store", type=int, default=1, help="Number of combine jobs (lifetime points) to run in parallel")
+    parser.add_argument("--combine-timeout",  action="store", type=float, default=None, help="Timeout per combine job in seconds")
+    parser.add_argument("-w", "--workspace",  action="store_true", default=False, help="Build one workspace per cut configuration, lifetime points only set the signal rateParams")
 
-# ------------------------------------------------------------------------------
-def calculate_bkg_prediction(tree_data_skim, lumi_sf, incl_score_cut, depth_score_cut, additional_cut_jet0="", additional_cut_jet1=""): 
+    # Data files
+    add_data_era_args(parser)
 
-    # This is really just an approximation, should use Gillian's more robust approach eventually
+    # Caches
+    add_skim_cache_args(parser)
+    add_column_store_args(parser)
+    add_limit_cache_args(parser)
 
-    if additional_cut_jet0 != "": additional_cut_jet0 = "("+additional_cut_jet0+") && "
-    if additional_cut_jet1 != "": additional_cut_jet1 = "("+additional_cut_jet1+") && "
+    # Results store
+    add_results_store_args(parser)
 
-    nevents_bkg_ljdc_cr_temp       = tree_data_skim.GetEntries( additional_cut_jet0 + "(jet0_DepthTagCand == 1 && jet1_InclTagCand == 1 && jet1_scores_inc_train80 < 0.2)".format( incl_score_cut ) )
-    nevents_bkg_sjdc_cr_temp       = tree_data_skim.GetEntries( additional_cut_jet1 + "(jet1_DepthTagCand == 1 && jet0_InclTagCand == 1 && jet0_scores_inc_train80 < 0.2)".format( incl_score_cut ) )
-    nevents_bkg_ljdc_cr_depth_temp = tree_data_skim.GetEntries( additional_cut_jet0 + "(jet0_DepthTagCand == 1 && jet1_InclTagCand == 1 && jet0_scores_depth_LLPanywhere > {0} && jet1_scores_inc_train80 < 0.2)".format( depth_score_cut, incl_score_cut ) )
-    nevents_bkg_sjdc_cr_depth_temp = tree_data_skim.GetEntries( additional_cut_jet1 + "(jet1_DepthTagCand == 1 && jet0_InclTagCand == 1 && jet1_scores_depth_LLPanywhere > {0} && jet0_scores_inc_train80 < 0.2)".format( depth_score_cut, incl_score_cut ) )
-    nevents_bkg_ljdc_sr_temp       = tree_data_skim.GetEntries( additional_cut_jet0 + "(jet0_DepthTagCand == 1 && jet1_InclTagCand == 1 && jet1_scores_inc_train80 > {0} )".format( incl_score_cut ) )
-    nevents_bkg_sjdc_sr_temp       = tree_data_skim.GetEntries( additional_cut_jet1 + "(jet1_DepthTagCand == 1 && jet0_InclTagCand == 1 && jet0_scores_inc_train80 > {0} )".format( incl_score_cut ) )
+    # Adaptive lifetime sampling
+    add_lifetime_sampling_args(parser)
 
-    """
-    print( "nevents_bkg_ljdc_cr_temp", nevents_bkg_ljdc_cr_temp )       
-    print( "nevents_bkg_sjdc_cr_temp", nevents_bkg_sjdc_cr_temp )        
-    print( "nevents_bkg_ljdc_cr_depth_temp", nevents_bkg_ljdc_cr_depth_temp ) 
-    print( "nevents_bkg_sjdc_cr_depth_temp", nevents_bkg_sjdc_cr_depth_temp ) 
-    print( "nevents_bkg_ljdc_sr_temp", nevents_bkg_ljdc_sr_temp ) 
-    print( "nevents_bkg_sjdc_sr_temp",nevents_bkg_sjdc_sr_temp  ) 
-    """
+    # Instrumentation
+    add_profile_args(parser)
 
-    nevents_bkg_ljdc_srpred = lumi_sf * nevents_bkg_ljdc_sr_temp * (nevents_bkg_ljdc_cr_depth_temp / nevents_bkg_ljdc_cr_temp)
-    nevents_bkg_sjdc_srpred = lumi_sf * nevents_bkg_sjdc_sr_temp * (nevents_bkg_sjdc_cr_depth_temp / nevents_bkg_sjdc_cr_temp)
+    args = parser.parse_args()
 
-    print( "nevents_bkg_ljdc_srpred",nevents_bkg_ljdc_srpred  ) 
-    print( "nevents_bkg_sjdc_srpred",nevents_bkg_sjdc_srpred  ) 
+    if args.input is None and args.sig_table is None:
+        parser.error("give the signal as --input or --sig-table")
 
-    return nevents_bkg_ljdc_srpred, nevents_bkg_sjdc_srpred
+    return args
 
 # ------------------------------------------------------------------------------
-def main():
+def predict_background(read_columns, incl_score_cut, depth_score_cut, lumi_sf=default_lumi_sf, data_file=default_data_file, chunk_size=None,
+                       n_bootstrap=0, bootstrap_seed=None, bkg_stat="lnN"):
+    """ ABCD background prediction {category: (ljdc, sjdc)} for the inclusive, btag and no-btag categories
 
-    # ----- Process Inputs ----- #
+    With chunk_size, the data tree is streamed in chunks of that many entries and only the region counts are kept.
+    With n_bootstrap, the prediction also carries the bootstrap distributions under "bootstrap", and the
+    datacards get bkg_stat (lnN or gmN) nuisances for the statistical uncertainty of the prediction.
+    """
 
-    args = parseArgs()
+    # TODO: Eventually should use Gillian's background estimation
 
-    debug = args.debug
+    print("Reading in data tree...")
 
-    template_datacard = args.template
-    filetag           = args.filetag
-    infilepath        = args.input
-    ctau_sample       = args.ctau
-    incl_score_cut    = args.incl_score
-    depth_score_cut   = args.depth_score
-    output_dir        = args.output_dir
+    # currently only using a partial dataset (2023D corresponds to lumi scale factor)
+    # All regions, jet orderings and btag categories are counted in one pass over the arrays
+    if n_bootstrap:
+        counts_bkg, replica_counts_bkg = count_data_file(data_file, incl_score_cut, depth_score_cut, read_columns, chunk_size, n_bootstrap, bootstrap_seed)
+    else:
+        counts_bkg = count_data_file(data_file, incl_score_cut, depth_score_cut, read_columns, chunk_size)
 
-    unique_filetag = "{0}_{1}_{2}".format( filetag, incl_score_cut, depth_score_cut)
+    bkg_predictions = { category: calculate_bkg_prediction(counts_bkg[category], lumi_sf) for category in btag_categories }
 
-    ctaus        = []
-    limits_obs   = []
-    nevents_sig_ljdc = []
-    nevents_sig_sjdc = []
+    if n_bootstrap:
+        bkg_predictions["bootstrap"] = bootstrap_summary(counts_bkg, replica_counts_bkg, lumi_sf, bkg_stat)
 
-    limits_expected = {}
-    for val in expected_percent: limits_expected[val] = []
+    return bkg_predictions
+
+# ------------------------------------------------------------------------------
+def predict_background_from_args(args, read_columns):
+    """ Background prediction for the command-line options: merged shard partials, all data files of --data-eras
+    (map-reduce over files), or --data-file (default: the 2023D file) scaled by --lumi-sf
+    """
+    if args.bkg_partials:
+        partials = read_partials(args.bkg_partials)
+        for partial in partials:
+            if (partial["incl_score"], partial["depth_score"]) != (float(args.incl_score), float(args.depth_score)):
+                raise ValueError("partial result {0} was counted with other score cuts".format(partial["input"]))
+        return predict_background_partials(partials, args.target_lumi, args.bkg_stat)
+
+    if args.data_eras:
+        print("Counting data files...")
+        partials = count_eras(read_era_manifest(args.data_eras), args.incl_score, args.depth_score, read_columns, args.chunk_size, args.data_jobs,
+                              args.bootstrap, args.bootstrap_seed)
+        return predict_background_partials(partials, args.target_lumi, args.bkg_stat)
+
+    return predict_background(read_columns, args.incl_score, args.depth_score, args.lumi_sf, args.data_file, chunk_size=args.chunk_size,
+                              n_bootstrap=args.bootstrap, bootstrap_seed=args.bootstrap_seed, bkg_stat=args.bkg_stat)
 
-    # ----- Read in Data (Background Prediction) ----- #
+# ------------------------------------------------------------------------------
+def evaluate_lifetimes(columns_sig, ctau_targets, ctau_sample, bkg_predictions, template_datacard, unique_filetag, incl_score_cut, depth_score_cut,
+                       output_dir, backend="combine", n_jobs=1, combine_timeout=None, limit_cache=None, debug=False, workspace=False, sig_table=None):
+    """ Signal yields, datacards and limits (in datacard units) for a batch of target lifetimes (mm, as strings)
 
-    # TODO: Eventually should use Gillian's background estimation
+    With workspace, all lifetimes share one datacard (and combine workspace) whose signal rates are set by rateParams.
+    With sig_table (a SignalEfficiencyTable), the yields are looked up in the table and columns_sig is not used.
+    """
+
+    print( "Getting Event Counts...")
 
-    print("Reading in data tree... (this may take a few minutes)")
+    # Lifetime reweighting for all targets at once (events x lifetimes weight matrix)
+    with profiler.stage("signal_yields"):
+        if sig_table is not None:
+            yields_sig = sig_table.yields([float(ctau) for ctau in ctau_targets], incl_score_cut, depth_score_cut)
+        else:
+            profiler.add_events( len(columns_sig[signal_branches[0]]) * len(ctau_targets) )
+            yields_sig = calculate_sig_yields(columns_sig, ctau_sample, [float(ctau) for ctau in ctau_targets], incl_score_cut, depth_score_cut)
 
-    # if using a partial dataset, how much to scale this up by
-    lumi_sf = 6.8 # 2023D
+    points       = []
+    combine_jobs = []
 
-    # currently only using a partial dataset (2023D corresponds to lumi scale factor above)
-    infile_data = ROOT.TFile.Open("/eos/cms/store/group/phys_exotica/HCAL_LLP/MiniTuples/v4.1/minituple_LLPskim_2023D_allscores.root")
-    tree_data   = infile_data.Get("NoSel")
+    with profiler.stage("datacards"):
+        if workspace:
+            workspace_datacard = render_workspace_datacard(template_datacard, template_datacard.replace("TEMPLATE", unique_filetag + "__workspace"), bkg_predictions)
 
-    # Copy tree but only copy these branches
-    tree_data.SetBranchStatus("*", 0) 
-    tree_data.SetBranchStatus("Pass_PreSel", 1) 
-    tree_data.SetBranchStatus("jet*_DepthTagCand", 1) 
-    tree_data.SetBranchStatus("jet*_InclTagCand", 1) 
-    tree_data.SetBranchStatus("jet*_scores*", 1) 
-    tree_data.SetBranchStatus("jet*_DeepCSV*", 1)
+        for i_ctau, ctau_target in enumerate(ctau_targets):
+            print( "\nCTau Target:", ctau_target )
 
-    outfile_temp = ROOT.TFile("skim_temp_{0}.root".format(unique_filetag),"RECREATE")
-    outfile_temp.cd()
-    tree_data_skim = tree_data.CopyTree("Pass_PreSel == 1")
+            nevents_sig_ljdc_temp = yields_sig["ljdc"][i_ctau] * SF_temp * 100. # 100 to convert from minituple % --> net fraction 
+            nevents_sig_sjdc_temp = yields_sig["sjdc"][i_ctau] * SF_temp * 100. # 100 to convert from minituple % --> net fraction
 
-    # Btag score corresponds to 2023 post BPIX (TODO: Fix)
-    nevents_bkg_ljdc_srpred, nevents_bkg_sjdc_srpred               = calculate_bkg_prediction(tree_data_skim, lumi_sf, incl_score_cut, depth_score_cut) #, additional_cut_jet0="", additional_cut_jet1="")
-    nevents_bkg_ljdc_srpred_btag, nevents_bkg_sjdc_srpred_btag     = calculate_bkg_prediction(tree_data_skim, lumi_sf, incl_score_cut, depth_score_cut, "jet0_DeepCSV_prob_b > 0.2435", "jet1_DeepCSV_prob_b > 0.2435") #, additional_cut_jet0="", additional_cut_jet1="")
-    nevents_bkg_ljdc_srpred_nobtag, nevents_bkg_sjdc_srpred_nobtag = calculate_bkg_prediction(tree_data_skim, lumi_sf, incl_score_cut, depth_score_cut, "jet0_DeepCSV_prob_b < 0.2435", "jet1_DeepCSV_prob_b < 0.2435") #, additional_cut_jet0="", additional_cut_jet1="")
+            point = { "ctau": ctau_target }
+            point["nevents_sig_ljdc"] = float(nevents_sig_ljdc_temp / SF_temp)
+            point["nevents_sig_sjdc"] = float(nevents_sig_sjdc_temp / SF_temp)
+            points.append(point)
 
-    # ----- Read in Signal ----- #
+            print( "Nsig (ljdc, sjdc):", nevents_sig_ljdc_temp, nevents_sig_sjdc_temp)
 
-    print("Reading in signal tree...")
+            if workspace:
+                combine_jobs.append( (workspace_datacard, unique_filetag + "__" + ctau_target, signal_scale_values(point["nevents_sig_ljdc"], point["nevents_sig_sjdc"])) )
+                continue
 
-    infile_sig = ROOT.TFile.Open(infilepath)
-    tree_sig   = infile_sig.Get("NoSel")
+            # Replace test in template datacard
 
-    tree_sig.SetBranchStatus("*", 0) 
-    tree_sig.SetBranchStatus("Pass_PreSel", 1) 
-    tree_sig.SetBranchStatus("jet*_DepthTagCand", 1) 
-    tree_sig.SetBranchStatus("jet*_InclTagCand", 1) 
-    tree_sig.SetBranchStatus("jet*_scores*", 1) 
-    tree_sig.SetBranchStatus("weight*", 1) 
-    tree_sig.SetBranchStatus("LLP*", 1) 
+            output_file = template_datacard.replace("TEMPLATE", unique_filetag + "__" + ctau_target )
 
-    tree_sig_skim = tree_sig.CopyTree("Pass_PreSel == 1")
+            replacements = datacard_replacements(point["nevents_sig_ljdc"], point["nevents_sig_sjdc"], bkg_predictions)
+            render_datacard(template_datacard, output_file, replacements, background_stat_lines(template_datacard, replacements, bkg_predictions.get("bootstrap")))
 
-    # ----- Loop over Signal Lifetimes ----- #
+            combine_jobs.append( (output_file, unique_filetag + "__" + ctau_target) )
 
-    print( "Getting Event Counts...")
+    # ----- Run Combine ----- #
 
-    for ctau_target in lifetimes:
-        print( "\nCTau Target:", ctau_target )
+    # Each combine job runs in its own work directory with a unique name, so they can run side by side
+    with profiler.stage("limits"):
+        limit_results = run_limit_jobs(combine_jobs, os.path.join(output_dir, "combine_work"), backend=backend, n_jobs=n_jobs, timeout=combine_timeout, cache=limit_cache)
 
-        # Lifetime Reweight
+    for point, result in zip(points, limit_results):
 
-        reweight_llp0 = "pow ( {0} / {1}, 1 ) * exp( -LLP0_DecayCtau * 10. * ( 1.0/{2} - 1.0/{3} ) )".format(ctau_sample, ctau_target, ctau_target, ctau_sample)
-        reweight_llp1 = "pow ( {0} / {1}, 1 ) * exp( -LLP1_DecayCtau * 10. * ( 1.0/{2} - 1.0/{3} ) )".format(ctau_sample, ctau_target, ctau_target, ctau_sample)
-        reweight = "(weight * {0} * {1})".format(reweight_llp0, reweight_llp1)
+        point["result"]     = result
+        point["limit_obs"]  = result["limit_obs"]
+        point["limits_exp"] = result["limits_exp"]
 
-        hist_sig_ljdc = ROOT.TH1F("hist_sig_ljdc_"+ctau_target, "", 1, 0, 1)
-        hist_sig_sjdc = ROOT.TH1F("hist_sig_sjdc_"+ctau_target, "", 1, 0, 1)
+        match_all = result["returncode"] == 0 and result["limit_obs"] is not None and None not in result["limits_exp"].values()
 
-        tree_sig_skim.Draw("0.5 >> hist_sig_ljdc_"+ctau_target, " {0} * (jet0_DepthTagCand == 1 && jet1_InclTagCand == 1 && jet0_scores_depth_LLPanywhere > {1} && jet1_scores_inc_train80 > {2})".format(reweight, depth_score_cut, incl_score_cut ) )
-        tree_sig_skim.Draw("0.5 >> hist_sig_sjdc_"+ctau_target, " {0} * (jet1_DepthTagCand == 1 && jet0_InclTagCand == 1 && jet1_scores_depth_LLPanywhere > {1} && jet0_scores_inc_train80 > {2})".format(reweight, depth_score_cut, incl_score_cut ) )
+        if not match_all: 
+            print("WARNING: could not extract all limit information for:", point["ctau"], "(more info available in debug mode)" )
+            if debug: 
+                print( result["stdout"] )
+                print( result["stderr"] )
+
+    return points
+
+# ------------------------------------------------------------------------------
+def results_path(output_dir, filetag, incl_score_cut, depth_score_cut):
+    """ Results json of one signal sample and cut configuration
+    """
+    return os.path.join( output_dir, "{0}_inc{1}_depth{2}.json".format(filetag, incl_score_cut, depth_score_cut ) )
 
-        nevents_sig_ljdc_temp = hist_sig_ljdc.Integral() * SF_temp * 100. # 100 to convert from minituple % --> net fraction 
-        nevents_sig_sjdc_temp = hist_sig_sjdc.Integral() * SF_temp * 100. # 100 to convert from minituple % --> net fraction
+# ------------------------------------------------------------------------------
+def process_signal(infilepath, filetag, ctau_sample, bkg_predictions, template_datacard, incl_score_cut, depth_score_cut, output_dir,
+                   read_columns, backend="combine", n_jobs=1, combine_timeout=None, limit_cache=None, debug=False,
+                   ctau_targets=None, sampler=None, workspace=False, chunk_size=None, results_db=None, sig_table=None):
+    """ Signal yields, datacards and limits for all target lifetimes of one signal sample; returns the results json path
+
+    The target lifetimes are ctau_targets (default: lifetimes above), or chosen adaptively by an
+    AdaptiveLifetimeSampler, in which case an interpolated limit curve is added to the json.
+    With workspace, the datacard is built into a workspace once and every lifetime only sets the signal rates.
+    With chunk_size, the signal tree is streamed in chunks of that many entries.
+    With results_db, every lifetime point is also written to that results_store.ResultsStore.
+    With sig_table (path of a signal_efficiency_table.py table), the signal yields come from the table and the
+    signal tree is not read.
+    """
 
-        nevents_sig_ljdc.append( nevents_sig_ljdc_temp / SF_temp )
-        nevents_sig_sjdc.append( nevents_sig_sjdc_temp / SF_temp )
+    unique_filetag = "{0}_{1}_{2}".format( filetag, incl_score_cut, depth_score_cut)
 
-        # Replace test in template datacard
+    if ctau_targets is None: ctau_targets = lifetimes
 
-        output_file = template_datacard.replace("TEMPLATE", unique_filetag + "__" + ctau_target )
-        print( "Nsig (ljdc, sjdc):", nevents_sig_ljdc_temp, nevents_sig_sjdc_temp)
+    ctaus        = []
+    limits_obs   = []
+    nevents_sig_ljdc = []
+    nevents_sig_sjdc = []
 
-        replacements = {
-            "SIGLJDC": f"{nevents_sig_ljdc_temp:04.2f}", 
-            "SIGSJDC": f"{nevents_sig_sjdc_temp:04.2f}",
-            "BKGLJDC": f"{nevents_bkg_ljdc_srpred:04.2f}", 
-            "BKGSJDC": f"{nevents_bkg_sjdc_srpred:04.2f}",
-            "BKGLJ_B": f"{nevents_bkg_sjdc_srpred_btag:04.2f}",
-            "BKGLJ_XB": f"{nevents_bkg_sjdc_srpred_nobtag:04.2f}",
-            "BKGSJ_B": f"{nevents_bkg_sjdc_srpred_btag:04.2f}",
-            "BKGSJ_XB": f"{nevents_bkg_sjdc_srpred_nobtag:04.2f}"
-        }
+    limits_expected = {}
+    for val in expected_percent: limits_expected[val] = []
 
-        pattern = re.compile("|".join(re.escape(k) for k in replacements))
+    nevents_bkg_ljdc_srpred, nevents_bkg_sjdc_srpred = bkg_predictions["incl"]
 
-        with open(template_datacard) as fin, open(output_file, "w") as fout:
-            for line in fin:
-                fout.write(pattern.sub(lambda m: replacements[m.group(0)], line))
+    # ----- Read in Signal ----- #
 
-        output = subprocess.check_output("combine -M AsymptoticLimits {}".format(output_file), shell=True, text=True)
-        #print( output )
+    with profiler.stage("signal_read"):
+        if sig_table is not None:
+            # Precomputed yields vs lifetime: the signal tree is never opened
+            print("Reading in signal table...", sig_table)
+            sig_table   = SignalEfficiencyTable.load(sig_table)
+            columns_sig = None
+        else:
+            print("Reading in signal tree...", infilepath)
+            if chunk_size:
+                # Bounded memory: only the signal region events of every chunk are kept for the lifetime reweighting
+                columns_sig = concatenate_columns([ signal_region_events(columns_chunk, incl_score_cut, depth_score_cut)
+                                                    for columns_chunk in load_column_chunks(infilepath, signal_branches, chunk_size) ])
+            else:
+                columns_sig = read_columns(infilepath, signal_branches)
+            profiler.add_events( len(columns_sig[signal_branches[0]]) )
 
-        match_all = True 
-       
-        match = re.search(r"Observed Limit:\s*r\s*<\s*([0-9.]+)", output)
+    # ----- Loop over Signal Lifetimes ----- #
 
-        if match:
-            ctaus.append( float(ctau_target) )
-            limits_obs.append( float(match.group(1)) * SF_temp )
+    evaluate = lambda ctaus_batch: evaluate_lifetimes(columns_sig, ctaus_batch, ctau_sample, bkg_predictions, template_datacard, unique_filetag,
+                                                      incl_score_cut, depth_score_cut, output_dir, backend, n_jobs, combine_timeout, limit_cache, debug, workspace,
+                                                      sig_table)
+
+    if sampler is None:
+        points = evaluate(ctau_targets)
+    else:
+        # Rounds of new lifetimes where the expected limit curve bends or crosses a threshold
+        points = []
+        while True:
+            ctaus_batch = sampler.propose()
+            if len(ctaus_batch) == 0: break
+            print( "\nAdaptive lifetime sampling, next points:", ctaus_batch )
+            points_batch = evaluate([ ctau_label(ctau) for ctau in ctaus_batch ])
+            sampler.add( ctaus_batch, [ point["limits_exp"]["50.0"] * SF_temp if point["limits_exp"]["50.0"] is not None else None for point in points_batch ] )
+            points += points_batch
+        points.sort(key=lambda point: float(point["ctau"]))
+
+    for point in points:
+
+        nevents_sig_ljdc.append( point["nevents_sig_ljdc"] )
+        nevents_sig_sjdc.append( point["nevents_sig_sjdc"] )
+
+        if point["limit_obs"] is not None:
+            ctaus.append( float(point["ctau"]) )
+            limits_obs.append( point["limit_obs"] * SF_temp )
         else:
             limits_obs.append( -1 )
-            match_all = False
 
         for val in expected_percent: 
-            pattern = rf"Expected {val}%:\s*r\s*<\s*([0-9.]+)"
-            match = re.search(pattern, output)
-            if match:
-                limits_expected[val].append( float( match.group(1) ) * SF_temp )
+            if point["limits_exp"][val] is not None:
+                limits_expected[val].append( point["limits_exp"][val] * SF_temp )
             else:
                 limits_expected[val].append( -1 )
-                match_all = False
-
-        if not match_all: 
-            print("WARNING: could not extract all limit information for:", ctau_target, "(more info available in debug mode)" )
-            if debug: print( output )
 
     data = {}
     data["ctaus"] = ctaus
@@ -232,10 +296,31 @@ def main():
     data["nevents_bkg_ljdc"] = nevents_bkg_ljdc_srpred
     data["nevents_bkg_sjdc"] = nevents_bkg_sjdc_srpred
 
+    if "bootstrap" in bkg_predictions:
+        data["bkg_bootstrap"] = bkg_predictions["bootstrap"]
+
+    if backend == "validate":
+        data["backend_validation"] = { point["ctau"]: point["result"]["validation"] for point in points }
+
+    # A curve needs at least two valid points (all failed: no interp block)
+    limits_median = np.asarray(limits_expected["50.0"], dtype=np.float64)
+    n_valid = int( np.count_nonzero( np.isfinite(limits_median) & (limits_median > 0) ) )
+
+    if sampler is not None and n_valid >= 2:
+        # Smooth curve for plotting, on a dense grid over the sampled range
+        ctaus_sampled = [ float(point["ctau"]) for point in points ]
+        ctaus_dense   = np.logspace( np.log10(min(ctaus_sampled)), np.log10(max(ctaus_sampled)), 200 )
+        data["interp"] = { "ctaus": ctaus_dense.tolist(), "limits_exp": {}, "limits_exp_err": {} }
+        for val in expected_percent:
+            limits_dense, errors_dense = interpolate_limits(ctaus_sampled, limits_expected[val], ctaus_dense)
+            # Outside the range of the valid points the curve is NaN, written as null (NaN is not valid json)
+            data["interp"]["limits_exp"][val]     = [ limit if np.isfinite(limit) else None for limit in limits_dense.tolist() ]
+            data["interp"]["limits_exp_err"][val] = [ error if np.isfinite(error) else None for error in errors_dense.tolist() ]
+
     if not os.path.exists(output_dir): 
         os.makedirs(output_dir)
 
-    outfile_path = os.path.join( output_dir, "{0}_inc{1}_depth{2}.json".format(filetag, incl_score_cut, depth_score_cut ) )
+    outfile_path = results_path(output_dir, filetag, incl_score_cut, depth_score_cut)
 
     with open(outfile_path, "w") as f:
         json.dump(data, f, indent=2)
@@ -248,5 +333,59 @@ def main():
     print( "--------------------------------------" )
     print( "Json file written to:", outfile_path )
 
+    if results_db:
+        store = ResultsStore(results_db)
+        n_rows = store.put_points(points, filetag, ctau_sample, incl_score_cut, depth_score_cut, template_datacard, bkg_predictions, SF_temp, backend, outfile_path)
+        store.close()
+        print( "Results store:", results_db, "({0} rows)".format(n_rows) )
+
+    return outfile_path
+
+# ------------------------------------------------------------------------------
+def main():
+
+    # ROOT only here: importers of this module (batch and era workers, campaign.py) do not need its startup
+    import ROOT
+    ROOT.gROOT.SetBatch(True)
+
+    # ----- Process Inputs ----- #
+
+    args = parseArgs()
+
+    # Per-stage timers and resources, written next to the results json
+    if args.profile:
+        outfile_path = results_path(args.output_dir, args.filetag, args.incl_score, args.depth_score)
+        profiler.enable(args.profile_hook, profile_path(outfile_path)[:-len(".json")])
+
+    # ----- Caches ----- #
+
+    # Preselected columns are cached on disk, keyed by the input files, branches and preselection
+    # (and with --column-store, shared in memory between processes)
+    read_columns = column_reader(args)
+
+    # Limits are cached on disk, keyed by the rendered datacard
+    limit_cache = limit_cache_from_args(args)
+
+    # ----- Background Prediction ----- #
+
+    with profiler.stage("bkg_prediction"):
+        bkg_predictions = predict_background_from_args(args, read_columns)
+
+    # ----- Target Lifetimes ----- #
+
+    ctau_targets = args.lifetimes.split(",") if args.lifetimes else lifetimes
+    sampler = lifetime_sampler_from_args(args)
+
+    # ----- Signal and Limits ----- #
+
+    outfile_path = process_signal(args.input, args.filetag, args.ctau, bkg_predictions, args.template, args.incl_score, args.depth_score, args.output_dir,
+                   read_columns, backend=args.backend, n_jobs=args.jobs, combine_timeout=args.combine_timeout, limit_cache=limit_cache, debug=args.debug,
+                   ctau_targets=ctau_targets, sampler=sampler, workspace=args.workspace, chunk_size=args.chunk_size,
+                   results_db=results_db_from_args(args), sig_table=args.sig_table)
+
+    if args.profile:
+        profiler.print_report()
+        profiler.write( profile_path(outfile_path) )
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,207 @@
+import argparse
+import os
+import glob
+import json
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from regions import default_data_file, default_lumi_sf, btag_categories, btag_wp, load_columns, count_data_file, add_region_counts, calculate_bkg_prediction, bootstrap_summary
+
+# ------------------------------------------------------------------------------
+def read_era_manifest(path):
+    """ Data files [{"input", "lumi", "era"}] from a json list or text lines '<input> <lumi> [<era>]' (lumi in fb^-1)
+    """
+    if path.endswith(".json"):
+        with open(path) as f:
+            eras = json.load(f)
+        return [ { "input": era["input"], "lumi": float(era["lumi"]), "era": era.get("era", os.path.basename(era["input"])) } for era in eras ]
+
+    eras = []
+    with open(path) as f:
+        for line in f:
+            words = line.split("#")[0].split()
+            if len(words) == 0: continue
+            eras.append( { "input": words[0], "lumi": float(words[1]), "era": words[2] if len(words) > 2 else os.path.basename(words[0]) } )
+    return eras
+
+# ------------------------------------------------------------------------------
+def count_era(era, incl_score_cut, depth_score_cut, read_columns=load_columns, chunk_size=None, n_replicas=0, seed=None):
+    """ Map step: region counts of one data file, as a partial result {"input", "era", "lumi", cuts, "counts"}
+
+    With n_replicas, the partial result also holds the bootstrap replica counts under "bootstrap".
+    """
+    start = time.time()
+    print("Counting data file...", era["input"])
+
+    partial = { "input": era["input"], "era": era["era"], "lumi": era["lumi"],
+                "incl_score": float(incl_score_cut), "depth_score": float(depth_score_cut), "btag_cut": btag_wp }
+
+    if n_replicas:
+        partial["counts"], replica_counts = count_data_file(era["input"], incl_score_cut, depth_score_cut, read_columns, chunk_size, n_replicas, seed)
+        partial["bootstrap"] = { category: { key: values.tolist() for key, values in replica_counts[category].items() } for category in replica_counts }
+    else:
+        partial["counts"] = count_data_file(era["input"], incl_score_cut, depth_score_cut, read_columns, chunk_size)
+
+    partial["elapsed"] = time.time() - start
+
+    return partial
+
+# ------------------------------------------------------------------------------
+def count_eras(eras, incl_score_cut, depth_score_cut, read_columns=load_columns, chunk_size=None, n_workers=1, n_replicas=0, seed=None):
+    """ Partial results of all data files, n_workers files at a time (one process per file)
+
+    Every file gets its own bootstrap random stream, derived from seed and its position in eras.
+    """
+    era_args = [ (era, incl_score_cut, depth_score_cut, read_columns, chunk_size, n_replicas, None if seed is None else [seed, i_era])
+                 for i_era, era in enumerate(eras) ]
+
+    if n_workers <= 1:
+        return [ count_era(*args) for args in era_args ]
+
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [ pool.submit(count_era, *args) for args in era_args ]
+        return [ future.result() for future in futures ]
+
+# ------------------------------------------------------------------------------
+def write_partial(partial, path):
+
+    if os.path.dirname(path): os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(partial, f, indent=2)
+
+    return path
+
+def read_partials(pattern):
+    """ Partial results from a comma separated list of json files or globs
+    """
+    paths = []
+    for item in pattern.split(","):
+        paths += sorted( glob.glob(item) ) or [item]
+
+    partials = []
+    for path in paths:
+        with open(path) as f:
+            partials.append( json.load(f) )
+    return partials
+
+# ------------------------------------------------------------------------------
+def merge_partials(partials):
+    """ Reduce step: summed region counts, total luminosity and summed bootstrap replica counts (None unless all
+    partials have them) of the partial results
+
+    The counts are integers, so the merge is exact. All partials must use the same cuts, the same number of
+    bootstrap replicas and distinct inputs.
+    The bootstrap weights of different files are independent, so the replica counts add up as well.
+    """
+    cuts = set( (partial["incl_score"], partial["depth_score"], partial["btag_cut"]) for partial in partials )
+    if len(cuts) != 1:
+        raise ValueError("partial results with different cuts (incl, depth, btag): " + str(sorted(cuts)))
+
+    inputs = [ partial["input"] for partial in partials ]
+    duplicates = sorted( set( infilepath for infilepath in inputs if inputs.count(infilepath) > 1 ) )
+    if duplicates:
+        raise ValueError("data files counted more than once: " + ", ".join(duplicates))
+
+    counts = None
+    for partial in partials:
+        counts = add_region_counts(counts, partial["counts"])
+
+    replica_counts = None
+    if all( "bootstrap" in partial for partial in partials ):
+        # Replicas are summed index by index, so every partial needs the same number of them
+        n_replicas = set( len( next(iter( partial["bootstrap"]["incl"].values() )) ) for partial in partials )
+        if len(n_replicas) != 1:
+            raise ValueError("partial results with different numbers of bootstrap replicas: " + str(sorted(n_replicas)))
+
+        for partial in partials:
+            replica_counts = add_region_counts(replica_counts, { category: { key: np.asarray(values) for key, values in partial["bootstrap"][category].items() }
+                                                                 for category in partial["bootstrap"] })
+
+    return counts, sum( partial["lumi"] for partial in partials ), replica_counts
+
+# ------------------------------------------------------------------------------
+def predict_background_partials(partials, target_lumi=None, bkg_stat="lnN"):
+    """ ABCD background prediction {category: (ljdc, sjdc)} from the merged partial results
+
+    The prediction is for the summed luminosity of the data files, or scaled to target_lumi if given.
+    With bootstrap replica counts in the partials, it carries the bootstrap distributions as predict_background.
+    """
+    counts, lumi, replica_counts = merge_partials(partials)
+
+    print( "Data files:", len(partials), "luminosity: {0:.2f} fb^-1".format(lumi) )
+    for partial in partials:
+        print( "  {0:20s} {1:8.2f} fb^-1  {2}".format(partial["era"], partial["lumi"], partial["input"]) )
+
+    lumi_sf = target_lumi / lumi if target_lumi else 1.
+
+    bkg_predictions = { category: calculate_bkg_prediction(counts[category], lumi_sf) for category in btag_categories }
+
+    if replica_counts is not None:
+        bkg_predictions["bootstrap"] = bootstrap_summary(counts, replica_counts, lumi_sf, bkg_stat)
+
+    return bkg_predictions
+
+# ------------------------------------------------------------------------------
+def add_data_era_args(parser):
+    """ Command-line options of the background prediction (multiple data files, bootstrap), shared by the scripts predicting the background
+    """
+    parser.add_argument("--data-file",    action="store", default=default_data_file, help="Data minituple of the single-file prediction")
+    parser.add_argument("--lumi-sf",      action="store", type=float, default=default_lumi_sf, help="Luminosity scale factor of the single-file prediction")
+    parser.add_argument("--data-eras",    action="store", default=None, help="Manifest of data files with luminosities (json list of {input, lumi, era}, or text lines '<input> <lumi> [<era>]')")
+    parser.add_argument("--data-jobs",    action="store", type=int, default=1, help="Number of data files to count in parallel")
+    parser.add_argument("--bkg-partials", action="store", default=None, help="Merge partial count files written by 'data_eras.py count' (comma separated files or globs) instead of reading data")
+    parser.add_argument("--target-lumi",  action="store", type=float, default=None, help="Scale the multi-file prediction to this luminosity in fb^-1 (default: the summed luminosity)")
+    parser.add_argument("--bootstrap",    action="store", type=int, default=0, help="Number of bootstrap replicas for the statistical uncertainty of the background prediction")
+    parser.add_argument("--bootstrap-seed", action="store", type=int, default=None, help="Random seed of the bootstrap")
+    parser.add_argument("--bkg-stat",     action="store", default="lnN", choices=["lnN", "gmN"], help="Datacard form of the background statistical uncertainty (with --bootstrap)")
+
+# ------------------------------------------------------------------------------
+def main():
+
+    # Shard jobs: one 'count' job per data file, then one 'merge'
+
+    parser = argparse.ArgumentParser(
+        add_help=True,
+        description='Partial region counts of data files (map) and their merge into the background prediction (reduce)'
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_count = subparsers.add_parser("count", help="Count the regions of one data file and write a partial result")
+    parser_count.add_argument("-i", "--input",  action="store", required=True, help="Input data file (ROOT Minituple)")
+    parser_count.add_argument("--lumi",         action="store", type=float, required=True, help="Luminosity of the data file in fb^-1")
+    parser_count.add_argument("--era",          action="store", default=None, help="Era label")
+    parser_count.add_argument("-o", "--output", action="store", required=True, help="Output partial result (json)")
+    parser_count.add_argument("--incl-score",   action="store", default=0.9, help="Signal region inclusive score cut")
+    parser_count.add_argument("--depth-score",  action="store", default=0.8, help="Signal region depth score cut")
+    parser_count.add_argument("--chunk-size",   action="store", type=int, default=None, help="Stream the tree in chunks of this many entries")
+    parser_count.add_argument("--bootstrap",    action="store", type=int, default=0, help="Number of bootstrap replicas (same in every shard)")
+    parser_count.add_argument("--bootstrap-seed", action="store", type=int, default=None, help="Random seed of the bootstrap (must differ between shards)")
+
+    parser_merge = subparsers.add_parser("merge", help="Merge partial results into the background prediction")
+    parser_merge.add_argument("partials",       action="store", help="Partial results (comma separated files or globs)")
+    parser_merge.add_argument("-o", "--output", action="store", default=None, help="Output json with the merged counts and prediction")
+    parser_merge.add_argument("--target-lumi",  action="store", type=float, default=None, help="Scale the prediction to this luminosity in fb^-1")
+    parser_merge.add_argument("--bkg-stat",     action="store", default="lnN", choices=["lnN", "gmN"], help="Datacard form of the background statistical uncertainty")
+
+    args = parser.parse_args()
+
+    if args.command == "count":
+        era = { "input": args.input, "lumi": args.lumi, "era": args.era or os.path.basename(args.input) }
+        partial = count_era(era, args.incl_score, args.depth_score, chunk_size=args.chunk_size, n_replicas=args.bootstrap, seed=args.bootstrap_seed)
+        print( "Partial result written to:", write_partial(partial, args.output) )
+        return
+
+    partials = read_partials(args.partials)
+    bkg_predictions = predict_background_partials(partials, args.target_lumi, args.bkg_stat)
+
+    if args.output:
+        counts, lumi, _ = merge_partials(partials)
+        write_partial({ "inputs": [ partial["input"] for partial in partials ], "lumi": lumi, "target_lumi": args.target_lumi,
+                        "counts": counts, "predictions": bkg_predictions }, args.output)
+        print( "Merged result written to:", args.output )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+import re
+
+# Temporary scale factor, otherwise get weird results
+SF_temp = 0.01
+
+# Background placeholders -> (btag category, jet ordering) of the prediction they take
+# (the LJDC btag / no-btag columns take the SJDC predictions)
+background_placeholders = {
+    "BKGLJDC":  ("incl", "ljdc"),
+    "BKGSJDC":  ("incl", "sjdc"),
+    "BKGLJ_B":  ("btag", "sjdc"),
+    "BKGLJ_XB": ("nobtag", "sjdc"),
+    "BKGSJ_B":  ("btag", "sjdc"),
+    "BKGSJ_XB": ("nobtag", "sjdc"),
+}
+
+# Order of the jet orderings in the (ljdc, sjdc) prediction tuples
+orderings = ["ljdc", "sjdc"]
+
+# ------------------------------------------------------------------------------
+def datacard_replacements(nevents_sig_ljdc, nevents_sig_sjdc, bkg_predictions):
+    """ Template placeholders -> rates, with the signal in datacard units (nevents * SF_temp)
+
+    bkg_predictions: {category: (nevents_bkg_ljdc_srpred, nevents_bkg_sjdc_srpred)} for "incl", "btag", "nobtag"
+    """
+    nevents_sig_ljdc_temp = nevents_sig_ljdc * SF_temp
+    nevents_sig_sjdc_temp = nevents_sig_sjdc * SF_temp
+
+    replacements = {
+        "SIGLJDC": f"{nevents_sig_ljdc_temp:04.2f}",
+        "SIGSJDC": f"{nevents_sig_sjdc_temp:04.2f}",
+    }
+
+    for placeholder, (category, ordering) in background_placeholders.items():
+        replacements[placeholder] = f"{bkg_predictions[category][orderings.index(ordering)]:04.2f}"
+
+    return replacements
+
+# ------------------------------------------------------------------------------
+def background_stat_lines(template_datacard, replacements, bkg_bootstrap):
+    """ Datacard nuisance lines for the statistical uncertainty of the background predictions (none without bootstrap)
+
+    One nuisance per prediction, on every column taking that prediction:
+      lnN: bkgstat_<ordering>_<category> with kappa = 1 + bootstrap std / prediction
+      gmN: bkgstat_<ordering>_<category> gmN <SR count> <transfer factor>, plus the bootstrap transfer factor
+           uncertainty as bkgtf_<ordering>_<category> lnN
+    """
+    if not bkg_bootstrap: return []
+
+    with open(template_datacard) as f:
+        lines = f.read().splitlines()
+    rates = [ line.split()[1:] for line in lines if line.split()[:1] == ["rate"] ][0]
+
+    # prediction -> columns using it
+    columns = {}
+    for i_column, placeholder in enumerate(rates):
+        if placeholder in background_placeholders:
+            columns.setdefault(background_placeholders[placeholder], []).append(i_column)
+
+    def nuisance_line(name, kind, values):
+        return "{0} {1} ".format(name, kind) + " ".join( values.get(i_column, "-") for i_column in range(len(rates)) )
+
+    stat_lines = []
+    for (category, ordering), i_columns in columns.items():
+        summary = bkg_bootstrap["predictions"][category][ordering]
+        name = "{0}_{1}".format(ordering, category)
+
+        if bkg_bootstrap["bkg_stat"] == "gmN":
+            # rate = N * alpha exactly for the rounded rate of the datacard
+            sr_count = summary["sr_count"]
+            alpha = { i_column: float(replacements[rates[i_column]]) / sr_count if sr_count > 0 else summary["tf"] for i_column in i_columns }
+            stat_lines.append( "bkgstat_{0} gmN {1} ".format(name, sr_count) + " ".join( "{0:.6g}".format(alpha[i_column]) if i_column in alpha else "-"
+                                                                                      for i_column in range(len(rates)) ) )
+            if summary["tf"] > 0:
+                stat_lines.append( nuisance_line("bkgtf_" + name, "lnN", { i_column: "{0:.4f}".format(1. + summary["tf_std"] / summary["tf"]) for i_column in i_columns }) )
+        elif summary["nominal"] > 0:
+            stat_lines.append( nuisance_line("bkgstat_" + name, "lnN", { i_column: "{0:.4f}".format(1. + summary["std"] / summary["nominal"]) for i_column in i_columns }) )
+
+    return stat_lines
+
+# ------------------------------------------------------------------------------
+def render_datacard(template_datacard, output_file, replacements, extra_lines=()):
+    """ Replace the placeholders of the template datacard and write the result (and extra_lines) to output_file
+    """
+    with open(template_datacard) as fin, open(output_file, "w") as fout:
+        fout.writelines( render_datacard_lines(fin, replacements) )
+        for line in extra_lines: fout.write(line + "\n")
+
+    return output_file
+
+# ------------------------------------------------------------------------------
+def render_datacard_lines(lines, replacements):
+    pattern = re.compile("|".join(re.escape(k) for k in replacements))
+    return [ pattern.sub(lambda m: replacements[m.group(0)], line) for line in lines ]
+
+# ------------------------------------------------------------------------------
+# Signal rate placeholders -> rateParam scaling that signal column in the workspace datacard
+signal_scale_params = { "SIGLJDC": "scale_LJDC", "SIGSJDC": "scale_SJDC" }
+
+# rateParam range, wide enough for any signal yield in datacard units (frozen values are clamped to it)
+scale_param_max = 1.0e6
+
+# ------------------------------------------------------------------------------
+def signal_scale_values(nevents_sig_ljdc, nevents_sig_sjdc):
+    """ rateParam values reproducing the signal rates of datacard_replacements (same rounding)
+    """
+    replacements = datacard_replacements(nevents_sig_ljdc, nevents_sig_sjdc, { category: (0., 0.) for category in ["incl", "btag", "nobtag"] })
+    return { param: float(replacements[placeholder]) for placeholder, param in signal_scale_params.items() }
+
+# ------------------------------------------------------------------------------
+def render_workspace_datacard(template_datacard, output_file, bkg_predictions):
+    """ Datacard for one cut configuration with unit signal rates, each scaled by a rateParam (see signal_scale_params)
+
+    Built into a workspace once, every lifetime point then only sets the rateParams.
+    """
+    replacements = datacard_replacements(0., 0., bkg_predictions)
+    for placeholder in signal_scale_params: replacements[placeholder] = "1.00"
+
+    with open(template_datacard) as f:
+        lines = f.read().splitlines()
+
+    # (bin, process) of every signal placeholder, from the column-wise bin/process/rate lines
+    column_bins = [ line.split()[1:] for line in lines if line.split()[:1] == ["bin"] ][-1]
+    column_processes = [ line.split()[1:] for line in lines if line.split()[:1] == ["process"] ][0]
+    rates = [ line.split()[1:] for line in lines if line.split()[:1] == ["rate"] ][0]
+
+    with open(output_file, "w") as fout:
+        render_lines = render_datacard_lines(lines, replacements)
+        fout.write("\n".join(render_lines) + "\n")
+        for placeholder, param in signal_scale_params.items():
+            if placeholder not in rates: continue
+            i_column = rates.index(placeholder)
+            fout.write("{0} rateParam {1} {2} 1 [0,{3:.0f}]\n".format(param, column_bins[i_column], column_processes[i_column], scale_param_max))
+        for line in background_stat_lines(template_datacard, replacements, bkg_predictions.get("bootstrap")):
+            fout.write(line + "\n")
+
+    return output_file
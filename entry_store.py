@@ -0,0 +1,153 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+
+from regions import default_preselection
+
+# ------------------------------------------------------------------------------
+def file_checksum(path, blocksize=1 << 24):
+    """ sha256 of a file's content (slow for big files, only used on request)
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+# ------------------------------------------------------------------------------
+def input_identity(infilepath, checksum=False):
+    """ Identity of an input file: absolute path, size and mtime (and optionally the content checksum)
+
+    Returns None when the file cannot be stat'ed (e.g. root:// URLs), in which case it is not cached.
+    """
+    try:
+        stat = os.stat(infilepath)
+    except OSError:
+        return None
+
+    identity = {
+        "path": os.path.abspath(infilepath),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+    if checksum: identity["sha256"] = file_checksum(infilepath)
+
+    return identity
+
+# ------------------------------------------------------------------------------
+class EntryStore:
+    """ Directory of content-addressed column entries, shared by the skim cache and the column store
+
+    Each entry is a directory named by the hash of (input identity, branch list, preselection, tree name) with
+    a meta.json, published atomically. The meta.json mtime tracks the last access, entries are evicted
+    least-recently-used first once the directory exceeds max_size_gb. Subclasses write the column files
+    (write_columns) and build the columns of an entry.
+    """
+
+    label = "Entry store" # prefix of the printed messages
+    format_version = 1    # bump in a subclass when its layout changes, so old entries are never picked up
+
+    def __init__(self, directory, max_size_gb, checksum=False):
+        self.directory      = directory
+        self.max_size_bytes = int(max_size_gb * 1024**3)
+        self.checksum       = checksum
+
+        os.makedirs(self.directory, exist_ok=True)
+
+    # --------------------------------------------------------------------------
+    def key(self, infilepath, branches, preselection=default_preselection, treename="NoSel"):
+
+        identity = input_identity(infilepath, self.checksum)
+        if identity is None: return None
+
+        description = {
+            "format": self.format_version,
+            "input": identity,
+            "branches": sorted(branches),
+            "preselection": preselection,
+            "treename": treename,
+        }
+
+        return hashlib.sha256( json.dumps(description, sort_keys=True).encode() ).hexdigest()
+
+    # --------------------------------------------------------------------------
+    def entry(self, key):
+        """ Path of the complete entry of key, marked as recently used (None if there is none)
+        """
+        entry = os.path.join(self.directory, key)
+        meta  = os.path.join(entry, "meta.json")
+        if not os.path.exists(meta): return None
+
+        os.utime(meta) # mark as recently used
+
+        return entry
+
+    # --------------------------------------------------------------------------
+    def write_columns(self, entry, columns, meta):
+        """ Write the column files of a new entry into the directory entry, adding their description to meta
+        """
+        raise NotImplementedError
+
+    # --------------------------------------------------------------------------
+    def publish(self, key, columns, meta):
+
+        entry = os.path.join(self.directory, key)
+        entry_temp = entry + ".tmp{0}".format(os.getpid())
+
+        os.makedirs(entry_temp, exist_ok=True)
+        meta = dict(meta)
+        self.write_columns(entry_temp, columns, meta)
+
+        meta["created"] = time.time()
+        with open(os.path.join(entry_temp, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+
+        # Rename is atomic, a concurrent writer of the same entry simply loses
+        try:
+            os.rename(entry_temp, entry)
+        except OSError:
+            shutil.rmtree(entry_temp, ignore_errors=True)
+
+        self.evict()
+
+    # --------------------------------------------------------------------------
+    def entries(self):
+        """ (last access time, size in bytes, path) of every complete entry
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            entry = os.path.join(self.directory, name)
+            meta  = os.path.join(entry, "meta.json")
+            if not os.path.exists(meta): continue
+            size = sum( os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry) )
+            entries.append( (os.path.getmtime(meta), size, entry) )
+        return entries
+
+    # --------------------------------------------------------------------------
+    def evict(self):
+        """ Drop least-recently-used entries until the directory fits in its size budget
+        """
+        entries = sorted(self.entries())
+        total = sum( size for _, size, _ in entries )
+
+        # Never evict the most recent entry, even if it alone exceeds the budget
+        while total > self.max_size_bytes and len(entries) > 1:
+            _, size, entry = entries.pop(0)
+            print(self.label + ": evicting", entry)
+            shutil.rmtree(entry, ignore_errors=True)
+            try:
+                os.remove(entry + ".lock")
+            except OSError:
+                pass
+            total -= size
+
+    # --------------------------------------------------------------------------
+    def purge(self):
+
+        print(self.label + ": purging", self.directory)
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if os.path.isdir(path): shutil.rmtree(path, ignore_errors=True)
+            else: os.remove(path)
@@ -0,0 +1,131 @@
+import numpy as np
+from scipy.interpolate import PchipInterpolator
+
+# ------------------------------------------------------------------------------
+def log_grid(ctau_min, ctau_max, n_points):
+    """ n_points log-spaced lifetimes between ctau_min and ctau_max (mm), rounded to 3 significant digits
+    """
+    return [ float("{0:.3g}".format(ctau)) for ctau in np.logspace(np.log10(ctau_min), np.log10(ctau_max), n_points) ]
+
+# ------------------------------------------------------------------------------
+def ctau_label(ctau):
+    """ Lifetime as used in file names and json keys: "1000" for 1000.0, "31.6" for 31.6
+    """
+    return "{0:g}".format(ctau)
+
+# ------------------------------------------------------------------------------
+class AdaptiveLifetimeSampler:
+    """ Adaptive choice of the target lifetimes for a limit curve
+
+    Starts from a coarse log-spaced grid, then repeatedly adds the log-midpoint of every interval where
+      - the curve bends: the monotone cubic (PCHIP) and the straight line through the neighbouring points,
+        both in log(ctau)-log(limit), differ by more than `tolerance` (in log10 of the limit), or
+      - the curve crosses one of the `thresholds` (e.g. BR = 1),
+    until no interval needs refinement, intervals reach `min_spacing` (log10 ctau) or `max_points` is reached.
+    """
+
+    def __init__(self, ctau_min=10., ctau_max=10000., n_initial=5, tolerance=0.05, thresholds=(), max_points=30, min_spacing=0.02):
+        self.ctau_min    = ctau_min
+        self.ctau_max    = ctau_max
+        self.n_initial   = n_initial
+        self.tolerance   = tolerance
+        self.thresholds  = list(thresholds)
+        self.max_points  = max_points
+        self.min_spacing = min_spacing
+
+        self.limits = {} # ctau -> limit (None where no limit could be computed)
+
+    # --------------------------------------------------------------------------
+    def add(self, ctaus, limits):
+        for ctau, limit in zip(ctaus, limits):
+            self.limits[float(ctau)] = limit if limit is not None and limit > 0 and np.isfinite(limit) else None
+
+    def valid_points(self):
+        ctaus = sorted( ctau for ctau, limit in self.limits.items() if limit is not None )
+        return np.log10(ctaus), np.log10( [self.limits[ctau] for ctau in ctaus] )
+
+    # --------------------------------------------------------------------------
+    def interval_errors(self):
+        """ Estimated error (log10 of the limit) of linear interpolation at the middle of every interval between valid points
+        """
+        x, y = self.valid_points()
+        if len(x) < 3: return x, np.full(max(len(x) - 1, 0), np.inf)
+
+        middle = 0.5 * (x[1:] + x[:-1])
+        return x, np.abs( PchipInterpolator(x, y)(middle) - np.interp(middle, x, y) )
+
+    # --------------------------------------------------------------------------
+    def propose(self):
+        """ Next lifetimes to evaluate (empty when the curve is converged)
+        """
+        if len(self.limits) == 0:
+            return log_grid(self.ctau_min, self.ctau_max, self.n_initial)
+
+        budget = self.max_points - len(self.limits)
+        if budget <= 0: return []
+
+        x, errors = self.interval_errors()
+        _, y = self.valid_points()
+
+        candidates = []
+        for i in range(len(x) - 1):
+            if x[i+1] - x[i] < 2. * self.min_spacing: continue
+
+            bends = errors[i] > self.tolerance
+            crosses = any( (y[i] - np.log10(threshold)) * (y[i+1] - np.log10(threshold)) < 0 for threshold in self.thresholds )
+
+            if bends or crosses:
+                candidates.append( (errors[i] if np.isfinite(errors[i]) else 1e9, 10**(0.5 * (x[i] + x[i+1]))) )
+
+        # Largest estimated errors first when the budget does not allow all of them
+        candidates.sort(reverse=True)
+        proposed = [ float("{0:.4g}".format(ctau)) for _, ctau in candidates[:budget] ]
+
+        return [ ctau for ctau in proposed if ctau not in self.limits ]
+
+# ------------------------------------------------------------------------------
+def interpolate_limits(ctaus, limits, ctaus_dense):
+    """ Smooth limit curve through the sampled points, with an interpolation error estimate
+
+    PCHIP interpolation in log(ctau)-log(limit). The error is the difference to the piecewise-linear log-log
+    interpolation, as a relative error on the limit (zero at the sampled points).
+    Returns (limits_dense, relative_errors_dense); points without a valid limit are ignored.
+    """
+    ctaus  = np.asarray(ctaus, dtype=np.float64)
+    limits = np.asarray(limits, dtype=np.float64)
+
+    valid = (limits > 0) & np.isfinite(limits)
+    order = np.argsort(ctaus[valid])
+    x = np.log10(ctaus[valid][order])
+    y = np.log10(limits[valid][order])
+
+    x_dense = np.log10(np.asarray(ctaus_dense, dtype=np.float64))
+    if len(x) < 2:
+        return np.full(len(x_dense), np.nan), np.full(len(x_dense), np.nan)
+
+    y_smooth = PchipInterpolator(x, y, extrapolate=False)(x_dense) if len(x) >= 3 else np.interp(x_dense, x, y, left=np.nan, right=np.nan)
+    y_linear = np.interp(x_dense, x, y, left=np.nan, right=np.nan)
+
+    return 10**y_smooth, np.abs(10**(y_smooth - y_linear) - 1.)
+
+# ------------------------------------------------------------------------------
+def add_lifetime_sampling_args(parser):
+    """ Command-line options of the adaptive lifetime sampling, shared by the scripts computing limit curves
+    """
+    parser.add_argument("--adaptive-lifetimes",  action="store_true", default=False, help="Choose the target lifetimes adaptively instead of a fixed list")
+    parser.add_argument("--ctau-range",          action="store", default="10:10000", help="Adaptive sampling lifetime range in mm, 'min:max'")
+    parser.add_argument("--adaptive-initial",    action="store", type=int, default=5, help="Number of points of the initial log-spaced grid")
+    parser.add_argument("--adaptive-tolerance",  action="store", type=float, default=0.05, help="Refine intervals where the interpolation error exceeds this (log10 of the limit)")
+    parser.add_argument("--adaptive-max-points", action="store", type=int, default=30, help="Maximum number of lifetime points per sample")
+    parser.add_argument("--limit-thresholds",    action="store", default="1.0", help="Comma separated limit values (BR) whose crossing is refined")
+
+# ------------------------------------------------------------------------------
+def lifetime_sampler_from_args(args):
+    """ New AdaptiveLifetimeSampler matching the options (one per signal sample), or None for a fixed list of lifetimes
+    """
+    if not args.adaptive_lifetimes: return None
+
+    ctau_min, ctau_max = [ float(ctau) for ctau in args.ctau_range.split(":") ]
+    thresholds = [ float(val) for val in args.limit_thresholds.split(",") ] if args.limit_thresholds else []
+
+    return AdaptiveLifetimeSampler(ctau_min, ctau_max, args.adaptive_initial, args.adaptive_tolerance, thresholds, args.adaptive_max_points)
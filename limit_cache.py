@@ -0,0 +1,132 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+
+import asymptotic_cls
+
+default_cache_dir = os.environ.get("HCAL_LLP_LIMIT_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "hcal_llp_limits"))
+
+# ------------------------------------------------------------------------------
+def combine_version():
+    """ Identity of the combine installation: CMSSW release, binary path and binary mtime
+    """
+    path = shutil.which("combine")
+    mtime = os.path.getmtime(path) if path else None
+    return "combine:{0}:{1}:{2}".format(os.environ.get("CMSSW_VERSION", ""), path, mtime)
+
+# ------------------------------------------------------------------------------
+def backend_version(backend):
+    if backend == "native": return "native:" + asymptotic_cls.version
+    return combine_version()
+
+# ------------------------------------------------------------------------------
+class LimitCache:
+    """ Persistent cache of limits keyed by the rendered datacard text
+
+    The key hashes the datacard text, the backend, the method and options and the backend version, so byte-identical
+    cards (e.g. ctau points whose rates round to the same values) only run once. One json file per entry.
+    """
+
+    def __init__(self, cache_dir=default_cache_dir):
+        self.cache_dir = cache_dir
+        self.hits   = 0
+        self.misses = 0
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    # --------------------------------------------------------------------------
+    def key(self, datacard_text, backend, method="AsymptoticLimits", options=None):
+
+        description = {
+            "datacard": datacard_text,
+            "backend": backend,
+            "method": method,
+            "options": list(options or []),
+            "version": backend_version(backend),
+        }
+
+        return hashlib.sha256( json.dumps(description, sort_keys=True).encode() ).hexdigest()
+
+    # --------------------------------------------------------------------------
+    def get(self, key):
+
+        path = os.path.join(self.cache_dir, key + ".json")
+        if not os.path.exists(path):
+            self.misses += 1
+            return None
+
+        with open(path) as f:
+            entry = json.load(f)
+        self.hits += 1
+
+        return entry["limit_obs"], entry["limits_exp"]
+
+    # --------------------------------------------------------------------------
+    def put(self, key, limit_obs, limits_exp, name=""):
+
+        path = os.path.join(self.cache_dir, key + ".json")
+        path_temp = path + ".tmp{0}".format(os.getpid())
+
+        with open(path_temp, "w") as f:
+            json.dump({ "limit_obs": limit_obs, "limits_exp": limits_exp, "name": name, "created": time.time() }, f, indent=2)
+        os.replace(path_temp, path)
+
+    # --------------------------------------------------------------------------
+    def stats(self):
+        total = self.hits + self.misses
+        return { "hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total > 0 else 0. }
+
+    def print_stats(self):
+        stats = self.stats()
+        print( "Limit cache: {0} hits, {1} misses ({2:.0%} hit rate)".format(stats["hits"], stats["misses"], stats["hit_rate"]) )
+
+    # --------------------------------------------------------------------------
+    def entries(self):
+        return [ name for name in os.listdir(self.cache_dir) if name.endswith(".json") ]
+
+    def purge(self):
+
+        print("Limit cache: purging", self.cache_dir)
+        for name in os.listdir(self.cache_dir):
+            os.remove(os.path.join(self.cache_dir, name))
+
+# ------------------------------------------------------------------------------
+def add_limit_cache_args(parser):
+    """ Command-line options of the limit cache, shared by the scripts computing limits
+    """
+    parser.add_argument("--limit-cache-dir",   action="store", default=default_cache_dir, help="Directory of the limit cache")
+    parser.add_argument("--no-limit-cache",    action="store_true", default=False, help="Bypass the limit cache")
+    parser.add_argument("--purge-limit-cache", action="store_true", default=False, help="Empty the limit cache before running")
+
+# ------------------------------------------------------------------------------
+def limit_cache_from_args(args):
+    """ LimitCache matching the limit cache options, or None if bypassed
+    """
+    if args.no_limit_cache: return None
+
+    limit_cache = LimitCache(args.limit_cache_dir)
+    if args.purge_limit_cache: limit_cache.purge()
+
+    return limit_cache
+
+# ------------------------------------------------------------------------------
+def main():
+
+    # Usage: python3 limit_cache.py [--purge] [<cache dir>]
+
+    purge = "--purge" in sys.argv[1:]
+    paths = [ arg for arg in sys.argv[1:] if arg != "--purge" ]
+
+    limit_cache = LimitCache(paths[0] if paths else default_cache_dir)
+    if purge: limit_cache.purge()
+
+    size = sum( os.path.getsize(os.path.join(limit_cache.cache_dir, name)) for name in limit_cache.entries() )
+    print( "Limit cache:", limit_cache.cache_dir )
+    print( "Entries:    ", len(limit_cache.entries()) )
+    print( "Size:        {0:.1f} kB".format(size / 1024.) )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+import os
+import re
+import time
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from asymptotic_cls import asymptotic_limits
+from profiling import profiler
+
+# combine: subprocess, native: in-process asymptotic CLs, validate: both, combine results are kept
+limit_backends = ["combine", "native", "validate"]
+
+# Use this for text scraping (expert only)
+expected_percent = [" 2.5", "16.0", "50.0", "84.0", "97.5"]
+
+# ------------------------------------------------------------------------------
+def parse_combine_output(output):
+    """ Scrape the observed and expected limits from the combine stdout
+
+    Returns (limit_obs, {percent: limit_exp}), with None for anything that could not be found.
+    """
+    match = re.search(r"Observed Limit:\s*r\s*<\s*([0-9.]+)", output)
+    limit_obs = float(match.group(1)) if match else None
+
+    limits_exp = {}
+    for val in expected_percent:
+        match = re.search(rf"Expected {val}%:\s*r\s*<\s*([0-9.]+)", output)
+        limits_exp[val] = float(match.group(1)) if match else None
+
+    return limit_obs, limits_exp
+
+# ------------------------------------------------------------------------------
+def job_parameters(job):
+    """ Parameters of a (datacard, name[, parameters]) job, None for a plain datacard job
+    """
+    return job[2] if len(job) > 2 else None
+
+def parameter_options(parameters):
+    """ combine options setting and freezing {parameter: value}
+    """
+    if not parameters: return []
+    return [ "--setParameters", ",".join( "{0}={1}".format(name, value) for name, value in sorted(parameters.items()) ),
+             "--freezeParameters", ",".join( sorted(parameters) ) ]
+
+# ------------------------------------------------------------------------------
+def build_workspace(datacard, timeout=None):
+    """ text2workspace.py on a datacard, writing <datacard>.root next to it
+
+    Returns a result dict as run_combine, with the workspace path in "workspace".
+    """
+    workspace = os.path.splitext(datacard)[0] + ".root"
+    command = ["text2workspace.py", os.path.abspath(datacard), "-o", os.path.abspath(workspace)]
+
+    result = { "name": os.path.basename(datacard), "command": " ".join(command), "workspace": workspace, "stdout": "", "stderr": "", "returncode": None }
+
+    start = time.time()
+    try:
+        process = subprocess.run(command, capture_output=True, text=True, timeout=timeout)
+        result["stdout"]     = process.stdout
+        result["stderr"]     = process.stderr
+        result["returncode"] = process.returncode
+    except subprocess.TimeoutExpired:
+        result["stderr"] = "text2workspace.py timed out after {0} s".format(timeout)
+    result["elapsed"] = time.time() - start
+    profiler.add_call("text2workspace", result["elapsed"])
+
+    print( "Workspace:", workspace, "({0:.1f} s)".format(result["elapsed"]) if result["returncode"] == 0 else "FAILED" )
+
+    return result
+
+# ------------------------------------------------------------------------------
+def run_combine(datacard, name, workdir, method="AsymptoticLimits", options=None, timeout=None):
+    """ Run one combine job in its own work directory
+
+    The job gets a unique -n name and runs with workdir as cwd, so jobs never share output files.
+    stdout and stderr are both captured, a failure or timeout is reported rather than raised.
+    """
+    os.makedirs(workdir, exist_ok=True)
+
+    command = ["combine", "-M", method, os.path.abspath(datacard), "-n", "." + name] + list(options or [])
+
+    result = { "name": name, "command": " ".join(command), "workdir": workdir, "stdout": "", "stderr": "", "returncode": None }
+
+    start = time.time()
+    try:
+        process = subprocess.run(command, cwd=workdir, capture_output=True, text=True, timeout=timeout)
+        result["stdout"]     = process.stdout
+        result["stderr"]     = process.stderr
+        result["returncode"] = process.returncode
+    except subprocess.TimeoutExpired as error:
+        result["stdout"] = error.stdout.decode() if isinstance(error.stdout, bytes) else (error.stdout or "")
+        result["stderr"] = "combine timed out after {0} s".format(timeout)
+    result["elapsed"] = time.time() - start
+    profiler.add_call("combine", result["elapsed"])
+
+    return result
+
+# ------------------------------------------------------------------------------
+def run_combine_jobs(jobs, work_dir, n_jobs=1, method="AsymptoticLimits", options=None, timeout=None):
+    """ Run (datacard, name[, parameters]) combine jobs, n_jobs at a time, each in work_dir/<name>
+
+    Every combine call is its own OS process, so a thread pool is enough to keep n_jobs of them busy.
+    Jobs with parameters share one workspace per datacard, built once; each job only sets and freezes
+    its parameters. Results are returned in the order of the input jobs.
+    """
+    workspaces = {}
+    for job in jobs:
+        if job_parameters(job) is not None and job[0] not in workspaces:
+            workspaces[job[0]] = build_workspace(job[0], timeout)
+
+    def run(job):
+        datacard, name, parameters = job[0], job[1], job_parameters(job)
+        if parameters is None:
+            return run_combine(datacard, name, os.path.join(work_dir, name), method, options, timeout)
+
+        workspace = workspaces[datacard]
+        if workspace["returncode"] != 0:
+            return dict(workspace, name=name)
+        return run_combine(workspace["workspace"], name, os.path.join(work_dir, name), method, list(options or []) + parameter_options(parameters), timeout)
+
+    if n_jobs <= 1:
+        return [ run(job) for job in jobs ]
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        return list( pool.map(run, jobs) )
+
+# ------------------------------------------------------------------------------
+def run_native(datacard, name, parameters=None):
+    """ In-process asymptotic CLs limits for a counting datacard, with the same result fields as run_combine
+    """
+    result = { "name": name, "command": "asymptotic_cls " + datacard, "stdout": "", "stderr": "", "returncode": 0 }
+
+    start = time.time()
+    with open(datacard) as f:
+        text = f.read()
+    try:
+        result["limit_obs"], result["limits_exp"] = asymptotic_limits(text, parameters=parameters)
+    except ValueError as error:
+        result["limit_obs"], result["limits_exp"] = None, { val: None for val in expected_percent }
+        result["stderr"]     = "native backend: " + str(error)
+        result["returncode"] = 1
+    result["elapsed"] = time.time() - start
+    profiler.add_call("native", result["elapsed"])
+
+    return result
+
+# ------------------------------------------------------------------------------
+def compare_limits(result_reference, result_test):
+    """ Relative difference (test - reference) / reference of the observed and expected limits, None if either is missing
+    """
+    pairs = { "obs": (result_reference["limit_obs"], result_test["limit_obs"]) }
+    for val in expected_percent:
+        pairs[val] = (result_reference["limits_exp"][val], result_test["limits_exp"][val])
+
+    return { key: (test - reference) / reference if reference and test is not None else None for key, (reference, test) in pairs.items() }
+
+# ------------------------------------------------------------------------------
+def run_limit_jobs(jobs, work_dir, backend="combine", n_jobs=1, timeout=None, cache=None):
+    """ Limits for (datacard, name[, parameters]) jobs with the selected backend, in the order of the input jobs
+
+    Every result carries "limit_obs" and "limits_exp" (None where not available). With the validate backend
+    the combine limits are returned, each with a "validation" entry comparing the native limits to them.
+    With a limit_cache.LimitCache, cached and duplicate datacards are not recomputed (not for validate).
+    """
+    if backend not in limit_backends:
+        raise ValueError("unknown limit backend: " + backend)
+
+    if cache is None or backend == "validate":
+        return compute_limits(jobs, work_dir, backend, n_jobs, timeout)
+
+    texts = {}
+    keys  = []
+    for job in jobs:
+        if job[0] not in texts:
+            with open(job[0]) as f:
+                texts[job[0]] = f.read()
+        keys.append( cache.key(texts[job[0]], backend, options=parameter_options(job_parameters(job))) )
+
+    # Look up every distinct card once, and compute each missing card once
+    results_by_key = {}
+    jobs_to_run = {}
+    for job, key in zip(jobs, keys):
+        if key in results_by_key or key in jobs_to_run: continue
+        cached = cache.get(key)
+        if cached is not None:
+            results_by_key[key] = { "name": job[1], "stdout": "", "stderr": "", "returncode": 0, "elapsed": 0., "cached": True,
+                                    "limit_obs": cached[0], "limits_exp": cached[1] }
+        else:
+            jobs_to_run[key] = job
+
+    for key, result in zip( jobs_to_run, compute_limits(list(jobs_to_run.values()), work_dir, backend, n_jobs, timeout) ):
+        result["cached"] = False
+        results_by_key[key] = result
+        if result["returncode"] == 0 and result["limit_obs"] is not None and None not in result["limits_exp"].values():
+            cache.put(key, result["limit_obs"], result["limits_exp"], result["name"])
+
+    cache.print_stats()
+
+    results = []
+    for job, key in zip(jobs, keys):
+        result = dict(results_by_key[key])
+        result["name"] = job[1]
+        results.append(result)
+
+    return results
+
+# ------------------------------------------------------------------------------
+def compute_limits(jobs, work_dir, backend="combine", n_jobs=1, timeout=None):
+    """ Run the backend on every job (no caching)
+    """
+    if backend == "native":
+        return [ run_native(*job) for job in jobs ]
+
+    results = run_combine_jobs(jobs, work_dir, n_jobs=n_jobs, timeout=timeout)
+    for result in results:
+        result["limit_obs"], result["limits_exp"] = parse_combine_output(result["stdout"])
+
+    if backend == "validate":
+        print( "Backend validation, (native - combine) / combine:" )
+        print( "  {0:40s} {1:>8s}".format("job", "obs") + "".join( " {0:>8s}".format(val.strip()+"%") for val in expected_percent ) )
+        for job, result in zip(jobs, results):
+            native = run_native(*job)
+            result["validation"] = compare_limits(result, native)
+            result["validation"]["elapsed_combine"] = result["elapsed"]
+            result["validation"]["elapsed_native"]  = native["elapsed"]
+            print( "  {0:40s} ".format(result["name"]) + " ".join( "{0:8.4f}".format(result["validation"][key]) if result["validation"][key] is not None else "     n/a"
+                                                                  for key in ["obs"] + expected_percent ) )
+
+    return results
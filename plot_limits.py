@@ -1,16 +1,17 @@
 import sys
 import json
+import glob
+import argparse
 import numpy as np
 import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
-import matplotlib.pyplot as plt
-from matplotlib.cm import get_cmap
-from matplotlib.colors import LinearSegmentedColormap
-from matplotlib.gridspec import GridSpec
+from results_store import ResultsStore, parse_filters, series_of
 
 
 # --- Style settings (CMS-like) ---
-plt.rcParams.update({
+style = {
     "font.family": "sans-serif",
     "font.sans-serif": ["Arial"], #, "Helvetica"],
     "mathtext.default": "regular",
@@ -19,21 +20,47 @@ plt.rcParams.update({
     "ytick.direction": "in",
     "xtick.minor.visible": True,
     "ytick.minor.visible": True
-})
+}
+
+# -------------------------------------------------------------------------------------------------
+def pyplot():
+	""" matplotlib.pyplot with the style above, imported on first use so that importing this module or
+	querying results does not pay for matplotlib
+	"""
+	import matplotlib
+	# Plots are only ever saved, so never need a display (also in batch worker processes)
+	matplotlib.use("Agg")
+	import matplotlib.pyplot as plt
+	plt.rcParams.update(style)
+	return plt
+
+# Parsed results, keyed by (path, mtime): each json is read once per process
+data_cache = {}
 
 # -------------------------------------------------------------------------------------------------
 def get_data(infile):
 
+	key = (os.path.abspath(infile), os.stat(infile).st_mtime_ns)
+	if key not in data_cache:
+		data_cache[key] = read_data(infile)
+
+	return data_cache[key]
+
+# -------------------------------------------------------------------------------------------------
+def read_data(infile):
+
 	data_in = {}
 
 	with open(infile) as f:
 		data_in = json.load(f)
 
-	mask = (np.array( data_in["limits_exp"]["50.0"] ) > 0)
+	# ctaus only lists the points with an observed limit, the other lists have -1 for failed points
+	mask_obs = (np.array( data_in["limits_obs"] ) > 0)
+	mask = (np.array( data_in["limits_exp"]["50.0"] ) > 0) & mask_obs
 
 	data_out = {}
 
-	data_out["ctaus"] = np.array( data_in["ctaus"] )[mask] * 1.0e-3
+	data_out["ctaus"] = np.array( data_in["ctaus"] )[mask[mask_obs]] * 1.0e-3
 	data_out["exp_median"] = np.array( data_in["limits_exp"]["50.0"] )[mask] #* 0.01
 	data_out["exp_1s_low"] = np.array( data_in["limits_exp"]["16.0"] )[mask] #* 0.01
 	data_out["exp_1s_high"] = np.array( data_in["limits_exp"]["84.0"] )[mask] #* 0.01
@@ -45,26 +72,65 @@ def get_data(infile):
 	data_out["nevents_bkg_ljdc"] = np.full(len(data_out["ctaus"]), data_in["nevents_bkg_ljdc"])
 	data_out["nevents_bkg_sjdc"] = np.full(len(data_out["ctaus"]), data_in["nevents_bkg_sjdc"])
 
+	# Interpolated curve from adaptive lifetime sampling
+	if "interp" in data_in:
+		interp = data_in["interp"]
+		mask_interp = np.isfinite( np.array( interp["limits_exp"]["50.0"], dtype=float ) )
+
+		data_out["interp"] = {}
+		data_out["interp"]["ctaus"] = np.array( interp["ctaus"] )[mask_interp] * 1.0e-3
+		for key, val in [("exp_median", "50.0"), ("exp_1s_low", "16.0"), ("exp_1s_high", "84.0"), ("exp_2s_low", " 2.5"), ("exp_2s_high", "97.5")]:
+			data_out["interp"][key] = np.array( interp["limits_exp"][val], dtype=float )[mask_interp]
+		data_out["interp"]["exp_median_err"] = np.array( interp["limits_exp_err"]["50.0"], dtype=float )[mask_interp]
+
 
 	return data_out	
 
 # -------------------------------------------------------------------------------------------------
-def plot_single_limit(infile):
+def data_from_rows(rows):
+	""" Same arrays as get_data, from the results store rows of one limit curve (sorted by target lifetime)
+	"""
+	rows = [ row for row in rows if row["exp_50"] is not None and row["exp_50"] > 0 ]
+
+	data_out = {}
+
+	data_out["ctaus"] = np.array( [ row["ctau_target"] for row in rows ] ) * 1.0e-3
+	for key, column in [("exp_median", "exp_50"), ("exp_1s_low", "exp_16"), ("exp_1s_high", "exp_84"), ("exp_2s_low", "exp_2p5"), ("exp_2s_high", "exp_97p5"),
+	                    ("nevents_sig_ljdc", "nevents_sig_ljdc"), ("nevents_sig_sjdc", "nevents_sig_sjdc"), ("nevents_bkg_ljdc", "nevents_bkg_ljdc"), ("nevents_bkg_sjdc", "nevents_bkg_sjdc")]:
+		data_out[key] = np.array( [ row[column] for row in rows ], dtype=float )
+
+	return data_out
+
+# -------------------------------------------------------------------------------------------------
+def plot_single_limit(infile, data=None, outfiles=None):
 
 	# Load
-	data = get_data(infile)
+	if data is None: data = get_data(infile)
 
 	#print(ctaus)
 	#print(exp_median)
 
+	plt = pyplot()
 	fig, ax = plt.subplots(figsize=(5,5))
 
 	# --- 2σ (yellow) and 1σ (green) bands ---
-	ax.plot(data["ctaus"], data["exp_median"], 'k--', lw=2, label='Expected')
-	ax.fill_between(data["ctaus"], data["exp_2s_low"], data["exp_2s_high"],
-	                color='gold', alpha=0.5, label=r'$\pm2\sigma$')
-	ax.fill_between(data["ctaus"], data["exp_1s_low"], data["exp_1s_high"],
-	                color='limegreen', alpha=0.8, label=r'$\pm1\sigma$')
+	if "interp" in data:
+		# Smooth curve through the adaptively sampled points, which are drawn as markers
+		curve = data["interp"]
+		ax.plot(curve["ctaus"], curve["exp_median"], 'k--', lw=2, label='Expected')
+		ax.fill_between(curve["ctaus"], curve["exp_2s_low"], curve["exp_2s_high"],
+		                color='gold', alpha=0.5, label=r'$\pm2\sigma$')
+		ax.fill_between(curve["ctaus"], curve["exp_1s_low"], curve["exp_1s_high"],
+		                color='limegreen', alpha=0.8, label=r'$\pm1\sigma$')
+		ax.fill_between(curve["ctaus"], curve["exp_median"] * (1. - curve["exp_median_err"]), curve["exp_median"] * (1. + curve["exp_median_err"]),
+		                color='grey', alpha=0.6, label='Interpolation')
+		ax.plot(data["ctaus"], data["exp_median"], 'ko', ms=3, label='Sampled')
+	else:
+		ax.plot(data["ctaus"], data["exp_median"], 'k--', lw=2, label='Expected')
+		ax.fill_between(data["ctaus"], data["exp_2s_low"], data["exp_2s_high"],
+		                color='gold', alpha=0.5, label=r'$\pm2\sigma$')
+		ax.fill_between(data["ctaus"], data["exp_1s_low"], data["exp_1s_high"],
+		                color='limegreen', alpha=0.8, label=r'$\pm1\sigma$')
 
 	# --- Median expected (black dashed) and observed (solid) ---
 	#ax.plot(masses, obs, 'k-', lw=2, label='Observed')
@@ -100,8 +166,10 @@ def plot_single_limit(infile):
 	plt.tight_layout()
 	plt.subplots_adjust(top=0.92) 
 
-	outfile = os.path.join("plots", infile.replace(".json", ".pdf").split("/")[-1])
-	plt.savefig(outfile)
+	if outfiles is None: outfiles = [ os.path.join("plots", infile.replace(".json", ".pdf").split("/")[-1]) ]
+	for outfile in outfiles:
+		plt.savefig(outfile)
+	plt.close(fig)
 
 # -------------------------------------------------------------------------------------------------
 def plot_multi_limit(infiles):
@@ -117,6 +185,8 @@ def plot_multi_limit(infiles):
 	#print(ctaus)
 	#print(exp_median)
 
+	plt = pyplot()
+	from matplotlib.cm import get_cmap
 	fig, ax = plt.subplots(figsize=(10,8))
 
 	color_map_name = "summer_r"
@@ -168,19 +238,22 @@ def plot_multi_limit(infiles):
 	plt.savefig(outfile)	
 
 # -------------------------------------------------------------------------------------------------
-def plot_multi_limit_debug(outfiletag, infiles):
+def plot_multi_limit_debug(outfiletag, infiles, datas=None, outfiles=None):
 
 	# Load
 	data = {}
 	filetags = []
-	for infile in infiles:
+	for i_file, infile in enumerate(infiles):
 		filetag = infile.replace(".json", "").split("/")[-1]
 		filetags.append(filetag)
-		data[filetag] = get_data(infile)
+		data[filetag] = datas[i_file] if datas is not None else get_data(infile)
 
 	#print(ctaus)
 	#print(exp_median)
 
+	plt = pyplot()
+	from matplotlib.cm import get_cmap
+	from matplotlib.gridspec import GridSpec
 	fig = plt.figure(figsize=(10, 8))
 	gs = GridSpec(2, 1, height_ratios=[2, 1], figure=fig, hspace=0.0)  # 2:1 ratio
 
@@ -254,13 +327,167 @@ def plot_multi_limit_debug(outfiletag, infiles):
 
 	plt.tight_layout()
 
-	outfile = os.path.join("plots", outfiletag+".png")
-	print("Saving figure to:", outfile )
-	plt.savefig(outfile)	
+	if outfiles is None: outfiles = [ os.path.join("plots", outfiletag+".png") ]
+	for outfile in outfiles:
+		print("Saving figure to:", outfile )
+		plt.savefig(outfile)
+	plt.close(fig)
+
+# -------------------------------------------------------------------------------------------------
+def parseBatchArgs(argv):
+	""" Parse command-line arguments of the batch mode
+	"""
+	parser = argparse.ArgumentParser(
+		prog="plot_limits.py batch",
+		add_help=True,
+		description='Plot many results jsons: all single-limit Brazil plots and the requested comparison plots, in parallel'
+	)
+
+	parser.add_argument("inputs",             nargs="+", help="Results jsons, directories of results jsons or globs")
+	parser.add_argument("--compare",          action="append", default=[], help="Comparison plot '<name>=<glob>' (repeatable)")
+	parser.add_argument("--no-single",        action="store_true", default=False, help="Only make the comparison plots")
+	parser.add_argument("-o", "--output-dir", action="store", default="plots", help="Output directory")
+	parser.add_argument("--formats",          action="store", default="pdf", help="Comma separated output formats per figure, e.g. pdf,png")
+	parser.add_argument("-j", "--jobs",       action="store", type=int, default=1, help="Number of figures to render in parallel")
+	parser.add_argument("--force",            action="store_true", default=False, help="Also redo plots that are newer than their inputs")
+
+	return parser.parse_args(argv)
+
+# -------------------------------------------------------------------------------------------------
+def results_files(inputs):
+	""" Results jsons from files, directories and globs (profile reports are skipped)
+	"""
+	infiles = []
+	for item in inputs:
+		if os.path.isdir(item): item = os.path.join(item, "*.json")
+		matches = sorted( glob.glob(item) )
+		if not matches: print( "WARNING: no results match", item )
+		infiles += matches
+
+	return [ infile for infile in dict.fromkeys(infiles) if not infile.endswith("_profile.json") ]
+
+def is_up_to_date(outfiles, infiles):
+	""" True if every output exists and is newer than every input
+	"""
+	if not infiles or not all( os.path.exists(outfile) for outfile in outfiles ): return False
+	return min( os.path.getmtime(outfile) for outfile in outfiles ) >= max( os.path.getmtime(infile) for infile in infiles )
+
+# -------------------------------------------------------------------------------------------------
+def run_plot_task(task):
+	""" Render one figure, (function name, args) as built by main_batch
+	"""
+	name, args = task
+	globals()[name](*args)
+	return args[-1]
+
+# -------------------------------------------------------------------------------------------------
+def main_batch(argv):
+
+	args = parseBatchArgs(argv)
+	formats = args.formats.split(",")
+	os.makedirs(args.output_dir, exist_ok=True)
+
+	# Figures to make: (function, inputs, outputs)
+	figures = []
+	if not args.no_single:
+		for infile in results_files(args.inputs):
+			stem = os.path.join( args.output_dir, os.path.basename(infile).replace(".json", "") )
+			figures.append( ("plot_single_limit", [infile], [ stem + "." + fmt for fmt in formats ]) )
+
+	for compare in args.compare:
+		outfiletag, pattern = compare.split("=", 1)
+		infiles = results_files(pattern.split(","))
+		if not infiles:
+			print( "WARNING: skipping comparison", outfiletag, "- no results match", pattern )
+			continue
+		figures.append( ("plot_multi_limit_debug", infiles, [ os.path.join(args.output_dir, outfiletag + "." + fmt) for fmt in formats ]) )
+
+	to_make = [ figure for figure in figures if args.force or not is_up_to_date(figure[2], figure[1]) ]
+	print( "Figures:", len(figures), "up to date:", len(figures) - len(to_make), "to make:", len(to_make) )
+
+	# Every json is parsed once here, workers only get the arrays they plot
+	tasks = []
+	for name, infiles, outfiles in to_make:
+		try:
+			datas = [ get_data(infile) for infile in infiles ]
+		except (KeyError, ValueError, OSError) as error:
+			print( "WARNING: skipping", outfiles[0], "- cannot read", infiles, ":", repr(error) )
+			continue
+		if name == "plot_single_limit":
+			tasks.append( (name, (infiles[0], datas[0], outfiles)) )
+		else:
+			tasks.append( (name, (outfiles[0].rsplit(".", 1)[0], infiles, datas, outfiles)) )
+
+	if args.jobs <= 1:
+		done = [ run_plot_task(task) for task in tasks ]
+	else:
+		with ProcessPoolExecutor(max_workers=args.jobs, mp_context=multiprocessing.get_context("spawn")) as pool:
+			done = list( pool.map(run_plot_task, tasks) )
+
+	for outfiles in done:
+		print( "Plotted:", ", ".join(outfiles) )
+
+# -------------------------------------------------------------------------------------------------
+def parseDbArgs(argv):
+	""" Parse command-line arguments of the results store mode
+	"""
+	parser = argparse.ArgumentParser(
+		prog="plot_limits.py db",
+		add_help=True,
+		description='Plot the limit curves selected from the results store'
+	)
+
+	parser.add_argument("db",                 action="store", help="SQLite results store written by combine_wrapper.py")
+	parser.add_argument("-w", "--where",      action="append", default=[], help="Filter 'column=value', 'column=v1,v2' or 'column=min:max' (repeatable), e.g. depth_cut=0.8")
+	parser.add_argument("--ctau-range",       action="store", default=None, help="Target lifetime range in m, 'min:max'")
+	parser.add_argument("-n", "--name",       action="store", default="results_db", help="Name of the comparison plot")
+	parser.add_argument("--single",           action="store_true", default=False, help="One Brazil plot per limit curve instead of the comparison plot")
+	parser.add_argument("-o", "--output-dir", action="store", default="plots", help="Output directory")
+	parser.add_argument("--formats",          action="store", default="png", help="Comma separated output formats per figure, e.g. pdf,png")
+
+	return parser.parse_args(argv)
+
+# -------------------------------------------------------------------------------------------------
+def main_db(argv):
+
+	args = parseDbArgs(argv)
+	formats = args.formats.split(",")
+	os.makedirs(args.output_dir, exist_ok=True)
+
+	filters = parse_filters(args.where)
+	if args.ctau_range:
+		filters["ctau_target"] = tuple( float(ctau) * 1.0e3 for ctau in args.ctau_range.split(":") )
+
+	# One indexed query for all curves, no per-file reads
+	store = ResultsStore(args.db)
+	series = series_of( store.query(filters) )
+	store.close()
+	print( "Limit curves:", len(series) )
+	if len(series) == 0: return
+
+	labels = list(series)
+	datas  = [ data_from_rows(series[label]) for label in labels ]
+
+	if args.single:
+		for label, data in zip(labels, datas):
+			plot_single_limit(label + ".json", data, [ os.path.join(args.output_dir, label + "." + fmt) for fmt in formats ])
+		return
+
+	plot_multi_limit_debug(args.name, labels, datas, [ os.path.join(args.output_dir, args.name + "." + fmt) for fmt in formats ])
 
 # -------------------------------------------------------------------------------------------------
 def main():
 
+	# Results store mode: plot_limits.py db <results.sqlite> [options]
+	if len(sys.argv) > 1 and sys.argv[1] == "db":
+		main_db(sys.argv[2:])
+		return
+
+	# Batch mode: plot_limits.py batch <inputs> [options]
+	if len(sys.argv) > 1 and sys.argv[1] == "batch":
+		main_batch(sys.argv[2:])
+		return
+
 	# Read in data
 
 	if len(sys.argv) == 2: 
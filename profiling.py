@@ -0,0 +1,168 @@
+import os
+import sys
+import json
+import time
+import resource
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+profile_hooks = ["cprofile", "pyinstrument"]
+
+# ------------------------------------------------------------------------------
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    """ Peak resident set size so far in MB (ru_maxrss is in kB on Linux, in bytes on macOS)
+    """
+    maxrss = resource.getrusage(who).ru_maxrss
+    return maxrss / (1024.**2 if sys.platform == "darwin" else 1024.)
+
+# ------------------------------------------------------------------------------
+class Profiler:
+    """ Stage timers, peak memory, event throughput and external call latencies of one run
+
+    Stages nest ("limits/workspace") and accumulate over repeated calls. Disabled profilers cost nothing but the
+    context manager. A hook ("cprofile" or "pyinstrument") profiles every top-level stage into hook_dir.
+    """
+
+    def __init__(self):
+        self.enabled  = False
+        self.hook     = None
+        self.hook_dir = None
+
+        self.start  = time.time()
+        self.stages = {}
+        self.calls  = {}
+        self.stack  = []
+        self.lock   = threading.Lock()
+
+    # --------------------------------------------------------------------------
+    def enable(self, hook=None, hook_dir=None):
+        if hook not in [None] + profile_hooks:
+            raise ValueError("unknown profile hook: " + str(hook))
+
+        self.enabled  = True
+        self.hook     = hook
+        self.hook_dir = hook_dir
+        self.start    = time.time()
+
+    # --------------------------------------------------------------------------
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        path = "/".join( self.stack + [name] )
+        self.stack.append(name)
+
+        hook = self.start_hook() if len(self.stack) == 1 else None
+        wall, cpu = time.time(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.time() - wall, time.process_time() - cpu
+            if hook is not None: self.stop_hook(hook, path)
+            self.stack.pop()
+
+            entry = self.stages.setdefault(path, { "wall": 0., "cpu": 0., "calls": 0, "events": 0 })
+            entry["wall"]  += wall
+            entry["cpu"]   += cpu
+            entry["calls"] += 1
+            entry["peak_rss_mb"] = peak_rss_mb()
+
+    def add_events(self, n_events):
+        """ Count processed events towards the innermost running stage
+        """
+        if not self.enabled or not self.stack: return
+        entry = self.stages.setdefault( "/".join(self.stack), { "wall": 0., "cpu": 0., "calls": 0, "events": 0 } )
+        entry["events"] += int(n_events)
+
+    def add_call(self, name, elapsed):
+        """ Latency of one external call (e.g. a combine subprocess), thread safe
+        """
+        if not self.enabled: return
+        with self.lock:
+            self.calls.setdefault(name, []).append(elapsed)
+
+    # --------------------------------------------------------------------------
+    def start_hook(self):
+        if self.hook == "cprofile":
+            import cProfile
+            hook = cProfile.Profile()
+            hook.enable()
+            return hook
+
+        if self.hook == "pyinstrument":
+            try:
+                from pyinstrument import Profiler as InstrumentProfiler
+            except ImportError:
+                raise ImportError("--profile-hook pyinstrument needs the pyinstrument package (pip install pyinstrument)")
+            hook = InstrumentProfiler()
+            hook.start()
+            return hook
+
+        return None
+
+    def stop_hook(self, hook, path):
+        os.makedirs(self.hook_dir, exist_ok=True)
+        outfile = os.path.join( self.hook_dir, path.replace("/", "__") )
+
+        if self.hook == "cprofile":
+            hook.disable()
+            hook.dump_stats(outfile + ".prof")
+        else:
+            hook.stop()
+            with open(outfile + ".html", "w") as f:
+                f.write( hook.output_html() )
+
+    # --------------------------------------------------------------------------
+    def report(self):
+        stages = {}
+        for path, entry in self.stages.items():
+            stages[path] = dict(entry)
+            if entry["events"] > 0 and entry["wall"] > 0:
+                stages[path]["events_per_s"] = entry["events"] / entry["wall"]
+
+        calls = {}
+        for name, latencies in self.calls.items():
+            latencies = np.array(latencies)
+            calls[name] = { "n": len(latencies), "total": float( latencies.sum() ), "mean": float( latencies.mean() ),
+                            "median": float( np.median(latencies) ), "max": float( latencies.max() ) }
+
+        return { "command": " ".join(sys.argv), "wall": time.time() - self.start, "cpu": time.process_time(),
+                 "peak_rss_mb": peak_rss_mb(), "peak_rss_children_mb": peak_rss_mb(resource.RUSAGE_CHILDREN),
+                 "stages": stages, "calls": calls, "hook": self.hook, "hook_dir": self.hook_dir if self.hook else None }
+
+    def print_report(self):
+        report = self.report()
+        print( "Profile: {0:.1f} s wall, {1:.1f} s cpu, peak RSS {2:.0f} MB (children {3:.0f} MB)".format(
+               report["wall"], report["cpu"], report["peak_rss_mb"], report["peak_rss_children_mb"]) )
+        for path, entry in report["stages"].items():
+            rate = "  {0:.3g} events/s".format(entry["events_per_s"]) if "events_per_s" in entry else ""
+            print( "  {0:35s} {1:8.2f} s  x{2:<4d}{3}".format(path, entry["wall"], entry["calls"], rate) )
+        for name, entry in report["calls"].items():
+            print( "  {0:35s} {1:4d} calls, median {2:.2f} s, max {3:.2f} s".format(name, entry["n"], entry["median"], entry["max"]) )
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+        print( "Profile written to:", path )
+        return path
+
+# Profiler of this process, enabled by --profile
+profiler = Profiler()
+
+# ------------------------------------------------------------------------------
+def add_profile_args(parser):
+    """ Command-line options of the profiler, shared by the scripts
+    """
+    parser.add_argument("--profile",      action="store_true", default=False, help="Write per-stage timing and resources as json next to the results")
+    parser.add_argument("--profile-hook", action="store", default=None, choices=profile_hooks, help="Also profile every stage with cProfile or pyinstrument")
+
+# ------------------------------------------------------------------------------
+def profile_path(results_path):
+    """ Profile json next to a results json (or in a results directory)
+    """
+    if results_path.endswith(".json"): return results_path[:-len(".json")] + "_profile.json"
+    return os.path.join(results_path, "profile.json")
@@ -0,0 +1,357 @@
+import numpy as np
+
+from profiling import profiler
+
+# Data (background) input -- currently only a partial dataset
+default_data_file = "/eos/cms/store/group/phys_exotica/HCAL_LLP/MiniTuples/v4.1/minituple_LLPskim_2023D_allscores.root"
+
+# if using a partial dataset, how much to scale this up by
+default_lumi_sf = 6.8 # 2023D
+
+# Branches needed for the background (data) prediction
+data_branches = [
+    "jet0_DepthTagCand", "jet1_DepthTagCand",
+    "jet0_InclTagCand", "jet1_InclTagCand",
+    "jet0_scores_inc_train80", "jet1_scores_inc_train80",
+    "jet0_scores_depth_LLPanywhere", "jet1_scores_depth_LLPanywhere",
+    "jet0_DeepCSV_prob_b", "jet1_DeepCSV_prob_b",
+]
+
+# Branches needed for the signal yields and lifetime reweighting
+signal_branches = [
+    "jet0_DepthTagCand", "jet1_DepthTagCand",
+    "jet0_InclTagCand", "jet1_InclTagCand",
+    "jet0_scores_inc_train80", "jet1_scores_inc_train80",
+    "jet0_scores_depth_LLPanywhere", "jet1_scores_depth_LLPanywhere",
+    "weight", "LLP0_DecayCtau", "LLP1_DecayCtau",
+]
+
+default_preselection = "Pass_PreSel == 1"
+
+# Jet orderings: (depth-tagged jet, inclusive-tagged jet)
+jet_orderings = {
+    "ljdc": ("jet0", "jet1"), # leading jet depth candidate
+    "sjdc": ("jet1", "jet0"), # subleading jet depth candidate
+}
+
+# Inclusive score upper bound defining the control regions
+incl_score_cr_max = 0.2
+
+# Btag working point, corresponds to 2023 post BPIX (TODO: Fix)
+btag_wp = 0.2435
+
+btag_categories = ["incl", "btag", "nobtag"]
+regions = ["cr", "cr_depth", "sr"]
+
+# ------------------------------------------------------------------------------
+def load_columns(infilepath, branches, preselection=default_preselection, treename="NoSel"):
+    """ Read the requested branches of the preselected events into numpy arrays (single event loop)
+    """
+    import ROOT
+
+    rdf = ROOT.RDataFrame(treename, infilepath)
+    if preselection: rdf = rdf.Filter(preselection)
+
+    return { name: np.asarray(values) for name, values in rdf.AsNumpy(list(branches)).items() }
+
+# ------------------------------------------------------------------------------
+def tree_entries(infilepath, treename="NoSel"):
+    """ Number of tree entries (generated events, before the preselection), from the tree header without an event loop
+    """
+    import ROOT
+
+    infile = ROOT.TFile.Open(infilepath)
+    if not infile or infile.IsZombie():
+        raise OSError("cannot open " + infilepath)
+    tree = infile.Get(treename)
+    if not tree:
+        raise KeyError("no tree {0} in {1}".format(treename, infilepath))
+    n_entries = int( tree.GetEntries() )
+    infile.Close()
+
+    return n_entries
+
+# ------------------------------------------------------------------------------
+def load_column_chunks(infilepath, branches, chunk_size, preselection=default_preselection, treename="NoSel"):
+    """ Iterate over the preselected events in chunks of chunk_size tree entries, as numpy arrays
+
+    Every chunk is an RDataFrame over its own global entry range: the reader starts at the first entry of the
+    chunk instead of iterating up to it (as Range would), so the total work stays linear in the tree size and
+    peak memory is set by chunk_size.
+    """
+    import ROOT
+
+    n_entries = tree_entries(infilepath, treename)
+
+    for start in range(0, n_entries, chunk_size):
+        spec = ROOT.RDF.Experimental.RDatasetSpec()
+        spec.AddSample( ROOT.RDF.Experimental.RSample(treename, treename, infilepath) )
+        spec.WithGlobalRange( ROOT.RDF.Experimental.RDatasetSpec.REntryRange(start, min(start + chunk_size, n_entries)) )
+
+        rdf = ROOT.RDataFrame(spec)
+        if preselection: rdf = rdf.Filter(preselection)
+
+        yield { name: np.asarray(values) for name, values in rdf.AsNumpy(list(branches)).items() }
+
+# ------------------------------------------------------------------------------
+def btag_category_masks(columns, jet_depth, btag_cut=btag_wp):
+    """ Btag category masks on the depth-tagged jet (None for the inclusive category)
+    """
+    btag_score = np.asarray(columns[jet_depth+"_DeepCSV_prob_b"], dtype=np.float64)
+    btag_cut   = np.float64(btag_cut)
+
+    return { "incl": None, "btag": btag_score > btag_cut, "nobtag": btag_score < btag_cut }
+
+# ------------------------------------------------------------------------------
+def bkg_region_masks(columns, incl_score_cut, depth_score_cut, btag_cut=btag_wp):
+    """ Masks of every CR / CR-depth / SR region, for both jet orderings and all btag categories
+
+    Returns {category: {"<ordering>_<region>": mask}}. Scores are cast to double before the comparison, as in
+    TTreeFormula (with NumPy 1.x a float32 array compared to a double cut would be compared in float32).
+    """
+    incl_score_cut  = np.float64(incl_score_cut)
+    depth_score_cut = np.float64(depth_score_cut)
+
+    masks = { category: {} for category in btag_categories }
+
+    for ordering, (jet_depth, jet_incl) in jet_orderings.items():
+
+        tagged      = (columns[jet_depth+"_DepthTagCand"] == 1) & (columns[jet_incl+"_InclTagCand"] == 1)
+        incl_score  = np.asarray(columns[jet_incl+"_scores_inc_train80"], dtype=np.float64)
+        depth_score = np.asarray(columns[jet_depth+"_scores_depth_LLPanywhere"], dtype=np.float64)
+
+        mask_region = {}
+        mask_region["cr"]       = tagged & (incl_score < np.float64(incl_score_cr_max))
+        mask_region["cr_depth"] = mask_region["cr"] & (depth_score > depth_score_cut)
+        mask_region["sr"]       = tagged & (incl_score > incl_score_cut)
+
+        mask_category = btag_category_masks(columns, jet_depth, btag_cut)
+
+        for category in btag_categories:
+            for region in regions:
+                mask = mask_region[region]
+                if mask_category[category] is not None: mask = mask & mask_category[category]
+                masks[category][ordering+"_"+region] = mask
+
+    return masks
+
+# ------------------------------------------------------------------------------
+def count_bkg_regions(columns, incl_score_cut, depth_score_cut, btag_cut=btag_wp):
+    """ Count data events in every CR / CR-depth / SR region, for both jet orderings and all btag categories
+
+    Returns {category: {"<ordering>_<region>": count}}, e.g. counts["btag"]["ljdc_cr_depth"].
+    """
+    masks = bkg_region_masks(columns, incl_score_cut, depth_score_cut, btag_cut)
+
+    return { category: { key: int( np.count_nonzero(mask) ) for key, mask in masks[category].items() } for category in btag_categories }
+
+# ------------------------------------------------------------------------------
+def bootstrap_bkg_regions(columns, incl_score_cut, depth_score_cut, n_replicas, rng, btag_cut=btag_wp):
+    """ Region counts of n_replicas bootstrap replicas of the data, {category: {"<ordering>_<region>": array(n_replicas)}}
+
+    Every event gets an independent Poisson(1) weight per replica. Events with the same region memberships are
+    interchangeable, and a sum of n independent Poisson(1) weights is Poisson(n), so the weights are drawn per
+    membership pattern instead of per event (same distribution, cost independent of the number of events).
+    All region counts of all replicas then come from one (regions x patterns) @ (patterns x replicas) product.
+    Counts are additive over chunks, as count_bkg_regions.
+    """
+    masks = bkg_region_masks(columns, incl_score_cut, depth_score_cut, btag_cut)
+    keys  = [ (category, key) for category in btag_categories for key in masks[category] ]
+
+    # Region memberships of every event as a bit pattern
+    patterns = np.zeros( len(next(iter(masks["incl"].values()))), dtype=np.int64 )
+    for bit, (category, key) in enumerate(keys):
+        patterns |= masks[category][key].astype(np.int64) << bit
+
+    patterns, n_events = np.unique(patterns[patterns > 0], return_counts=True)
+    membership = ( (patterns[None, :] >> np.arange(len(keys))[:, None]) & 1 ).astype(np.float64)
+
+    weights = rng.poisson(n_events[:, None], size=(len(patterns), n_replicas)).astype(np.float64)
+    replica_counts = membership @ weights
+
+    counts = { category: {} for category in btag_categories }
+    for (category, key), values in zip(keys, replica_counts):
+        counts[category][key] = values
+
+    return counts
+
+# ------------------------------------------------------------------------------
+def data_file_columns(infilepath, read_columns=load_columns, chunk_size=None):
+    """ Column sets of the data branches of one file: all at once with read_columns, or streamed in chunks of chunk_size entries
+    """
+    if not chunk_size:
+        # Only the needed branches of the preselected events are read, once, into arrays
+        yield read_columns(infilepath, data_branches)
+        return
+
+    # Bounded memory: the counts are additive over chunks
+    for columns_chunk in load_column_chunks(infilepath, data_branches, chunk_size):
+        yield columns_chunk
+
+# ------------------------------------------------------------------------------
+def count_data_file(infilepath, incl_score_cut, depth_score_cut, read_columns=load_columns, chunk_size=None, n_replicas=0, seed=None):
+    """ count_bkg_regions for one data file, read at once with read_columns or streamed in chunks of chunk_size entries
+
+    With n_replicas, returns (counts, bootstrap replica counts) from the same pass over the data.
+    """
+    rng = np.random.default_rng(seed)
+
+    counts, replica_counts = None, None
+    for columns in data_file_columns(infilepath, read_columns, chunk_size):
+        profiler.add_events( len(columns[data_branches[0]]) )
+        counts = add_region_counts(counts, count_bkg_regions(columns, incl_score_cut, depth_score_cut))
+        if n_replicas:
+            replica_counts = add_region_counts(replica_counts, bootstrap_bkg_regions(columns, incl_score_cut, depth_score_cut, n_replicas, rng))
+
+    if n_replicas: return counts, replica_counts
+    return counts
+
+# ------------------------------------------------------------------------------
+def add_region_counts(total, counts):
+    """ Sum of two count_bkg_regions (or bootstrap_bkg_regions) results (total may be None), for counting chunk by chunk
+    """
+    if total is None: return counts
+    return { category: { key: total[category][key] + counts[category][key] for key in counts[category] } for category in counts }
+
+# ------------------------------------------------------------------------------
+def calculate_bkg_prediction(region_counts, lumi_sf, verbose=True):
+    """ ABCD prediction of the SR yields from the region counts of one btag category
+    """
+
+    # This is really just an approximation, should use Gillian's more robust approach eventually
+
+    nevents_bkg_ljdc_srpred = lumi_sf * region_counts["ljdc_sr"] * (region_counts["ljdc_cr_depth"] / region_counts["ljdc_cr"])
+    nevents_bkg_sjdc_srpred = lumi_sf * region_counts["sjdc_sr"] * (region_counts["sjdc_cr_depth"] / region_counts["sjdc_cr"])
+
+    if verbose:
+        print( "nevents_bkg_ljdc_srpred",nevents_bkg_ljdc_srpred  )
+        print( "nevents_bkg_sjdc_srpred",nevents_bkg_sjdc_srpred  )
+
+    return nevents_bkg_ljdc_srpred, nevents_bkg_sjdc_srpred
+
+# ------------------------------------------------------------------------------
+def bootstrap_bkg_prediction(region_counts, replica_counts, lumi_sf):
+    """ Distribution of the ABCD prediction of one btag category over the bootstrap replicas
+
+    Returns {ordering: {"nominal", "mean", "std", "quantiles" (16/50/84%), "sr_count", "tf", "tf_std"}},
+    with the transfer factor tf = lumi_sf * CR_depth / CR (prediction = sr_count * tf).
+    Replicas with an empty CR are ignored.
+    """
+    nominal = dict( zip(jet_orderings, calculate_bkg_prediction(region_counts, lumi_sf, verbose=False)) )
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        replicas = dict( zip(jet_orderings, calculate_bkg_prediction(replica_counts, lumi_sf, verbose=False)) )
+
+    summary = {}
+    for ordering in jet_orderings:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            tf_replicas = lumi_sf * replica_counts[ordering+"_cr_depth"] / replica_counts[ordering+"_cr"]
+        valid = np.isfinite(replicas[ordering])
+
+        summary[ordering] = {
+            "nominal": float(nominal[ordering]),
+            "mean": float( np.mean(replicas[ordering][valid]) ),
+            "std": float( np.std(replicas[ordering][valid]) ),
+            "quantiles": [ float(val) for val in np.quantile(replicas[ordering][valid], [0.16, 0.5, 0.84]) ],
+            "sr_count": int(region_counts[ordering+"_sr"]),
+            "tf": float( lumi_sf * region_counts[ordering+"_cr_depth"] / region_counts[ordering+"_cr"] ),
+            "tf_std": float( np.std(tf_replicas[valid]) ),
+            "n_replicas": int( np.count_nonzero(valid) ),
+        }
+
+    return summary
+
+# ------------------------------------------------------------------------------
+def bootstrap_summary(region_counts, replica_counts, lumi_sf, bkg_stat="lnN"):
+    """ Bootstrap distributions of the predictions of all btag categories, as carried by the background predictions
+    """
+    n_replicas = len( next(iter(replica_counts["incl"].values())) )
+
+    predictions = {}
+    for category in btag_categories:
+        predictions[category] = bootstrap_bkg_prediction(region_counts[category], replica_counts[category], lumi_sf)
+
+        print( "Bootstrap ({0} replicas) {1}:".format(n_replicas, category) )
+        for ordering in jet_orderings:
+            print( "  {0}: {1:.2f} +- {2:.2f}".format(ordering, predictions[category][ordering]["nominal"], predictions[category][ordering]["std"]) )
+
+    return { "bkg_stat": bkg_stat, "n_replicas": n_replicas, "predictions": predictions }
+
+# ------------------------------------------------------------------------------
+def signal_region_masks(columns, incl_score_cut, depth_score_cut):
+    """ SR masks for both jet orderings: depth tag + depth score on one jet, inclusive tag + inclusive score on the other
+
+    Scores are compared in double precision, as in bkg_region_masks.
+    """
+    incl_score_cut  = np.float64(incl_score_cut)
+    depth_score_cut = np.float64(depth_score_cut)
+
+    masks = {}
+    for ordering, (jet_depth, jet_incl) in jet_orderings.items():
+        masks[ordering] = (columns[jet_depth+"_DepthTagCand"] == 1) & (columns[jet_incl+"_InclTagCand"] == 1) \
+                        & (np.asarray(columns[jet_depth+"_scores_depth_LLPanywhere"], dtype=np.float64) > depth_score_cut) \
+                        & (np.asarray(columns[jet_incl+"_scores_inc_train80"], dtype=np.float64) > incl_score_cut)
+
+    return masks
+
+# ------------------------------------------------------------------------------
+def signal_region_events(columns, incl_score_cut, depth_score_cut):
+    """ Columns restricted to the events in either signal region (calculate_sig_yields gives the same yields on them)
+    """
+    masks = signal_region_masks(columns, incl_score_cut, depth_score_cut)
+    in_sr = masks["ljdc"] | masks["sjdc"]
+
+    return { name: values[in_sr] for name, values in columns.items() }
+
+# ------------------------------------------------------------------------------
+def concatenate_columns(chunks):
+    """ One set of columns from a list of column chunks
+    """
+    return { name: np.concatenate([chunk[name] for chunk in chunks]) for name in chunks[0] }
+
+# ------------------------------------------------------------------------------
+def lifetime_weights(columns, ctau_sample, ctau_targets, mask=None):
+    """ Event weights reweighted from the sample lifetime to every target lifetime, as an events x lifetimes matrix
+
+    Each LLP gets (ctau_sample / ctau_target) * exp( -DecayCtau * 10 * (1/ctau_target - 1/ctau_sample) ),
+    with ctau in mm and DecayCtau in cm.
+    """
+    ctau_sample  = float(ctau_sample)
+    ctau_targets = np.asarray(ctau_targets, dtype=np.float64)
+
+    weight = np.asarray(columns["weight"], dtype=np.float64)
+    decay  = np.asarray(columns["LLP0_DecayCtau"], dtype=np.float64) + np.asarray(columns["LLP1_DecayCtau"], dtype=np.float64)
+    if mask is not None:
+        weight = weight[mask]
+        decay  = decay[mask]
+
+    # Both LLPs share the same target, so the two exponentials combine into one
+    slope = 10. * ( 1.0/ctau_targets - 1.0/ctau_sample )
+    norm  = ( ctau_sample / ctau_targets )**2
+
+    return weight[:, None] * norm[None, :] * np.exp( -decay[:, None] * slope[None, :] )
+
+# ------------------------------------------------------------------------------
+def calculate_sig_yields(columns, ctau_sample, ctau_targets, incl_score_cut, depth_score_cut, block_size=65536):
+    """ Reweighted signal yields in the LJDC and SJDC signal regions for all target lifetimes at once
+
+    Returns {"ljdc": array, "sjdc": array}, one entry per target lifetime (in minituple %, as the weight branch).
+    """
+    masks = signal_region_masks(columns, incl_score_cut, depth_score_cut)
+
+    # Only events in one of the SRs contribute, so only those rows of the weight matrix are built
+    in_sr   = masks["ljdc"] | masks["sjdc"]
+    columns_sr = { name: columns[name][in_sr] for name in ["weight", "LLP0_DecayCtau", "LLP1_DecayCtau"] }
+    masks_sr   = { ordering: mask[in_sr].astype(np.float64) for ordering, mask in masks.items() }
+
+    yields = { ordering: np.zeros(len(ctau_targets)) for ordering in masks }
+
+    # Blocks of events keep the weight matrix small for dense lifetime grids
+    n_sr = int( np.count_nonzero(in_sr) )
+    for start in range(0, n_sr, block_size):
+        block   = slice(start, start + block_size)
+        weights = lifetime_weights({ name: values[block] for name, values in columns_sr.items() }, ctau_sample, ctau_targets)
+        for ordering in yields:
+            yields[ordering] += masks_sr[ordering][block] @ weights
+
+    return yields
@@ -0,0 +1,216 @@
+import os
+import re
+import sys
+import time
+import sqlite3
+import argparse
+
+default_db_name = "results.sqlite"
+
+# Expected limit columns, per expected_percent quantile
+expected_columns = { " 2.5": "exp_2p5", "16.0": "exp_16", "50.0": "exp_50", "84.0": "exp_84", "97.5": "exp_97p5" }
+
+# One row per (signal sample, source lifetime, target lifetime, cuts, template version); limits in BR units as the results json
+schema = """
+CREATE TABLE IF NOT EXISTS limits (
+    sample           TEXT NOT NULL,
+    process          TEXT,
+    mass_h           REAL,
+    mass_s           REAL,
+    ctau_source      REAL NOT NULL,
+    ctau_target      REAL NOT NULL,
+    incl_cut         REAL NOT NULL,
+    depth_cut        REAL NOT NULL,
+    template         TEXT NOT NULL,
+    limit_obs        REAL,
+    exp_2p5          REAL,
+    exp_16           REAL,
+    exp_50           REAL,
+    exp_84           REAL,
+    exp_97p5         REAL,
+    nevents_sig_ljdc REAL,
+    nevents_sig_sjdc REAL,
+    nevents_bkg_ljdc REAL,
+    nevents_bkg_sjdc REAL,
+    backend          TEXT,
+    results_json     TEXT,
+    created          REAL,
+    PRIMARY KEY (sample, ctau_source, ctau_target, incl_cut, depth_cut, template)
+);
+CREATE INDEX IF NOT EXISTS limits_mass ON limits (mass_s, mass_h, depth_cut, incl_cut, ctau_target);
+CREATE INDEX IF NOT EXISTS limits_cuts ON limits (depth_cut, incl_cut, ctau_target);
+"""
+
+columns = [ "sample", "process", "mass_h", "mass_s", "ctau_source", "ctau_target", "incl_cut", "depth_cut", "template", "limit_obs" ] \
+        + list(expected_columns.values()) \
+        + [ "nevents_sig_ljdc", "nevents_sig_sjdc", "nevents_bkg_ljdc", "nevents_bkg_sjdc", "backend", "results_json", "created" ]
+
+# ------------------------------------------------------------------------------
+def sample_description(filetag):
+    """ Process and masses from a filetag like HToSSTo4B_125_50_CTau3000 (None where not found)
+    """
+    match = re.match(r"(.+?)_(\d+(?:p\d+)?)_(\d+(?:p\d+)?)(?:_|$)", filetag)
+    if not match: return { "process": None, "mass_h": None, "mass_s": None }
+
+    return { "process": match.group(1), "mass_h": float(match.group(2).replace("p", ".")), "mass_s": float(match.group(3).replace("p", ".")) }
+
+def template_version(template_datacard):
+    """ Template version: the directory of the template datacard (templates/v1/... -> v1)
+    """
+    return os.path.basename( os.path.dirname( os.path.abspath(template_datacard) ) )
+
+# ------------------------------------------------------------------------------
+class ResultsStore:
+    """ SQLite store of the limits and yields of every lifetime point, indexed by sample, masses, cuts and lifetimes
+
+    Rows are replaced when the same point is computed again. The database runs in WAL mode, so several
+    processes (batch workers, campaign jobs) can write to it while it is queried.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        if os.path.dirname(path): os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=60.)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(schema)
+
+    def close(self):
+        self.connection.close()
+
+    # --------------------------------------------------------------------------
+    def put(self, rows):
+        """ Insert or replace rows (dicts with the column names, missing columns are NULL)
+        """
+        statement = "INSERT OR REPLACE INTO limits ({0}) VALUES ({1})".format( ", ".join(columns), ", ".join("?" * len(columns)) )
+        with self.connection:
+            self.connection.executemany( statement, [ tuple( row.get(column) for column in columns ) for row in rows ] )
+
+    def put_points(self, points, filetag, ctau_source, incl_score_cut, depth_score_cut, template_datacard, bkg_predictions, sf, backend=None, results_json=None):
+        """ Rows of the lifetime points of one signal sample, as returned by combine_wrapper.evaluate_lifetimes
+
+        Limits are scaled by sf (datacard units -> BR), yields are stored as in the results json.
+        """
+        common = dict( sample_description(filetag), sample=filetag, ctau_source=float(ctau_source), incl_cut=float(incl_score_cut),
+                       depth_cut=float(depth_score_cut), template=template_version(template_datacard), backend=backend,
+                       results_json=os.path.abspath(results_json) if results_json else None, created=time.time(),
+                       nevents_bkg_ljdc=bkg_predictions["incl"][0], nevents_bkg_sjdc=bkg_predictions["incl"][1] )
+
+        rows = []
+        for point in points:
+            row = dict( common, ctau_target=float(point["ctau"]), nevents_sig_ljdc=point["nevents_sig_ljdc"], nevents_sig_sjdc=point["nevents_sig_sjdc"] )
+            row["limit_obs"] = point["limit_obs"] * sf if point["limit_obs"] is not None else None
+            for val, column in expected_columns.items():
+                row[column] = point["limits_exp"][val] * sf if point["limits_exp"][val] is not None else None
+            rows.append(row)
+
+        self.put(rows)
+        return len(rows)
+
+    def merge(self, path):
+        """ Insert or replace all rows of another results store
+        """
+        self.connection.execute("ATTACH DATABASE ? AS other", (path,))
+        with self.connection:
+            self.connection.execute( "INSERT OR REPLACE INTO limits ({0}) SELECT {0} FROM other.limits".format(", ".join(columns)) )
+        self.connection.execute("DETACH DATABASE other")
+
+    # --------------------------------------------------------------------------
+    def query(self, filters=None, order_by=("sample", "template", "incl_cut", "depth_cut", "ctau_source", "ctau_target")):
+        """ Rows matching all filters {column: value, [values] or (min, max)} as dicts
+        """
+        where, values = [], []
+        for column, value in (filters or {}).items():
+            if column not in columns:
+                raise ValueError("unknown results column: " + column)
+            if isinstance(value, tuple):
+                where.append( "{0} BETWEEN ? AND ?".format(column) )
+                values += list(value)
+            elif isinstance(value, list):
+                where.append( "{0} IN ({1})".format(column, ", ".join("?" * len(value))) )
+                values += value
+            else:
+                where.append( "{0} = ?".format(column) )
+                values.append(value)
+
+        statement = "SELECT * FROM limits"
+        if where: statement += " WHERE " + " AND ".join(where)
+        statement += " ORDER BY " + ", ".join(order_by)
+
+        return [ dict(row) for row in self.connection.execute(statement, values) ]
+
+# ------------------------------------------------------------------------------
+def filter_value(text):
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+def parse_filters(expressions):
+    """ Filters from command-line expressions: 'column=value', 'column=v1,v2' or 'column=min:max'
+    """
+    filters = {}
+    for expression in expressions or []:
+        column, value = expression.split("=", 1)
+
+        if ":" in value:
+            filters[column] = tuple( filter_value(item) for item in value.split(":") )
+        elif "," in value:
+            filters[column] = [ filter_value(item) for item in value.split(",") ]
+        else:
+            filters[column] = filter_value(value)
+
+    return filters
+
+def series_of(rows):
+    """ Rows grouped into limit curves vs target lifetime, one per (sample, source lifetime, cuts, template)
+    """
+    series = {}
+    for row in rows:
+        # Filetags from batch runs already carry the source lifetime (..._CTau3000)
+        sample = row["sample"] if "CTau" in row["sample"] else "{0}_CTau{1:g}".format(row["sample"], row["ctau_source"])
+        key = "{0}_inc{1:g}_depth{2:g}_{3}".format(sample, row["incl_cut"], row["depth_cut"], row["template"])
+        series.setdefault(key, []).append(row)
+
+    for key in series:
+        series[key].sort(key=lambda row: row["ctau_target"])
+    return series
+
+# ------------------------------------------------------------------------------
+def add_results_store_args(parser):
+    """ Command-line options of the results store, shared by the scripts computing limits
+    """
+    parser.add_argument("--results-db",    action="store", default=None, help="SQLite results store (default: <output dir>/" + default_db_name + ")")
+    parser.add_argument("--no-results-db", action="store_true", default=False, help="Do not write the results store")
+
+def results_db_from_args(args):
+    """ Path of the results store matching the options, or None if disabled
+    """
+    if args.no_results_db: return None
+    return args.results_db or os.path.join(args.output_dir, default_db_name)
+
+# ------------------------------------------------------------------------------
+def main():
+
+    parser = argparse.ArgumentParser(
+        add_help=True,
+        description='Query the results store'
+    )
+    parser.add_argument("db",             action="store", help="SQLite results store")
+    parser.add_argument("-w", "--where",  action="append", default=[], help="Filter 'column=value', 'column=v1,v2' or 'column=min:max' (repeatable)")
+    parser.add_argument("--columns",      action="store", default="sample,incl_cut,depth_cut,template,ctau_target,exp_50,limit_obs,nevents_sig_ljdc,nevents_sig_sjdc",
+                        help="Comma separated columns to print")
+    args = parser.parse_args()
+
+    store = ResultsStore(args.db)
+    rows = store.query( parse_filters(args.where) )
+
+    shown = args.columns.split(",")
+    print( "  ".join( "{0:>12s}".format(column) for column in shown ) )
+    for row in rows:
+        print( "  ".join( "{0:>12.4g}".format(row[column]) if isinstance(row[column], float) else "{0:>12s}".format(str(row[column])) for column in shown ) )
+    print( "Rows:", len(rows), file=sys.stderr )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,374 @@
+import argparse
+import os
+import json
+
+import numpy as np
+from scipy.stats import norm
+
+from datacards import SF_temp, datacard_replacements, render_datacard
+from limits import expected_percent, limit_backends, run_limit_jobs
+from limit_cache import add_limit_cache_args, limit_cache_from_args
+from skim_cache import add_skim_cache_args
+from column_store import add_column_store_args, column_reader
+from signal_efficiency_table import SignalEfficiencyTable
+from regions import default_data_file, default_lumi_sf, btag_categories, data_branches, signal_branches, \
+                    jet_orderings, incl_score_cr_max, btag_wp, btag_category_masks, lifetime_weights
+
+cwd = os.getcwd()
+default_template_datacard = os.path.join( cwd, "templates/v1/datacard_TEMPLATE.txt" )
+
+# ------------------------------------------------------------------------------
+def parseArgs():
+    """ Parse command-line arguments
+    """
+    parser = argparse.ArgumentParser(
+        add_help=True,
+        description='Scan of the (inclusive score, depth score) signal region cuts'
+    )
+
+    parser.add_argument("-d", "--debug",      action="store_true", default=False, help="Debug mode")
+    parser.add_argument("-i", "--input",      action="store", help="Input signal file (ROOT Minituple)")
+    parser.add_argument("--sig-table",        action="store", default=None, help="Signal yields from this signal_efficiency_table.py table (must hold every grid cut pair) instead of the signal tree")
+    parser.add_argument("-t", "--template",   action="store", default=default_template_datacard, help="Input template datacard (for --full-limits)")
+    parser.add_argument("-f", "--filetag",    action="store", help="Input file tag", required=True)
+    parser.add_argument("-c", "--ctau",       action="store", help="Input file lifetime (with --input)")
+    parser.add_argument("-o", "--output-dir", action="store", default="output", help="Output directory")
+    parser.add_argument("-l", "--lifetimes",  action="store", default="1000", help="Comma separated target lifetimes in mm")
+    parser.add_argument("--data-file",        action="store", default=default_data_file, help="Data minituple of the background prediction")
+    parser.add_argument("--lumi-sf",          action="store", type=float, default=default_lumi_sf, help="Luminosity scale factor of the data file")
+    parser.add_argument("--incl-scores",      action="store", default="0.5:0.99:50", help="Inclusive score cuts, 'start:stop:n' or comma separated")
+    parser.add_argument("--depth-scores",     action="store", default="0.5:0.99:50", help="Depth score cuts, 'start:stop:n' or comma separated")
+    parser.add_argument("--full-limits",      action="store_true", default=False, help="Also compute full limits for the best grid points")
+    parser.add_argument("-b", "--backend",    action="store", default="combine", choices=limit_backends, help="Limit backend for --full-limits")
+    parser.add_argument("--top",              action="store", type=int, default=10, help="Number of best grid points per lifetime to run full limits on (0: all)")
+    parser.add_argument("-j", "--jobs",       action="store", type=int, default=1, help="Number of combine jobs to run in parallel")
+    parser.add_argument("--combine-timeout",  action="store", type=float, default=None, help="Timeout per combine job in seconds")
+    add_skim_cache_args(parser)
+    add_column_store_args(parser)
+    add_limit_cache_args(parser)
+
+    args = parser.parse_args()
+
+    if args.input is None and args.sig_table is None:
+        parser.error("give the signal as --input or --sig-table")
+    if args.input is not None and args.ctau is None:
+        parser.error("--input needs the lifetime of the sample (--ctau)")
+
+    return args
+
+# ------------------------------------------------------------------------------
+def parse_grid(spec):
+    """ 'start:stop:n' (inclusive linspace) or comma separated values -> sorted unique cut values
+    """
+    if ":" in spec:
+        start, stop, n = spec.split(":")
+        return np.unique( np.round( np.linspace(float(start), float(stop), int(n)), 6 ) )
+    return np.unique( np.array( [float(val) for val in spec.split(",")] ) )
+
+# ------------------------------------------------------------------------------
+def count_above(sorted_values, cuts):
+    """ Number of values strictly above each cut, from an ascending sorted array (binary search)
+    """
+    return len(sorted_values) - np.searchsorted(sorted_values, np.asarray(cuts, dtype=np.float64), side="right")
+
+# ------------------------------------------------------------------------------
+class BkgScan:
+    """ ABCD background prediction at any (incl, depth) cut pair from sorted score arrays
+
+    The CR count does not depend on the cuts, the CR-depth count only on the depth cut and the SR count only
+    on the inclusive cut, so each is a binary search in one sorted array.
+    """
+
+    def __init__(self, columns, lumi_sf, btag_cut=btag_wp):
+        self.lumi_sf = lumi_sf
+
+        self.n_cr = { category: {} for category in btag_categories }
+        self.depth_scores_cr  = { category: {} for category in btag_categories }
+        self.incl_scores_tagged = { category: {} for category in btag_categories }
+
+        for ordering, (jet_depth, jet_incl) in jet_orderings.items():
+
+            tagged      = (columns[jet_depth+"_DepthTagCand"] == 1) & (columns[jet_incl+"_InclTagCand"] == 1)
+            incl_score  = np.asarray(columns[jet_incl+"_scores_inc_train80"], dtype=np.float64)
+            depth_score = np.asarray(columns[jet_depth+"_scores_depth_LLPanywhere"], dtype=np.float64)
+            cr          = tagged & (incl_score < np.float64(incl_score_cr_max))
+
+            for category, mask_category in btag_category_masks(columns, jet_depth, btag_cut).items():
+                mask_cr     = cr if mask_category is None else cr & mask_category
+                mask_tagged = tagged if mask_category is None else tagged & mask_category
+
+                self.n_cr[category][ordering]               = int( np.count_nonzero(mask_cr) )
+                self.depth_scores_cr[category][ordering]    = np.sort( depth_score[mask_cr] )
+                self.incl_scores_tagged[category][ordering] = np.sort( incl_score[mask_tagged] )
+
+    # --------------------------------------------------------------------------
+    def counts(self, incl_score_cut, depth_score_cut, category="incl"):
+        """ Region counts at one cut pair, in the format of regions.count_bkg_regions
+        """
+        counts = {}
+        for ordering in jet_orderings:
+            counts[ordering+"_cr"]       = self.n_cr[category][ordering]
+            counts[ordering+"_cr_depth"] = int( count_above(self.depth_scores_cr[category][ordering], [depth_score_cut])[0] )
+            counts[ordering+"_sr"]       = int( count_above(self.incl_scores_tagged[category][ordering], [incl_score_cut])[0] )
+        return counts
+
+    # --------------------------------------------------------------------------
+    def predictions(self, incl_score_cuts, depth_score_cuts, category="incl"):
+        """ Predicted SR yields on the whole cut grid: {ordering: array (n_incl, n_depth)}
+        """
+        predictions = {}
+        for ordering in jet_orderings:
+            n_sr       = count_above(self.incl_scores_tagged[category][ordering], incl_score_cuts)
+            n_cr_depth = count_above(self.depth_scores_cr[category][ordering], depth_score_cuts)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                predictions[ordering] = self.lumi_sf * n_sr[:, None] * ( n_cr_depth[None, :] / self.n_cr[category][ordering] )
+        return predictions
+
+# ------------------------------------------------------------------------------
+class SigScan:
+    """ Reweighted signal yields on a (incl, depth) cut grid for several lifetimes, from cumulative 2D histograms
+
+    Every event is binned by the number of grid cuts its scores are strictly above, so the yield above a cut pair
+    is a reverse cumulative sum, computed once for the whole grid.
+    """
+
+    def __init__(self, columns, ctau_sample, ctau_targets, incl_score_cuts, depth_score_cuts, block_size=65536):
+        self.incl_score_cuts  = np.asarray(incl_score_cuts, dtype=np.float64)
+        self.depth_score_cuts = np.asarray(depth_score_cuts, dtype=np.float64)
+        self.ctau_targets     = np.asarray(ctau_targets, dtype=np.float64)
+
+        n_incl, n_depth, n_ctau = len(self.incl_score_cuts), len(self.depth_score_cuts), len(self.ctau_targets)
+
+        self.yields = {}
+        for ordering, (jet_depth, jet_incl) in jet_orderings.items():
+
+            tagged = (columns[jet_depth+"_DepthTagCand"] == 1) & (columns[jet_incl+"_InclTagCand"] == 1)
+
+            bin_incl  = np.searchsorted(self.incl_score_cuts, np.asarray(columns[jet_incl+"_scores_inc_train80"][tagged], dtype=np.float64), side="left")
+            bin_depth = np.searchsorted(self.depth_score_cuts, np.asarray(columns[jet_depth+"_scores_depth_LLPanywhere"][tagged], dtype=np.float64), side="left")
+            bin_flat  = bin_incl * (n_depth + 1) + bin_depth
+
+            # Events below every cut never pass, they need no lifetime weights
+            keep     = (bin_incl > 0) & (bin_depth > 0)
+            bin_flat = bin_flat[keep]
+            columns_kept = { name: np.asarray(columns[name])[tagged][keep] for name in ["weight", "LLP0_DecayCtau", "LLP1_DecayCtau"] }
+
+            hist = np.zeros( ( (n_incl + 1) * (n_depth + 1), n_ctau ) )
+            for start in range(0, len(bin_flat), block_size):
+                block   = slice(start, start + block_size)
+                weights = lifetime_weights({ name: values[block] for name, values in columns_kept.items() }, ctau_sample, self.ctau_targets)
+                for i_ctau in range(n_ctau):
+                    hist[:, i_ctau] += np.bincount(bin_flat[block], weights=weights[:, i_ctau], minlength=hist.shape[0])
+
+            hist = hist.reshape(n_incl + 1, n_depth + 1, n_ctau)
+            cumulative = hist[::-1, ::-1].cumsum(axis=0).cumsum(axis=1)[::-1, ::-1]
+
+            # Passing cut i means being in a bin above i
+            self.yields[ordering] = cumulative[1:, 1:, :]
+
+    # --------------------------------------------------------------------------
+    @classmethod
+    def from_table(cls, table, ctau_targets, incl_score_cuts, depth_score_cuts):
+        """ Yields on the cut grid looked up in a SignalEfficiencyTable, without the signal tree
+        """
+        scan = cls.__new__(cls)
+        scan.incl_score_cuts  = np.asarray(incl_score_cuts, dtype=np.float64)
+        scan.depth_score_cuts = np.asarray(depth_score_cuts, dtype=np.float64)
+        scan.ctau_targets     = np.asarray(ctau_targets, dtype=np.float64)
+
+        scan.yields = { ordering: np.zeros( (len(scan.incl_score_cuts), len(scan.depth_score_cuts), len(scan.ctau_targets)) ) for ordering in jet_orderings }
+        for i_incl, incl_score_cut in enumerate(scan.incl_score_cuts):
+            for i_depth, depth_score_cut in enumerate(scan.depth_score_cuts):
+                for ordering, yields in table.yields(scan.ctau_targets, incl_score_cut, depth_score_cut).items():
+                    scan.yields[ordering][i_incl, i_depth] = yields
+
+        return scan
+
+    # --------------------------------------------------------------------------
+    def lookup(self, incl_score_cut, depth_score_cut):
+        """ {ordering: yields per lifetime} at one grid cut pair (binary search on the grid)
+        """
+        i_incl  = np.searchsorted(self.incl_score_cuts, np.float64(incl_score_cut))
+        i_depth = np.searchsorted(self.depth_score_cuts, np.float64(depth_score_cut))
+        if i_incl == len(self.incl_score_cuts) or self.incl_score_cuts[i_incl] != np.float64(incl_score_cut) \
+           or i_depth == len(self.depth_score_cuts) or self.depth_score_cuts[i_depth] != np.float64(depth_score_cut):
+            raise ValueError("cut pair ({0}, {1}) is not on the scan grid".format(incl_score_cut, depth_score_cut))
+
+        return { ordering: yields[i_incl, i_depth] for ordering, yields in self.yields.items() }
+
+# ------------------------------------------------------------------------------
+def asimov_significance(nsig, nbkg):
+    """ Expected discovery significance of independent counting bins, sum over the last axis
+    """
+    nsig = np.asarray(nsig, dtype=np.float64)
+    nbkg = np.asarray(nbkg, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z2 = 2. * ( (nsig + nbkg) * np.log1p(nsig / nbkg) - nsig )
+    z2 = np.where( (nbkg > 0) & (nsig > 0), z2, 0. )
+    return np.sqrt( z2.sum(axis=-1) )
+
+# ------------------------------------------------------------------------------
+def expected_limit_asimov(nsig, nbkg, quantile=0.5, cl=0.95, n_iterations=60):
+    """ Asymptotic expected CLs upper limit on the signal strength, without systematics
+
+    Solves sqrt(q_mu,A) = Phi^-1(1 - alpha Phi(N)) + N on the background-only Asimov dataset, by bisection in
+    log(mu) vectorized over all points; bins are summed over the last axis. inf where there is no signal.
+    """
+    nsig = np.asarray(nsig, dtype=np.float64)
+    nbkg = np.asarray(nbkg, dtype=np.float64)
+
+    n_sigma = norm.ppf(quantile)
+    target  = ( norm.ppf(1. - (1. - cl) * norm.cdf(n_sigma)) + n_sigma )**2
+
+    def q_asimov(mu):
+        mu_s = mu[..., None] * nsig
+        with np.errstate(divide="ignore", invalid="ignore"):
+            term = np.where( nbkg > 0, mu_s - nbkg * np.log1p(mu_s / nbkg), mu_s )
+        return 2. * np.where( nsig > 0, term, 0. ).sum(axis=-1)
+
+    shape   = nsig.shape[:-1]
+    log_low  = np.full(shape, -12.)
+    log_high = np.full(shape, 12.)
+    for _ in range(n_iterations):
+        log_mid = 0.5 * (log_low + log_high)
+        above   = q_asimov(np.exp(log_mid)) > target
+        log_high = np.where(above, log_mid, log_high)
+        log_low  = np.where(above, log_low, log_mid)
+
+    limit = np.exp(log_high)
+    return np.where( q_asimov(limit) > target, limit, np.inf )
+
+# ------------------------------------------------------------------------------
+def json_grid(values):
+    """ Nested lists of a grid for json, with inf / NaN (empty CR, no signal) written as null (not valid json)
+    """
+    values = np.asarray(values, dtype=np.float64)
+    return np.where( np.isfinite(values), values, None ).tolist()
+
+# ------------------------------------------------------------------------------
+def main():
+
+    # ----- Process Inputs ----- #
+
+    args = parseArgs()
+
+    incl_score_cuts  = parse_grid(args.incl_scores)
+    depth_score_cuts = parse_grid(args.depth_scores)
+    lifetimes        = args.lifetimes.split(",")
+    ctau_targets     = [float(ctau) for ctau in lifetimes]
+
+    read_columns = column_reader(args)
+
+    print("Scanning", len(incl_score_cuts), "x", len(depth_score_cuts), "cut pairs for", len(lifetimes), "lifetimes")
+
+    # ----- Precompute ----- #
+
+    print("Reading in data tree...")
+    scan_bkg = BkgScan(read_columns(args.data_file, data_branches), args.lumi_sf)
+
+    if args.sig_table is not None:
+        print("Reading in signal table...", args.sig_table)
+        scan_sig = SigScan.from_table(SignalEfficiencyTable.load(args.sig_table), ctau_targets, incl_score_cuts, depth_score_cuts)
+    else:
+        print("Reading in signal tree...")
+        scan_sig = SigScan(read_columns(args.input, signal_branches), args.ctau, ctau_targets, incl_score_cuts, depth_score_cuts)
+
+    # ----- Grid ----- #
+
+    nevents_bkg = scan_bkg.predictions(incl_score_cuts, depth_score_cuts)
+    nevents_sig = { ordering: yields * 100. for ordering, yields in scan_sig.yields.items() } # 100 to convert from minituple % --> net fraction
+
+    # (incl, depth, ctau, bin)
+    nsig = np.stack( [nevents_sig["ljdc"], nevents_sig["sjdc"]], axis=-1 )
+    nbkg = np.stack( [nevents_bkg["ljdc"], nevents_bkg["sjdc"]], axis=-1 )[:, :, None, :]
+    nbkg = np.broadcast_to(nbkg, nsig.shape)
+
+    z_asimov         = asimov_significance(nsig, nbkg)
+    limit_exp_approx = expected_limit_asimov(nsig, nbkg)
+
+    data = {}
+    data["incl_scores"]      = incl_score_cuts.tolist()
+    data["depth_scores"]     = depth_score_cuts.tolist()
+    data["ctaus"]            = ctau_targets
+    data["nevents_bkg_ljdc"] = json_grid(nevents_bkg["ljdc"])
+    data["nevents_bkg_sjdc"] = json_grid(nevents_bkg["sjdc"])
+    data["nevents_sig_ljdc"] = json_grid(nevents_sig["ljdc"])
+    data["nevents_sig_sjdc"] = json_grid(nevents_sig["sjdc"])
+    data["z_asimov"]         = json_grid(z_asimov)
+    data["limit_exp_approx"] = json_grid(limit_exp_approx)
+
+    # ----- Summary ----- #
+
+    best_points = {}
+    for i_ctau, ctau_target in enumerate(lifetimes):
+        order = np.argsort( limit_exp_approx[:, :, i_ctau], axis=None )
+        if args.top > 0: order = order[:args.top]
+        best_points[ctau_target] = [ np.unravel_index(flat, limit_exp_approx.shape[:2]) for flat in order ]
+
+        print( "--------------------------------------" )
+        print( "CTau Target:", ctau_target )
+        print( "  incl   depth   Nsig(ljdc, sjdc)      Nbkg(ljdc, sjdc)      Z_A     exp. limit (no syst.)" )
+        for i_incl, i_depth in best_points[ctau_target][:10]:
+            print( "  {0:.3f}  {1:.3f}   {2:8.3g} {3:8.3g}   {4:8.3g} {5:8.3g}   {6:6.3f}  {7:.4g}".format(
+                incl_score_cuts[i_incl], depth_score_cuts[i_depth],
+                nevents_sig["ljdc"][i_incl, i_depth, i_ctau], nevents_sig["sjdc"][i_incl, i_depth, i_ctau],
+                nevents_bkg["ljdc"][i_incl, i_depth], nevents_bkg["sjdc"][i_incl, i_depth],
+                z_asimov[i_incl, i_depth, i_ctau], limit_exp_approx[i_incl, i_depth, i_ctau] ) )
+
+    # ----- Full Limits (optional) ----- #
+
+    if args.full_limits:
+
+        datacard_dir = os.path.join(args.output_dir, "scan_datacards", args.filetag)
+        os.makedirs(datacard_dir, exist_ok=True)
+
+        points = []
+        combine_jobs = []
+        for i_ctau, ctau_target in enumerate(lifetimes):
+            for i_incl, i_depth in best_points[ctau_target]:
+                incl_score_cut, depth_score_cut = incl_score_cuts[i_incl], depth_score_cuts[i_depth]
+
+                bkg_predictions = {}
+                for category in btag_categories:
+                    predictions = scan_bkg.predictions([incl_score_cut], [depth_score_cut], category)
+                    bkg_predictions[category] = ( predictions["ljdc"][0, 0], predictions["sjdc"][0, 0] )
+
+                name = "{0}_{1}_{2}__{3}".format(args.filetag, incl_score_cut, depth_score_cut, ctau_target)
+                output_file = os.path.join(datacard_dir, "datacard_{0}.txt".format(name))
+                replacements = datacard_replacements(nevents_sig["ljdc"][i_incl, i_depth, i_ctau], nevents_sig["sjdc"][i_incl, i_depth, i_ctau], bkg_predictions)
+                render_datacard(args.template, output_file, replacements)
+
+                points.append( (float(incl_score_cut), float(depth_score_cut), float(ctau_target)) )
+                combine_jobs.append( (output_file, name) )
+
+        print( "Computing", len(combine_jobs), "limits..." )
+        limit_results = run_limit_jobs(combine_jobs, os.path.join(args.output_dir, "combine_work"), backend=args.backend, n_jobs=args.jobs, timeout=args.combine_timeout,
+                                       cache=limit_cache_from_args(args))
+
+        data["full_limits"] = []
+        for (incl_score_cut, depth_score_cut, ctau_target), result in zip(points, limit_results):
+            limit_obs, limits_exp = result["limit_obs"], result["limits_exp"]
+            if limit_obs is None and args.debug: print( result["stdout"], result["stderr"] )
+            data["full_limits"].append( {
+                "incl_score": incl_score_cut,
+                "depth_score": depth_score_cut,
+                "ctau": ctau_target,
+                "limit_obs": limit_obs * SF_temp if limit_obs is not None else -1,
+                "limits_exp": { val: limits_exp[val] * SF_temp if limits_exp[val] is not None else -1 for val in expected_percent },
+            } )
+
+    # ----- Output ----- #
+
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    outfile_path = os.path.join( args.output_dir, "{0}_scan.json".format(args.filetag) )
+
+    with open(outfile_path, "w") as f:
+        json.dump(data, f, indent=2)
+
+    print( "--------------------------------------" )
+    print( "Json file written to:", outfile_path )
+
+if __name__ == '__main__':
+    main()
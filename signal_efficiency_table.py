@@ -0,0 +1,286 @@
+import argparse
+import os
+import json
+import hashlib
+
+import numpy as np
+
+from lifetime_sampling import ctau_label
+from signal_samples import samples_from_glob
+from regions import signal_branches, jet_orderings, default_preselection, load_columns, load_column_chunks, tree_entries, signal_region_events, concatenate_columns
+from skim_cache import add_skim_cache_args
+from entry_store import input_identity
+from column_store import add_column_store_args, column_reader
+
+default_cache_dir = os.environ.get("HCAL_LLP_SIG_TABLE_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "hcal_llp_sig_tables"))
+
+# Bump when the weighting or the table layout changes, so old tables are never picked up
+table_format_version = 1
+
+# Dense lifetime grid of the table (mm)
+default_ctau_range  = "1:100000"
+default_ctau_points = 251
+
+# ------------------------------------------------------------------------------
+def parseArgs():
+    """ Parse command-line arguments
+    """
+    parser = argparse.ArgumentParser(
+        add_help=True,
+        description='Signal yield (efficiency) table vs lifetime from several source-lifetime samples of one mass point'
+    )
+
+    parser.add_argument("-s", "--sample",     action="append", nargs=2, metavar=("INPUT", "CTAU"), default=[], help="Signal minituple and its lifetime in mm (repeatable)")
+    parser.add_argument("-g", "--glob",       action="store", default=None, help="Glob of signal minituples named minituple_<name>_CTau<ctau>_*.root (one mass point)")
+    parser.add_argument("-o", "--output",     action="store", required=True, help="Output table (npz)")
+    parser.add_argument("--cut-pairs",        action="store", default="0.9:0.8", help="Comma separated 'incl:depth' score cut pairs")
+    parser.add_argument("--incl-scores",      action="store", default=None, help="Inclusive score cut grid as in score_scan ('start:stop:n' or comma separated), with --depth-scores")
+    parser.add_argument("--depth-scores",     action="store", default=None, help="Depth score cut grid as in score_scan, with --incl-scores (replaces --cut-pairs)")
+    parser.add_argument("--ctau-range",       action="store", default=default_ctau_range, help="Table lifetime range in mm, 'min:max'")
+    parser.add_argument("--ctau-points",      action="store", type=int, default=default_ctau_points, help="Number of log-spaced table lifetimes")
+    parser.add_argument("--chunk-size",       action="store", type=int, default=None, help="Stream the trees in chunks of this many entries")
+    parser.add_argument("--table-cache-dir",  action="store", default=default_cache_dir, help="Directory of the table cache")
+    parser.add_argument("--no-table-cache",   action="store_true", default=False, help="Bypass the table cache")
+    add_skim_cache_args(parser)
+    add_column_store_args(parser)
+
+    args = parser.parse_args()
+
+    if not args.sample and args.glob is None:
+        parser.error("give signal samples with --sample or --glob")
+    if (args.incl_scores is None) != (args.depth_scores is None):
+        parser.error("--incl-scores and --depth-scores go together")
+
+    return args
+
+# ------------------------------------------------------------------------------
+def mixture_weights(columns, source_index, source_ctaus, source_fractions, ctau_targets):
+    """ Event weights for every target lifetime (events x lifetimes) of events pooled from several source lifetimes
+
+    Balance-heuristic multiple importance sampling: the pooled events are treated as drawn from the mixture
+    q = sum_k c_k p(t | ctau_k) of the source decay-length densities, with c_k = N_k / N_tot the share of
+    generated events of sample k. An event of sample k gets
+        weight * c_k * p(t | ctau_target) / q(t),
+    which is the single-sample lifetime reweighting for one source, and stays bounded wherever any source
+    sample covers the decay lengths. Both LLPs enter p through the summed decay length, as in lifetime_weights.
+    """
+    ctau_targets = np.asarray(ctau_targets, dtype=np.float64)
+    ctau_sources = np.asarray(source_ctaus, dtype=np.float64)
+
+    weight = np.asarray(columns["weight"], dtype=np.float64) * np.asarray(source_fractions)[source_index]
+    decay  = 10. * ( np.asarray(columns["LLP0_DecayCtau"], dtype=np.float64) + np.asarray(columns["LLP1_DecayCtau"], dtype=np.float64) ) # mm
+
+    # log( q / p_target ) = logsumexp_k [ log c_k + 2 log(ctau_target / ctau_k) - decay * (1/ctau_k - 1/ctau_target) ], events x targets x sources
+    log_terms = np.log(source_fractions)[None, None, :] + 2. * np.log( ctau_targets[:, None] / ctau_sources[None, :] )[None, :, :] \
+              - decay[:, None, None] * ( 1. / ctau_sources[None, :] - 1. / ctau_targets[:, None] )[None, :, :]
+    log_max = log_terms.max(axis=2)
+    log_q_over_p = log_max + np.log( np.exp(log_terms - log_max[:, :, None]).sum(axis=2) )
+
+    return weight[:, None] * np.exp( -log_q_over_p )
+
+# ------------------------------------------------------------------------------
+def score_bins(columns, jet_depth, jet_incl, incl_score_cuts, depth_score_cuts):
+    """ (incl bin, depth bin) of every event for one jet ordering: the number of cuts each score is strictly above
+
+    An event passes the cut pair (i, j) when its bins are above i and j. Events without both tags get bin 0.
+    """
+    tagged = (columns[jet_depth+"_DepthTagCand"] == 1) & (columns[jet_incl+"_InclTagCand"] == 1)
+
+    bin_incl  = np.searchsorted(incl_score_cuts, np.asarray(columns[jet_incl+"_scores_inc_train80"], dtype=np.float64), side="left")
+    bin_depth = np.searchsorted(depth_score_cuts, np.asarray(columns[jet_depth+"_scores_depth_LLPanywhere"], dtype=np.float64), side="left")
+
+    return np.where(tagged, bin_incl, 0), np.where(tagged, bin_depth, 0)
+
+def fill_histogram(hist, bin_flat, weights):
+    """ Add the rows of weights (events x lifetimes) to the flat bins of hist (bins x lifetimes)
+    """
+    for i_ctau in range(hist.shape[1]):
+        hist[:, i_ctau] += np.bincount(bin_flat, weights=weights[:, i_ctau], minlength=hist.shape[0])
+
+# ------------------------------------------------------------------------------
+def build_table(samples, cut_pairs, ctau_grid, read_columns=load_columns, chunk_size=None, block_size=16384):
+    """ Mixture-weighted signal yields with statistical errors, for every cut pair and table lifetime
+
+    samples: [(input, ctau_source)]. Only the events in the signal regions of the loosest cuts are kept, so
+    memory is set by the signal region size. Yields are in the units of calculate_sig_yields (minituple %).
+
+    As in score_scan.SigScan, every event is binned once by the number of incl and depth cuts it passes, into
+    cumulative 2D histograms of w and w^2 per lifetime; every cut pair is then read off the histograms. The
+    union of both signal regions (for n_eff) is LJDC + SJDC - both, with an event in both regions at the cut
+    pairs below its lower incl and lower depth bin.
+    """
+    cut_pairs = np.asarray(cut_pairs, dtype=np.float64).reshape(-1, 2)
+    incl_loose, depth_loose = cut_pairs[:, 0].min(), cut_pairs[:, 1].min()
+
+    columns_list, source_index, entries = [], [], []
+    for i_sample, (infilepath, ctau_source) in enumerate(samples):
+        print( "Reading in signal tree...", infilepath, "(ctau {0} mm)".format(ctau_source) )
+        if chunk_size:
+            columns = concatenate_columns([ signal_region_events(columns_chunk, incl_loose, depth_loose)
+                                            for columns_chunk in load_column_chunks(infilepath, signal_branches, chunk_size) ])
+        else:
+            columns = signal_region_events(read_columns(infilepath, signal_branches), incl_loose, depth_loose)
+        columns_list.append(columns)
+        source_index.append( np.full(len(columns["weight"]), i_sample) )
+        entries.append( tree_entries(infilepath) )
+
+    columns = concatenate_columns(columns_list)
+    source_index = np.concatenate(source_index)
+    source_ctaus = np.array([ float(ctau) for _, ctau in samples ])
+    source_fractions = np.array(entries, dtype=np.float64) / np.sum(entries)
+
+    # Histogram axes: the distinct cut values of each score
+    incl_score_cuts, i_incl  = np.unique(cut_pairs[:, 0], return_inverse=True)
+    depth_score_cuts, i_depth = np.unique(cut_pairs[:, 1], return_inverse=True)
+    shape = (len(incl_score_cuts) + 1, len(depth_score_cuts) + 1)
+
+    bins = { ordering: score_bins(columns, jet_depth, jet_incl, incl_score_cuts, depth_score_cuts) for ordering, (jet_depth, jet_incl) in jet_orderings.items() }
+    bins["both"] = ( np.minimum(bins["ljdc"][0], bins["sjdc"][0]), np.minimum(bins["ljdc"][1], bins["sjdc"][1]) )
+    bins_flat = { name: np.ravel_multi_index(bins_name, shape) for name, bins_name in bins.items() }
+
+    hists = { name: { "sumw": np.zeros( (shape[0] * shape[1], len(ctau_grid)) ), "sumw2": np.zeros( (shape[0] * shape[1], len(ctau_grid)) ) } for name in bins }
+
+    # Blocks of events keep the events x lifetimes x sources array small
+    n_events = len(columns["weight"])
+    for start in range(0, n_events, block_size):
+        block = slice(start, start + block_size)
+        weights = mixture_weights({ name: columns[name][block] for name in ["weight", "LLP0_DecayCtau", "LLP1_DecayCtau"] },
+                                  source_index[block], source_ctaus, source_fractions, ctau_grid)
+        weights2 = weights**2
+        for name, bin_flat in bins_flat.items():
+            fill_histogram(hists[name]["sumw"], bin_flat[block], weights)
+            fill_histogram(hists[name]["sumw2"], bin_flat[block], weights2)
+
+    # Passing cut i means being in a bin above i: reverse cumulative sums, read at (i + 1, j + 1) for every cut pair
+    at_cuts = {}
+    for name in hists:
+        for quantity, hist in hists[name].items():
+            hist = hist.reshape(shape[0], shape[1], len(ctau_grid))
+            cumulative = hist[::-1, ::-1].cumsum(axis=0).cumsum(axis=1)[::-1, ::-1]
+            at_cuts[name, quantity] = cumulative[i_incl + 1, i_depth + 1]
+
+    table = { "ctaus": np.asarray(ctau_grid, dtype=np.float64), "cut_pairs": cut_pairs,
+              "source_ctaus": source_ctaus, "source_entries": np.array(entries), "sources": np.array([ str(infilepath) for infilepath, _ in samples ]) }
+    for ordering in jet_orderings:
+        table["yield_" + ordering] = at_cuts[ordering, "sumw"]
+        table["error_" + ordering] = np.sqrt( np.maximum(at_cuts[ordering, "sumw2"], 0.) )
+
+    # Effective number of signal region events behind every entry (small where no source covers the lifetime)
+    sumw  = at_cuts["ljdc", "sumw"] + at_cuts["sjdc", "sumw"] - at_cuts["both", "sumw"]
+    sumw2 = at_cuts["ljdc", "sumw2"] + at_cuts["sjdc", "sumw2"] - at_cuts["both", "sumw2"]
+    table["n_eff"] = np.divide(sumw**2, sumw2, out=np.zeros_like(sumw), where=sumw2 > 0)
+
+    return SignalEfficiencyTable(table)
+
+# ------------------------------------------------------------------------------
+class SignalEfficiencyTable:
+    """ LJDC/SJDC signal yields (minituple %) and their statistical errors on a dense lifetime grid, per cut pair
+
+    Lookups interpolate linearly in log(ctau) between the table lifetimes.
+    """
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls({ name: f[name] for name in f.files })
+
+    def save(self, path):
+        if os.path.dirname(path): os.makedirs(os.path.dirname(path), exist_ok=True)
+        path_temp = path + ".tmp{0}.npz".format(os.getpid())
+        np.savez(path_temp, **self.arrays)
+        os.replace(path_temp, path)
+        return path
+
+    # --------------------------------------------------------------------------
+    def cut_index(self, incl_score_cut, depth_score_cut):
+        matches = np.flatnonzero( np.isclose(self.arrays["cut_pairs"][:, 0], float(incl_score_cut)) & np.isclose(self.arrays["cut_pairs"][:, 1], float(depth_score_cut)) )
+        if len(matches) == 0:
+            raise ValueError("signal table has no cut pair ({0}, {1}), available: {2}".format(incl_score_cut, depth_score_cut, self.arrays["cut_pairs"].tolist()))
+        return matches[0]
+
+    def lookup(self, name, ctau_targets, incl_score_cut, depth_score_cut):
+        ctau_targets = np.asarray(ctau_targets, dtype=np.float64)
+        ctaus = self.arrays["ctaus"]
+        if ctau_targets.min() < ctaus[0] * (1. - 1e-9) or ctau_targets.max() > ctaus[-1] * (1. + 1e-9):
+            raise ValueError("target lifetimes outside the signal table range [{0:g}, {1:g}] mm".format(ctaus[0], ctaus[-1]))
+
+        return np.interp( np.log(ctau_targets), np.log(ctaus), self.arrays[name][self.cut_index(incl_score_cut, depth_score_cut)] )
+
+    def yields(self, ctau_targets, incl_score_cut, depth_score_cut):
+        """ Same as calculate_sig_yields: {"ljdc": array, "sjdc": array}, one entry per target lifetime
+        """
+        return { ordering: self.lookup("yield_" + ordering, ctau_targets, incl_score_cut, depth_score_cut) for ordering in jet_orderings }
+
+    def errors(self, ctau_targets, incl_score_cut, depth_score_cut):
+        return { ordering: self.lookup("error_" + ordering, ctau_targets, incl_score_cut, depth_score_cut) for ordering in jet_orderings }
+
+# ------------------------------------------------------------------------------
+def table_key(samples, cut_pairs, ctau_grid):
+    """ Cache key of a table: input identities and lifetimes, cuts, lifetime grid, preselection and format version
+    """
+    identities = [ input_identity(infilepath) for infilepath, _ in samples ]
+    if None in identities: return None
+
+    description = {
+        "format": table_format_version,
+        "inputs": [ [identity, float(ctau)] for identity, (_, ctau) in zip(identities, samples) ],
+        "cut_pairs": np.asarray(cut_pairs, dtype=np.float64).tolist(),
+        "ctaus": np.asarray(ctau_grid, dtype=np.float64).tolist(),
+        "preselection": default_preselection,
+    }
+
+    return hashlib.sha256( json.dumps(description, sort_keys=True).encode() ).hexdigest()
+
+def cached_table(samples, cut_pairs, ctau_grid, cache_dir=default_cache_dir, read_columns=load_columns, chunk_size=None):
+    """ build_table, served from the table cache when the inputs and settings are unchanged (cache_dir None: no cache)
+    """
+    key = table_key(samples, cut_pairs, ctau_grid) if cache_dir else None
+    path = os.path.join(cache_dir, key + ".npz") if key else None
+
+    if path and os.path.exists(path):
+        print( "Signal table cache: hit", path )
+        return SignalEfficiencyTable.load(path)
+
+    table = build_table(samples, cut_pairs, ctau_grid, read_columns, chunk_size)
+    if path: table.save(path)
+
+    return table
+
+# ------------------------------------------------------------------------------
+def main():
+
+    args = parseArgs()
+
+    samples = [ (infilepath, float(ctau)) for infilepath, ctau in args.sample ]
+    if args.glob:
+        samples += [ (sample["input"], float(sample["ctau"])) for sample in samples_from_glob(args.glob) ]
+
+    if args.incl_scores is not None:
+        from score_scan import parse_grid
+        cut_pairs = [ [incl_score_cut, depth_score_cut] for incl_score_cut in parse_grid(args.incl_scores) for depth_score_cut in parse_grid(args.depth_scores) ]
+    else:
+        cut_pairs = [ [ float(cut) for cut in pair.split(":") ] for pair in args.cut_pairs.split(",") ]
+    ctau_min, ctau_max = [ float(ctau) for ctau in args.ctau_range.split(":") ]
+    ctau_grid = np.logspace( np.log10(ctau_min), np.log10(ctau_max), args.ctau_points )
+
+    table = cached_table(samples, cut_pairs, ctau_grid, None if args.no_table_cache else args.table_cache_dir, column_reader(args), args.chunk_size)
+    table.save(args.output)
+
+    # Summary at the source lifetimes and the decades of the grid
+    ctaus_summary = sorted( set( [ctau for _, ctau in samples] + [ ctau for ctau in 10.**np.arange(0, 6) if ctau_min <= ctau <= ctau_max ] ) )
+    for incl_score_cut, depth_score_cut in cut_pairs[:10]:
+        yields = table.yields(ctaus_summary, incl_score_cut, depth_score_cut)
+        errors = table.errors(ctaus_summary, incl_score_cut, depth_score_cut)
+        print( "Cuts (incl, depth):", incl_score_cut, depth_score_cut )
+        for i_ctau, ctau in enumerate(ctaus_summary):
+            print( "  ctau {0:>8s} mm  LJDC {1:.4g} +- {2:.2g}  SJDC {3:.4g} +- {4:.2g}".format(ctau_label(ctau), yields["ljdc"][i_ctau], errors["ljdc"][i_ctau],
+                   yields["sjdc"][i_ctau], errors["sjdc"][i_ctau]) )
+
+    if len(cut_pairs) > 10: print( "  ... ({0} cut pairs)".format(len(cut_pairs)) )
+    print( "Signal table written to:", args.output )
+
+if __name__ == '__main__':
+    main()
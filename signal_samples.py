@@ -0,0 +1,52 @@
+import os
+import re
+import json
+import glob
+
+# Signal sample lists of the batch driver and campaigns (no ROOT or analysis imports)
+
+# ------------------------------------------------------------------------------
+def read_manifest(path):
+    """ Signal samples [{"input", "filetag", "ctau"}] from a json list or a whitespace separated text file
+
+    Json entries may also give a "sig_table" (signal_efficiency_table.py) to take the signal yields from, and
+    "lifetimes" (list or comma separated, mm) to override the target lifetimes of that sample.
+    """
+    if path.endswith(".json"):
+        with open(path) as f:
+            samples = json.load(f)
+        return [ { "input": sample["input"], "filetag": sample["filetag"], "ctau": str(sample["ctau"]), "sig_table": sample.get("sig_table"),
+                   "lifetimes": lifetime_list(sample.get("lifetimes")) } for sample in samples ]
+
+    samples = []
+    with open(path) as f:
+        for line in f:
+            line = line.split("#")[0].strip()
+            if line == "": continue
+            infilepath, filetag, ctau = line.split()
+            samples.append( { "input": infilepath, "filetag": filetag, "ctau": ctau } )
+    return samples
+
+# ------------------------------------------------------------------------------
+def lifetime_list(lifetimes):
+    """ Target lifetimes as a list of strings (as combine_wrapper -l) from a list or a comma separated string (None: None)
+    """
+    if lifetimes is None: return None
+    if isinstance(lifetimes, str): lifetimes = lifetimes.split(",")
+    return [ str(ctau).strip() for ctau in lifetimes ]
+
+# ------------------------------------------------------------------------------
+def samples_from_glob(pattern):
+    """ Signal samples from file names like minituple_HToSSTo4B_125_50_CTau3000_scores.root
+
+    The filetag keeps the source lifetime (HToSSTo4B_125_50_CTau3000), so samples of one mass point do not
+    overwrite each other's outputs.
+    """
+    samples = []
+    for infilepath in sorted( glob.glob(pattern) ):
+        match = re.search(r"minituple_(.+_CTau(\d+))", os.path.basename(infilepath))
+        if not match:
+            print("WARNING: cannot get filetag and ctau from", infilepath, "-- skipped")
+            continue
+        samples.append( { "input": infilepath, "filetag": match.group(1), "ctau": match.group(2) } )
+    return samples
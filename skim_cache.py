@@ -0,0 +1,84 @@
+import os
+
+import numpy as np
+
+from regions import load_columns, default_preselection
+from entry_store import EntryStore
+
+default_cache_dir   = os.environ.get("HCAL_LLP_SKIM_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "hcal_llp_skims"))
+default_max_size_gb = 20.
+
+# Bump when the on-disk layout changes, so old entries are never picked up
+cache_format_version = 1
+
+# ------------------------------------------------------------------------------
+class SkimCache(EntryStore):
+    """ Content-addressed on-disk cache of preselected columns
+
+    Each entry is a directory named by the hash of (input identity, branch list, preselection, tree name),
+    holding one .npy file per branch (memory-mapped on load) and a meta.json. The meta.json mtime tracks
+    the last access, entries are evicted least-recently-used first once the cache exceeds max_size_gb.
+    """
+
+    label = "Skim cache"
+    format_version = cache_format_version
+
+    def __init__(self, cache_dir=default_cache_dir, max_size_gb=default_max_size_gb, checksum=False):
+        super().__init__(cache_dir, max_size_gb, checksum)
+
+    # --------------------------------------------------------------------------
+    def load_columns(self, infilepath, branches, preselection=default_preselection, treename="NoSel"):
+        """ Same as regions.load_columns, but served from the cache when the inputs are unchanged
+        """
+        key = self.key(infilepath, branches, preselection, treename)
+        if key is None:
+            print("Skim cache: cannot identify", infilepath, "-- not cached")
+            return load_columns(infilepath, branches, preselection, treename)
+
+        columns = self.get(key, branches)
+        if columns is not None:
+            print("Skim cache: hit for", infilepath)
+            return columns
+
+        print("Skim cache: miss for", infilepath, "(this may take a few minutes)")
+        columns = load_columns(infilepath, branches, preselection, treename)
+        self.publish(key, columns, { "input": os.path.abspath(infilepath), "preselection": preselection, "treename": treename })
+
+        return columns
+
+    # --------------------------------------------------------------------------
+    def get(self, key, branches):
+
+        entry = self.entry(key)
+        if entry is None: return None
+
+        return { name: np.load(os.path.join(entry, name+".npy"), mmap_mode="r") for name in branches }
+
+    # --------------------------------------------------------------------------
+    def write_columns(self, entry, columns, meta):
+
+        for name, values in columns.items():
+            np.save(os.path.join(entry, name+".npy"), np.ascontiguousarray(values))
+
+        meta["nbytes"] = sum( int(values.nbytes) for values in columns.values() )
+
+# ------------------------------------------------------------------------------
+def add_skim_cache_args(parser):
+    """ Command-line options of the skim cache, shared by the scripts reading minituples
+    """
+    parser.add_argument("--skim-cache-dir",      action="store", default=default_cache_dir, help="Directory of the preselected skim cache")
+    parser.add_argument("--skim-cache-max-gb",   action="store", type=float, default=default_max_size_gb, help="Skim cache size limit (least recently used skims are evicted)")
+    parser.add_argument("--skim-cache-checksum", action="store_true", default=False, help="Also key the skim cache on the input file checksums (slow)")
+    parser.add_argument("--no-skim-cache",       action="store_true", default=False, help="Bypass the skim cache")
+    parser.add_argument("--purge-skim-cache",    action="store_true", default=False, help="Empty the skim cache before running")
+
+# ------------------------------------------------------------------------------
+def skim_cache_reader(args):
+    """ Column reader matching the skim cache options: SkimCache.load_columns, or regions.load_columns if bypassed
+    """
+    if args.no_skim_cache: return load_columns
+
+    skim_cache = SkimCache(args.skim_cache_dir, args.skim_cache_max_gb, args.skim_cache_checksum)
+    if args.purge_skim_cache: skim_cache.purge()
+
+    return skim_cache.load_columns
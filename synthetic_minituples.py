@@ -0,0 +1,124 @@
+import argparse
+import os
+import shutil
+
+import numpy as np
+
+from regions import data_branches, signal_branches
+
+# Every synthetic tree carries all branches read by the wrapper, for data and signal alike
+minituple_branches = ["Pass_PreSel"] + sorted( set(data_branches + signal_branches) )
+
+default_chunk_size = 10**7
+
+# Sum of the signal weights: the wrapper's signal yields are 100 x the summed weights, so ~1000 events before cuts
+default_signal_norm = 10.
+
+# ------------------------------------------------------------------------------
+def parseArgs():
+    """ Parse command-line arguments
+    """
+    parser = argparse.ArgumentParser(
+        add_help=True,
+        description='Write synthetic NoSel minituples (data or signal) with the branches read by the combine wrapper'
+    )
+
+    parser.add_argument("-o", "--output",     action="store", required=True, help="Output ROOT file")
+    parser.add_argument("-n", "--events",     action="store", type=float, default=1e6, help="Number of events (tree entries)")
+    parser.add_argument("-k", "--kind",       action="store", default="data", choices=["data", "signal"], help="Background-like data or LLP signal")
+    parser.add_argument("-c", "--ctau",       action="store", type=float, default=1000., help="Signal proper lifetime in mm")
+    parser.add_argument("--signal-norm",      action="store", type=float, default=default_signal_norm, help="Sum of the signal weights")
+    parser.add_argument("-s", "--seed",       action="store", type=int, default=1, help="Random seed")
+    parser.add_argument("--chunk-size",       action="store", type=int, default=default_chunk_size, help="Events generated and written at a time")
+
+    args = parser.parse_args()
+
+    return args
+
+# ------------------------------------------------------------------------------
+def generate_columns(n_events, kind="data", ctau=1000., rng=None, signal_norm=default_signal_norm):
+    """ One chunk of synthetic minituple columns as numpy arrays
+
+    Data: most events fail the preselection or sit at low scores, so the ABCD control regions are well
+    populated and the signal region is sparse. Signal: decay lengths (cm) are exponential with the proper
+    lifetime ctau (mm), jets whose LLP decays in the calorimeters get high depth scores, and every event has
+    weight signal_norm/n_events.
+    """
+    rng = np.random.default_rng(rng)
+
+    columns = {}
+    columns["Pass_PreSel"] = ( rng.random(n_events) < (0.9 if kind == "signal" else 0.7) ).astype(np.int32)
+
+    for i_jet in range(2):
+        jet = "jet{0}".format(i_jet)
+        columns[jet+"_DepthTagCand"] = ( rng.random(n_events) < (0.7 if kind == "signal" else 0.5) ).astype(np.int32)
+        columns[jet+"_InclTagCand"]  = ( rng.random(n_events) < (0.7 if kind == "signal" else 0.5) ).astype(np.int32)
+        columns[jet+"_DeepCSV_prob_b"] = rng.beta(0.6, 4., n_events).astype(np.float32)
+
+        if kind == "signal":
+            decay = rng.exponential(ctau / 10., n_events)
+            in_calo = (decay > 20.) & (decay < 300.)
+            columns["LLP{0}_DecayCtau".format(i_jet)] = decay.astype(np.float32)
+            columns[jet+"_scores_depth_LLPanywhere"] = np.where(in_calo, rng.beta(5., 1., n_events), rng.beta(1., 3., n_events)).astype(np.float32)
+            columns[jet+"_scores_inc_train80"]       = np.where(in_calo, rng.beta(4., 1., n_events), rng.beta(1., 2., n_events)).astype(np.float32)
+        else:
+            columns["LLP{0}_DecayCtau".format(i_jet)] = np.zeros(n_events, dtype=np.float32)
+            columns[jet+"_scores_depth_LLPanywhere"] = rng.beta(0.5, 2.5, n_events).astype(np.float32)
+            columns[jet+"_scores_inc_train80"]       = rng.beta(0.5, 2.5, n_events).astype(np.float32)
+
+    columns["weight"] = np.full(n_events, signal_norm / n_events if kind == "signal" else 1., dtype=np.float32)
+
+    return { name: columns[name] for name in minituple_branches }
+
+# ------------------------------------------------------------------------------
+def write_minituple(outfilepath, n_events, kind="data", ctau=1000., seed=1, chunk_size=default_chunk_size, signal_norm=default_signal_norm):
+    """ Write n_events synthetic events as the NoSel tree of outfilepath, chunk_size events at a time
+
+    Every chunk is written with RDataFrame Snapshot from numpy arrays; several chunks are merged into
+    outfilepath with TFileMerger, so memory stays bounded by chunk_size. Chunk i uses the random stream
+    [seed, i], so the same arguments always give the same file.
+    """
+    import ROOT
+
+    # RDF.FromNumpy from ROOT 6.28, MakeNumpyDataFrame before
+    from_numpy = getattr(ROOT.RDF, "FromNumpy", None) or ROOT.RDF.MakeNumpyDataFrame
+
+    n_events = int(n_events)
+    n_chunks = max( 1, -(-n_events // chunk_size) )
+
+    if os.path.dirname(outfilepath): os.makedirs(os.path.dirname(outfilepath), exist_ok=True)
+    parts_dir = outfilepath + ".parts"
+    if n_chunks > 1: os.makedirs(parts_dir, exist_ok=True)
+
+    parts = []
+    for i_chunk in range(n_chunks):
+        n_chunk = min(chunk_size, n_events - i_chunk * chunk_size)
+        # Each chunk carries its share of the signal normalization
+        columns = generate_columns(n_chunk, kind, ctau, [seed, i_chunk], signal_norm * n_chunk / n_events)
+
+        part = outfilepath if n_chunks == 1 else os.path.join(parts_dir, "part{0}.root".format(i_chunk))
+        from_numpy(columns).Snapshot("NoSel", part)
+        parts.append(part)
+        print( "  {0}: {1}/{2} events".format(outfilepath, min((i_chunk + 1) * chunk_size, n_events), n_events) )
+
+    if n_chunks > 1:
+        merger = ROOT.TFileMerger(False)
+        for part in parts:
+            merger.AddFile(part)
+        merger.OutputFile(outfilepath, "RECREATE")
+        if not merger.Merge():
+            raise RuntimeError("could not merge the chunks of " + outfilepath)
+        shutil.rmtree(parts_dir)
+
+    return outfilepath
+
+# ------------------------------------------------------------------------------
+def main():
+
+    args = parseArgs()
+
+    write_minituple(args.output, args.events, args.kind, args.ctau, args.seed, args.chunk_size, args.signal_norm)
+    print( "Synthetic minituple written to:", args.output )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+import argparse
+import os
+import re
+import json
+import time
+
+import numpy as np
+
+from asymptotic_cls import CountingModel, apply_rate_params, parse_datacard
+
+# How the nuisances fluctuate in the toys:
+#   frequentist: generate at the nominal nuisances, randomize the global observables (combine --toysFrequentist)
+#   hybrid:      draw the nuisances from their priors to generate, fit with nominal global observables (combine default)
+#   none:        no nuisance fluctuations, only Poisson
+toy_modes = ["frequentist", "hybrid", "none"]
+
+# ------------------------------------------------------------------------------
+def is_positive_definite(matrices):
+    """ Whether each symmetric matrix of a [toys, n, n] stack is positive definite
+
+    Gaussian elimination without pivoting, vectorized over the stack: positive definite iff every pivot is > 0.
+    For the few parameters of a counting model this is much cheaper than eigenvalues.
+    """
+    reduced  = np.array(matrices, dtype=np.float64)
+    positive = np.ones(len(reduced), dtype=bool)
+    for k in range(reduced.shape[1]):
+        pivot = reduced[:, k, k]
+        positive &= pivot > 0
+        pivot = np.where(positive, pivot, 1.)
+        reduced[:, k+1:, k+1:] -= reduced[:, k+1:, k:k+1] * reduced[:, k:k+1, k+1:] / pivot[:, None, None]
+    return positive
+
+# ------------------------------------------------------------------------------
+class BatchedFit:
+    """ Maximum-likelihood fits of (mu, theta) for many datasets of one CountingModel at once
+
+    All arrays carry the toys along the first axis. The fit is a Newton iteration with analytic gradient and
+    Hessian, falling back to Fisher scoring where the Hessian is not positive definite, with a per-toy step
+    halving so the NLL never increases. mu is not bounded (negative values are allowed while all rates stay positive).
+    """
+
+    def __init__(self, model):
+        if np.any(model.is_gamma):
+            raise ValueError("toys only support lnN nuisances, not gmN: " + ", ".join( np.array(model.nuisance_names)[model.is_gamma] ))
+
+        self.model = model
+        self.n_params = 1 + model.n_nuisances
+
+        # Constraint term of the Hessian: unit Gaussians on the nuisances, none on mu
+        self.constraint = np.diag( np.concatenate([[0.], np.ones(model.n_nuisances)]) )
+
+    # --------------------------------------------------------------------------
+    def column_rates(self, params):
+        """ (rates, signal part of the rates without mu): both [toys, columns]
+        """
+        model = self.model
+        scale = np.exp(params[:, 1:] @ model.log_kappa) * model.rates
+        signal = np.where(model.is_signal, scale, 0.)
+        return np.where(model.is_signal, params[:, :1] * scale, scale), signal
+
+    def nll(self, params, data, theta0):
+        # Trial steps can overflow the rates, those get an infinite NLL
+        with np.errstate(over="ignore", divide="ignore", invalid="ignore"):
+            rates, _ = self.column_rates(params)
+            lam = rates @ self.model.to_bins
+            log_term = np.where(data > 0, data * np.log(lam), 0.)
+            nll = np.sum(lam - log_term, axis=1) + 0.5 * np.sum( (params[:, 1:] - theta0)**2, axis=1 )
+        return np.where( np.all(lam > 0, axis=1), nll, np.inf )
+
+    # --------------------------------------------------------------------------
+    def derivatives(self, params, data, theta0):
+        """ Gradient, Hessian and Fisher information of the NLL: [toys, params] and [toys, params, params]
+        """
+        model = self.model
+        rates, signal = self.column_rates(params)
+        lam = rates @ model.to_bins
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = np.where(data > 0, data / lam, 0.)
+            curvature = np.where(data > 0, ratio / lam, 0.)
+
+        # d rate_c / d param_i: signal part for mu, log(kappa) * rate for every theta
+        d_rates = np.concatenate( [ signal[:, None, :], model.log_kappa[None, :, :] * rates[:, None, :] ], axis=1 )
+        n_toys  = len(params)
+        # Products with the fixed model matrices as one 2D product over all toys (stacks of tiny matrices are slow in matmul)
+        d_lam   = ( d_rates.reshape(-1, len(model.rates)) @ model.to_bins ).reshape(n_toys, self.n_params, -1)
+
+        residual = 1. - ratio
+        gradient = np.sum( d_lam * residual[:, None, :], axis=2 )
+        gradient[:, 1:] += params[:, 1:] - theta0
+
+        # d2 rate_c / d param_i d param_j is log(kappa_i) * d rate_c / d param_j for theta_i (and symmetric), zero for mu mu,
+        # so its contraction with the per-column residual is one batched matrix product
+        residual_columns = residual @ model.to_bins.T
+        cross = ( ( d_rates * residual_columns[:, None, :] ).reshape(-1, len(model.rates)) @ model.log_kappa.T ).reshape(n_toys, self.n_params, -1)
+        second = np.zeros( (n_toys, self.n_params, self.n_params) )
+        second[:, 1:, :] = cross.transpose(0, 2, 1)
+        second[:, 0, 1:] = second[:, 1:, 0]
+
+        # sum_b d_lam_i d_lam_j w_b over the few bins by broadcasting
+        d_lam_pairs = d_lam[:, :, None, :] * d_lam[:, None, :, :]
+        hessian = second + np.sum( d_lam_pairs * curvature[:, None, None, :], axis=3 ) + self.constraint
+        with np.errstate(divide="ignore", invalid="ignore"):
+            fisher = np.sum( d_lam_pairs * np.where(lam > 0, 1. / lam, 0.)[:, None, None, :], axis=3 ) + self.constraint
+
+        return gradient, hessian, fisher
+
+    # --------------------------------------------------------------------------
+    def fit(self, data, theta0, max_iterations=50, tolerance=1e-9):
+        """ Best fit of every toy; returns (params, nll, covariance, converged)
+        """
+        model = self.model
+        n_toys = len(data)
+
+        # Start from the nominal nuisances and the background-subtracted signal strength
+        signal_total     = np.sum(model.rates[model.is_signal])
+        background_total = np.sum(model.rates[~model.is_signal])
+        params = np.zeros( (n_toys, self.n_params) )
+        params[:, 0]  = np.maximum( (data.sum(axis=1) - background_total) / signal_total, 0. )
+        params[:, 1:] = theta0
+
+        nll = self.nll(params, data, theta0)
+        converged = np.zeros(n_toys, dtype=bool)
+
+        for _ in range(max_iterations):
+            # Converged toys drop out: every iteration works on compact arrays of the active toys only
+            active = np.flatnonzero(~converged)
+            if len(active) == 0: break
+            params_active, data_active, theta0_active, nll_active = params[active], data[active], theta0[active], nll[active]
+
+            gradient, hessian, fisher = self.derivatives(params_active, data_active, theta0_active)
+
+            # Newton where the Hessian is positive definite, Fisher scoring elsewhere
+            positive = is_positive_definite(hessian)
+            matrix = np.where(positive[:, None, None], hessian, fisher)
+            step = np.linalg.solve(matrix, gradient[:, :, None])[:, :, 0]
+
+            # Step halving until the NLL does not increase
+            params_new = params_active.copy()
+            nll_new    = nll_active.copy()
+            pending    = np.arange(len(active))
+            scale      = 1.
+            for _ in range(30):
+                candidate = params_active[pending] - scale * step[pending]
+                nll_candidate = self.nll(candidate, data_active[pending], theta0_active[pending])
+                accept = nll_candidate <= nll_active[pending]
+
+                params_new[pending[accept]] = candidate[accept]
+                nll_new[pending[accept]]    = nll_candidate[accept]
+                pending = pending[~accept]
+
+                if len(pending) == 0: break
+                scale *= 0.5
+
+            no_step = np.zeros(len(active), dtype=bool)
+            no_step[pending] = True
+
+            improvement = nll_active - nll_new
+            params[active] = params_new
+            nll[active]    = nll_new
+            converged[active] = (improvement < tolerance) & ( np.max(np.abs(gradient), axis=1) < 1e-4 ) | no_step
+
+        # Covariance from the Hessian at the minimum (NaN where it is not positive definite)
+        _, hessian, _ = self.derivatives(params, data, theta0)
+        positive = is_positive_definite(hessian)
+        covariance = np.full_like(hessian, np.nan)
+        if np.any(positive):
+            covariance[positive] = np.linalg.inv(hessian[positive])
+
+        return params, nll, covariance, converged & positive
+
+# ------------------------------------------------------------------------------
+def generate_toys(model, mu, n_toys, mode="frequentist", rng=None):
+    """ Toy datasets [toys, bins], the global observables for the fit [toys, nuisances] and the true nuisances [toys, nuisances]
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    n = model.n_nuisances
+
+    theta_true = np.zeros( (n_toys, n) )
+    theta0     = np.zeros( (n_toys, n) )
+    if mode == "frequentist":
+        theta0 = rng.standard_normal( (n_toys, n) )
+    elif mode == "hybrid":
+        theta_true = rng.standard_normal( (n_toys, n) )
+    elif mode != "none":
+        raise ValueError("unknown toy mode: " + mode)
+
+    rates = model.rates * np.where(model.is_signal, mu, 1.) * np.exp(theta_true @ model.log_kappa)
+    data  = rng.poisson( rates @ model.to_bins ).astype(np.float64)
+
+    return data, theta0, theta_true
+
+# ------------------------------------------------------------------------------
+def toy_study(model, mu, n_toys, mode="frequentist", rng=None, batch_size=100000):
+    """ Fit n_toys toys generated with signal strength mu; returns bias, pull and coverage summaries
+    """
+    fitter = BatchedFit(model)
+
+    mu_hat, sigma_mu, theta_pulls, converged = [], [], [], []
+    for start in range(0, n_toys, batch_size):
+        data, theta0, theta_true = generate_toys(model, mu, min(batch_size, n_toys - start), mode, rng)
+        params, _, covariance, converged_batch = fitter.fit(data, theta0)
+
+        errors = np.sqrt( np.diagonal(covariance, axis1=1, axis2=2) )
+        mu_hat.append( params[:, 0] )
+        sigma_mu.append( errors[:, 0] )
+        theta_pulls.append( (params[:, 1:] - theta_true) / errors[:, 1:] )
+        converged.append( converged_batch )
+
+    mu_hat      = np.concatenate(mu_hat)
+    sigma_mu    = np.concatenate(sigma_mu)
+    theta_pulls = np.concatenate(theta_pulls)
+    converged   = np.concatenate(converged)
+
+    good  = converged & np.isfinite(sigma_mu) & (sigma_mu > 0)
+    pulls = (mu_hat[good] - mu) / sigma_mu[good]
+
+    summary = {
+        "mu_injected": mu,
+        "n_toys": n_toys,
+        "fit_failures": float( 1. - np.mean(good) ),
+        "mu_hat_mean": float( np.mean(mu_hat[good]) ),
+        "mu_hat_median": float( np.median(mu_hat[good]) ),
+        "bias": float( np.mean(mu_hat[good]) - mu ),
+        "sigma_mu_median": float( np.median(sigma_mu[good]) ),
+        "pull_mean": float( np.mean(pulls) ),
+        "pull_width": float( np.std(pulls) ),
+        "coverage_1sigma": float( np.mean( np.abs(pulls) <= 1. ) ),
+        "coverage_2sigma": float( np.mean( np.abs(pulls) <= 2. ) ),
+        "nuisance_pulls": { name: { "mean": float( np.mean(theta_pulls[good, k]) ), "width": float( np.std(theta_pulls[good, k]) ) }
+                            for k, name in enumerate(model.nuisance_names) },
+    }
+
+    return summary, { "mu_hat": mu_hat, "sigma_mu": sigma_mu, "theta_pulls": theta_pulls, "converged": good }
+
+# ------------------------------------------------------------------------------
+def asimov_test(model, mu):
+    """ Fit of the Asimov dataset with signal strength mu: the fitted mu must come back unbiased
+    """
+    data = (model.rates * np.where(model.is_signal, mu, 1.)) @ model.to_bins
+    params, _, covariance, converged = BatchedFit(model).fit(data[None, :], np.zeros( (1, model.n_nuisances) ))
+
+    return { "mu_injected": mu, "mu_hat": float(params[0, 0]), "sigma_mu": float( np.sqrt(covariance[0, 0, 0]) ),
+             "bias": float(params[0, 0] - mu), "converged": bool(converged[0]) }
+
+# ------------------------------------------------------------------------------
+def parseArgs():
+    """ Parse command-line arguments
+    """
+    parser = argparse.ArgumentParser(
+        add_help=True,
+        description='Signal injection, Asimov and pull studies with vectorized toys on counting datacards'
+    )
+
+    parser.add_argument("datacards",          nargs="+", help="Datacards written by combine_wrapper.py (one per lifetime point)")
+    parser.add_argument("--inject",           action="store", default="0,1", help="Comma separated injected signal strengths (datacard units)")
+    parser.add_argument("-n", "--toys",       action="store", type=int, default=100000, help="Number of toys per injected signal strength")
+    parser.add_argument("--mode",             action="store", default="frequentist", choices=toy_modes, help="Nuisance treatment in the toys")
+    parser.add_argument("--seed",             action="store", type=int, default=1, help="Random seed")
+    parser.add_argument("--batch-size",       action="store", type=int, default=100000, help="Toys fitted at once (memory)")
+    parser.add_argument("-o", "--output",     action="store", default="output/toys.json", help="Output json")
+    parser.add_argument("--save-toys",        action="store_true", default=False, help="Also write the per-toy fit results (npz next to the json)")
+
+    return parser.parse_args()
+
+# ------------------------------------------------------------------------------
+def main():
+
+    # ----- Process Inputs ----- #
+
+    args = parseArgs()
+
+    injected = [ float(mu) for mu in args.inject.split(",") ]
+    rng = np.random.default_rng(args.seed)
+
+    results  = {}
+    per_toy  = {}
+
+    print( "{0:50s} {1:>6s} {2:>9s} {3:>9s} {4:>9s} {5:>7s} {6:>7s} {7:>7s} {8:>7s}".format(
+           "datacard", "mu", "asimov", "bias", "pull", "width", "cov68", "cov95", "time") )
+
+    for datacard in args.datacards:
+        with open(datacard) as f:
+            model = CountingModel( apply_rate_params(parse_datacard(f.read())) )
+
+        # Lifetime point from the combine_wrapper datacard name (..__<ctau>.txt), else the file name
+        match = re.search(r"__([^_]+)\.txt$", os.path.basename(datacard))
+        label = match.group(1) if match else os.path.basename(datacard)
+
+        results[datacard] = { "label": label, "studies": [] }
+        for mu in injected:
+            start = time.time()
+            asimov = asimov_test(model, mu)
+            summary, fits = toy_study(model, mu, args.toys, args.mode, rng, args.batch_size)
+            summary["asimov"]  = asimov
+            summary["elapsed"] = time.time() - start
+            results[datacard]["studies"].append(summary)
+            per_toy["{0}__mu{1:g}".format(label, mu)] = fits
+
+            print( "{0:50s} {1:6g} {2:9.4f} {3:9.4f} {4:9.4f} {5:7.3f} {6:7.3f} {7:7.3f} {8:6.1f}s".format(
+                   os.path.basename(datacard), mu, asimov["bias"], summary["bias"], summary["pull_mean"], summary["pull_width"],
+                   summary["coverage_1sigma"], summary["coverage_2sigma"], summary["elapsed"]) )
+
+    if os.path.dirname(args.output): os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump({ "mode": args.mode, "seed": args.seed, "results": results }, f, indent=2)
+    print( "Json file written to:", args.output )
+
+    if args.save_toys:
+        outfile_toys = args.output.replace(".json", ".npz")
+        np.savez(outfile_toys, **{ key + "__" + name: values for key, fits in per_toy.items() for name, values in fits.items() })
+        print( "Toys written to:", outfile_toys )
+
+if __name__ == '__main__':
+    main()